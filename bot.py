@@ -1,19 +1,44 @@
 
 # --- START: Minimal HTTP server for Render ping ---
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import threading
 
 class PingHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        if self.path == "/metrics":
+            body = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path in ("/healthz", "/readyz"):
+            if self.path == "/healthz":
+                ok, report = HEALTH.live()
+            else:
+                ok, report = HEALTH.ready()
+            body = json.dumps({"ok": ok, **report}).encode("utf-8")
+            self.send_response(200 if ok else 503)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+            return
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"Bot is running")
 
+    def do_POST(self):
+        # update từ Telegram (webhook mode), xem WebhookReceiver
+        status = WEBHOOK.receive(self.path, self.headers, self.rfile)
+        self.send_response(status)
+        self.end_headers()
+
 def run_server():
-    server = HTTPServer(('0.0.0.0', 10000), PingHandler)
+    server = ThreadingHTTPServer(('0.0.0.0', 10000), PingHandler)
+    server.daemon_threads = True
     server.serve_forever()
 
-threading.Thread(target=run_server).start()
 # --- END: Minimal HTTP server ---
 
 
@@ -23,14 +48,39 @@ import json
 import csv
 import calendar
 import base64
+import gzip
 import hashlib
+import io
+import zlib
+import hmac
+import html
+import functools
+import contextlib
+import copy
+import multiprocessing
+import sqlite3
+import sys
+import asyncio
+import bisect
+import heapq
+import random
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from datetime import time as dt_time
 
 import requests
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 
 # ================== CONFIG ==================
 
+# pool xoay khoá (spawn) chạy lại file này trong mỗi process con dưới tên
+# __mp_main__: khi đó không tạo store, phiên, sao lưu, client/hàng đợi
+# Telegram (process con chỉ chạy hàm trong rotation_worker)
+SPAWN_CHILD = __name__ == "__mp_main__"
+
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 if not TELEGRAM_BOT_TOKEN:
     print("❌ Lỗi: Thiếu TELEGRAM_BOT_TOKEN trong environment variables")
@@ -40,20 +90,107 @@ MASTER_SECRET = os.environ.get("MASTER_SECRET")
 if not MASTER_SECRET:
     print("❌ Lỗi: Thiếu MASTER_SECRET trong environment variables")
     raise SystemExit(1)
-
-BASE_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+# các MASTER_SECRET cũ (cách nhau bởi dấu phẩy): chỉ dùng để giải mã dữ liệu
+# chưa xoay sang khoá mới
+OLD_MASTER_SECRETS = [
+    s.strip() for s in os.environ.get("OLD_MASTER_SECRETS", "").split(",")
+    if s.strip()
+]
+# chat_id được dùng lệnh quản trị (VD: /xoay_khoa, /khoi_phuc), cách nhau bởi dấu phẩy
+ADMIN_CHAT_IDS = {
+    s.strip() for s in os.environ.get("ADMIN_CHAT_IDS", "").split(",")
+    if s.strip()
+}
+# xoay khoá: số login mỗi batch (commit 1 lần) và số process mã hoá song song
+ROTATE_BATCH_SIZE = int(os.environ.get("ROTATE_BATCH_SIZE", 500))
+ROTATE_WORKERS = int(os.environ.get("ROTATE_WORKERS", os.cpu_count() or 2))
+# cache login đã giải mã cho /get_mail_login: số mục tối đa và thời gian sống
+# (giây); đặt CRED_CACHE_TTL=0 để tắt hẳn
+CRED_CACHE_SIZE = int(os.environ.get("CRED_CACHE_SIZE", 64))
+CRED_CACHE_TTL = float(os.environ.get("CRED_CACHE_TTL", 120))
+
+# đổi sang server giả lập Bot API khi test, VD: http://127.0.0.1:8081
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL",
+                                  "https://api.telegram.org").rstrip("/")
+BASE_URL = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}"
+FILE_URL = f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_BOT_TOKEN}"
+# số lần thử lại và độ trễ backoff gốc (giây) khi gọi Telegram bị lỗi mạng/5xx
+TELEGRAM_RETRIES = int(os.environ.get("TELEGRAM_RETRIES", 3))
+TELEGRAM_BACKOFF = float(os.environ.get("TELEGRAM_BACKOFF", 0.5))
+# giới hạn gửi tin: toàn bot (tin/giây), mỗi chat (tin/giây) và số tin chờ tối
+# đa mỗi hàng (đầy thì bên gửi phải chờ)
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", 30))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_QUEUE_SIZE = int(os.environ.get("OUTBOUND_QUEUE_SIZE", 1000))
+# đặt WEBHOOK_URL (VD: https://ten-app.onrender.com) để nhận update qua webhook
+# trên cổng 10000 thay cho long polling; secret mặc định suy ra từ token
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(
+    f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+# ngưỡng (giây / số update) để /readyz báo lỗi; 0 = không kiểm tra
+HEALTH_MAX_POLL_AGE = float(os.environ.get("HEALTH_MAX_POLL_AGE", 300))
+HEALTH_MAX_REMINDER_AGE = float(
+    os.environ.get("HEALTH_MAX_REMINDER_AGE", 7200))
+HEALTH_MAX_SAVE_AGE = float(os.environ.get("HEALTH_MAX_SAVE_AGE", 0))
+HEALTH_MAX_BACKLOG = int(os.environ.get("HEALTH_MAX_BACKLOG", 1000))
+# sao lưu tăng dần: thư mục, chu kỳ (giây, 0 = tắt), số bản delta giữa 2 bản
+# full và số bản full giữ lại
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", 3600))
+BACKUP_FULL_EVERY = int(os.environ.get("BACKUP_FULL_EVERY", 24))
+BACKUP_KEEP_FULL = int(os.environ.get("BACKUP_KEEP_FULL", 7))
+# nén gzip file /sao_luu và /xuat_csv khi gửi
+EXPORT_GZIP = os.environ.get("EXPORT_GZIP", "0") == "1"
+# số thread chạy handler song song (mỗi chat vẫn xử lý tuần tự)
+HANDLER_WORKERS = int(os.environ.get("HANDLER_WORKERS", 16))
 DATA_FILE = "farms_data.json"
+JOURNAL_FILE = DATA_FILE + ".journal"
+# journal vượt ngưỡng này (byte) thì gộp vào snapshot
+JOURNAL_COMPACT_BYTES = int(os.environ.get("JOURNAL_COMPACT_BYTES", 1024 * 1024))
+# "json" (mặc định, farms_data.json) hoặc "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").lower()
+SQLITE_FILE = os.environ.get("SQLITE_FILE", "farms_data.db")
+# phiên hội thoại (flow đang dở): hết hạn sau SESSION_TTL giây không thao tác,
+# tối đa SESSION_MAX phiên; SESSION_FILE = file lưu phiên khi khởi động lại
+# (để trống = chỉ giữ trong RAM)
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 1800))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 10000))
+SESSION_FILE = os.environ.get("SESSION_FILE", "sessions.json")
+# mỗi farm chỉ giữ HISTORY_KEEP lần nhắc gần nhất trong dữ liệu chính (0 = giữ
+# hết), cũ hơn chuyển sang file lưu trữ theo tháng trong HISTORY_DIR
+HISTORY_KEEP = int(os.environ.get("HISTORY_KEEP", 20))
+HISTORY_DIR = os.environ.get("HISTORY_DIR", "history")
+# giờ (0-23, giờ máy chủ) gửi tin nhắc hạn trong ngày
+REMINDER_HOUR = int(os.environ.get("REMINDER_HOUR", 9))
+# gộp các tin nhắc cùng lượt của 1 chat thành 1 (vài) tin tổng hợp
+REMINDER_DIGEST = os.environ.get("REMINDER_DIGEST", "1") != "0"
+# bỏ dấu tiếng Việt khi so tên farm ("hieu 1" khớp "Hiếu 1")
+NAME_FOLD_DIACRITICS = os.environ.get("NAME_FOLD_DIACRITICS", "1") != "0"
 
 # ================== ENCRYPTION (AES-256 / FERNET) ==================
 
 
-def _build_fernet():
-    key = hashlib.sha256(MASTER_SECRET.encode("utf-8")).digest()
-    fkey = base64.urlsafe_b64encode(key)
-    return Fernet(fkey)
+def _fernet_key(secret):
+    key = hashlib.sha256(secret.encode("utf-8")).digest()
+    return base64.urlsafe_b64encode(key)
+
+
+def key_id(secret):
+    # mã ngắn của khoá, lưu kèm blob ("kid") để biết blob đang dùng khoá nào
+    return hashlib.sha256(_fernet_key(secret)).hexdigest()[:8]
+
+
+def _build_fernet(secrets=None):
+    # khoá đầu tiên dùng để mã hoá, các khoá sau chỉ để giải mã (khoá cũ)
+    if secrets is None:
+        secrets = [MASTER_SECRET, *OLD_MASTER_SECRETS]
+    return MultiFernet([Fernet(_fernet_key(s)) for s in secrets])
 
 
 FERNET = _build_fernet()
+KEY_ID = key_id(MASTER_SECRET)
 
 
 def encrypt_text(plain: str) -> str:
@@ -70,22 +207,581 @@ def decrypt_text(token: str) -> str:
     return plain.decode("utf-8")
 
 
+class CredentialCache:
+    # LRU nhỏ, TTL ngắn cho bundle login đã giải mã. Khoá gồm farm, email và
+    # hash của ciphertext nên sửa login là mục cũ tự mất hiệu lực. Bản rõ giữ
+    # trong bytearray để khi bị loại có thể ghi đè bằng 0 (str thì không sửa
+    # được tại chỗ).
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    @staticmethod
+    def _wipe(buf):
+        buf[:] = bytes(len(buf))
+
+    def _evict(self, key):
+        _, buf = self._items.pop(key)
+        self._wipe(buf)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._items):
+                self._evict(key)
+
+    def get(self, farm_id, email, token, load):
+        # load(token) -> bytes bản rõ, chỉ gọi khi không có trong cache
+        if not self.enabled:
+            return load(token)
+        key = (farm_id, email, hashlib.sha256(token.encode("utf-8")).digest())
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return bytes(item[1])
+            if item is not None:
+                self._evict(key)
+            self.misses += 1
+        plain = load(token)
+        with self._lock:
+            if key in self._items:
+                self._evict(key)
+            self._items[key] = (now + self.ttl, bytearray(plain))
+            for old in [k for k, (exp, _) in self._items.items() if exp <= now]:
+                self._evict(old)
+            while len(self._items) > self.maxsize:
+                self._evict(next(iter(self._items)))
+        return plain
+
+
+CRED_CACHE = CredentialCache(CRED_CACHE_SIZE, CRED_CACHE_TTL)
+
+
+def decrypt_login(farm_id, email, token):
+    # bundle {"password", "twofa", "note"} của 1 email_login, qua cache
+    plain = CRED_CACHE.get(farm_id, email, token,
+                           lambda t: FERNET.decrypt(t.encode("utf-8")))
+    return json.loads(plain.decode("utf-8"))
+
+
+# ================== TEXT / INDEXES ==================
+
+
+def fold_diacritics(text):
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return text.replace("đ", "d").replace("Đ", "D")
+
+
+def normalize_name(name, fold=None):
+    if fold is None:
+        fold = NAME_FOLD_DIACRITICS
+    if name.isascii():
+        return " ".join(name.lower().split())
+    key = unicodedata.normalize("NFC", name).casefold()
+    if fold:
+        key = fold_diacritics(key)
+    return " ".join(key.split())
+
+
+class NameIndex:
+    # tên đã chuẩn hoá -> danh sách id farm (nhiều id = tên bị trùng)
+    fields = ("name", )
+
+    def __init__(self):
+        self._map = {}
+
+    def clear(self):
+        self._map = {}
+
+    def add(self, farm):
+        key = normalize_name(farm.get("name", ""))
+        self._map.setdefault(key, []).append(farm["id"])
+
+    def remove(self, farm):
+        key = normalize_name(farm.get("name", ""))
+        ids = self._map.get(key)
+        if ids and farm["id"] in ids:
+            ids.remove(farm["id"])
+            if not ids:
+                del self._map[key]
+
+    def lookup(self, name):
+        return self._map.get(normalize_name(name), [])
+
+    def duplicates(self):
+        return [ids for ids in self._map.values() if len(ids) > 1]
+
+
+def search_key(text):
+    # khoá tìm kiếm luôn bỏ dấu, không phụ thuộc NAME_FOLD_DIACRITICS
+    return normalize_name(text, fold=True)
+
+
+class TrigramIndex:
+    # Chỉ mục 3-gram cho /tim_farm trên tên, email chủ và email thành viên.
+    # Posting list là array('I') chỉ nối thêm: xoá/sửa farm chỉ bỏ khỏi
+    # _terms, id cũ còn trong posting bị lọc khi kiểm tra lại và được dọn
+    # khi số id cũ vượt số farm đang có.
+    fields = ("name", "owner_email", "members")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._postings = {}
+        self._terms = {}
+        self._stale = 0
+
+    @staticmethod
+    def _grams(term):
+        return {term[i:i + 3] for i in range(len(term) - 2)}
+
+    def _add_terms(self, farm_id, terms):
+        self._terms[farm_id] = terms
+        grams = set()
+        for t in terms:
+            grams |= self._grams(t)
+        for g in grams:
+            posting = self._postings.get(g)
+            if posting is None:
+                posting = self._postings[g] = array("I")
+            posting.append(farm_id)
+
+    def add(self, farm):
+        terms = [
+            search_key(farm.get("name", "")),
+            search_key(farm.get("owner_email", "")),
+        ]
+        terms += [search_key(m) for m in farm.get("members", [])]
+        self._add_terms(farm["id"], terms)
+
+    def remove(self, farm):
+        if self._terms.pop(farm["id"], None) is None:
+            return
+        self._stale += 1
+        if self._stale > 1000 and self._stale > len(self._terms):
+            terms = self._terms
+            self.clear()
+            for farm_id, ts in terms.items():
+                self._add_terms(farm_id, ts)
+
+    def search(self, query):
+        # trả về id farm theo thứ tự: khớp hẳn, khớp đầu, khớp giữa
+        return [farm_id for _, farm_id in self.ranked(query)]
+
+    def ranked(self, query):
+        # [(hạng, id)] đã sắp xếp; gộp được kết quả của nhiều index
+        q = search_key(query)
+        if not q:
+            return []
+        if len(q) < 3:
+            candidates = list(self._terms)
+        else:
+            postings = [self._postings.get(g) for g in self._grams(q)]
+            if any(p is None for p in postings):
+                return []
+            candidates = set(min(postings, key=len))
+        ranked = []
+        for farm_id in candidates:
+            terms = self._terms.get(farm_id)
+            if terms is None:
+                continue
+            best = None
+            for t in terms:
+                if t == q:
+                    best = 0
+                    break
+                if t.startswith(q):
+                    best = 1
+                elif best is None and q in t:
+                    best = 2
+            if best is not None:
+                ranked.append((best, farm_id))
+        ranked.sort()
+        return ranked
+
+
+class RenewalIndex:
+    # renewal_day (1-31) -> tập id farm; kết hợp renewal_day_map để lấy các
+    # farm đến hạn trong 1 khoảng ngày mà không phải tính ngày cho mọi farm.
+    fields = ("renewal_day", )
+
+    def __init__(self):
+        self._buckets = {}
+
+    def clear(self):
+        self._buckets = {}
+
+    def add(self, farm):
+        self._buckets.setdefault(farm.get("renewal_day", 1),
+                                 set()).add(farm["id"])
+
+    def remove(self, farm):
+        self._buckets.get(farm.get("renewal_day", 1), set()).discard(farm["id"])
+
+    def due(self, start, days):
+        # [(id, ngày đến hạn)] trong [start, start + days]
+        res = []
+        for rday, d in renewal_day_map(start, days).items():
+            for farm_id in self._buckets.get(rday, ()):
+                res.append((farm_id, d))
+        return res
+
+
+class TotalsIndex:
+    # số farm, tổng tiền và số farm bật nhắc, cập nhật dần cho /thong_ke
+    fields = ("price", "reminder_enabled")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.price = 0
+        self.active = 0
+
+    def _apply(self, farm, sign):
+        self.count += sign
+        self.price += sign * farm.get("price", 0)
+        if farm.get("reminder_enabled", True):
+            self.active += sign
+
+    def add(self, farm):
+        self._apply(farm, 1)
+
+    def remove(self, farm):
+        self._apply(farm, -1)
+
+
+def owner_key(chat_id):
+    # khoá phân vùng theo chat tạo farm ("" = farm cũ không có chat_id)
+    return "" if chat_id is None else str(chat_id)
+
+
+class FarmPartition:
+    # farm của 1 chat cùng bộ chỉ mục riêng: danh sách, tìm kiếm, báo cáo của
+    # 1 chat chỉ chạm vào phân vùng của chat đó, không phụ thuộc tổng số farm
+
+    def __init__(self):
+        self.farms = []
+        self.names = NameIndex()
+        self.trigrams = TrigramIndex()
+        self.renewals = RenewalIndex()
+        self.totals = TotalsIndex()
+        self.indexes = [self.names, self.trigrams, self.renewals, self.totals]
+
+    def add(self, farm):
+        self.farms.append(farm)
+        for index in self.indexes:
+            index.add(farm)
+
+    def remove(self, farm):
+        for index in self.indexes:
+            index.remove(farm)
+        self.farms.remove(farm)
+
+
+class TenantView:
+    # các hàm đọc của store giới hạn trong farm của 1 chat (owner=None: mọi
+    # chat, cho admin); hàm ghi và meta chuyển thẳng xuống store
+
+    def __init__(self, store, owner):
+        self.store = store
+        self.owner = owner
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def farms(self):
+        return self.store.farms(owner=self.owner)
+
+    def iter_farms(self, batch=500):
+        return self.store.iter_farms(batch, owner=self.owner)
+
+    def has_farms(self):
+        return self.store.has_farms(owner=self.owner)
+
+    def page_farms(self, offset, limit):
+        return self.store.page_farms(offset, limit, owner=self.owner)
+
+    def summary(self):
+        return self.store.summary(owner=self.owner)
+
+    def farm_by_id(self, farm_id):
+        return self.store.farm_by_id(farm_id, owner=self.owner)
+
+    def find_farm(self, name):
+        return self.store.find_farm(name, owner=self.owner)
+
+    def duplicate_names(self):
+        return self.store.duplicate_names(owner=self.owner)
+
+    def search_farms(self, keyword):
+        return self.store.search_farms(keyword, owner=self.owner)
+
+    def farms_due(self, start, days):
+        return self.store.farms_due(start, days, owner=self.owner)
+
+
+# ================== METRICS ==================
+
+
+class Histogram:
+    # histogram bucket cố định (giây), an toàn giữa các thread
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        # [(cận trên, số mẫu cộng dồn)], tổng, số mẫu
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self.sum, self.count
+        cumulative, acc = [], 0
+        for bound, c in zip(self.BUCKETS + (float("inf"), ), counts):
+            acc += c
+            cumulative.append((bound, acc))
+        return cumulative, total, count
+
+    def quantile(self, q):
+        # ước lượng theo cận trên của bucket chứa phân vị q
+        cumulative, _, count = self.snapshot()
+        if not count:
+            return 0.0
+        for bound, acc in cumulative:
+            if acc >= q * count:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    # registry nhỏ, xuất theo định dạng text của Prometheus ở GET /metrics.
+    # Counter/histogram có nhãn tạo dần khi có mẫu; collect(fn) đăng ký hàm
+    # trả về các số liệu mà thành phần khác tự giữ (API, router, hàng đợi).
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        with self._lock:
+            self._families.setdefault(name, (kind, help_text, {}))
+
+    def _sample(self, name, labels, factory):
+        _, _, samples = self._families[name]
+        key = tuple(sorted(labels.items()))
+        sample = samples.get(key)
+        if sample is None:
+            sample = samples[key] = factory()
+        return sample
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            cell = self._sample(name, labels, lambda: [0])
+            cell[0] += value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            hist = self._sample(name, labels, Histogram)
+        hist.observe(value)
+
+    def collect(self, fn):
+        # fn() -> [(tên, loại, mô tả, [(nhãn dict, số hoặc Histogram)])]
+        self._collectors.append(fn)
+
+    def render(self):
+        with self._lock:
+            families = [(name, kind, help_text, list(samples.items()))
+                        for name, (kind, help_text, samples)
+                        in self._families.items()]
+        families = [(name, kind, help_text,
+                     [(dict(key), v[0] if isinstance(v, list) else v)
+                      for key, v in samples])
+                    for name, kind, help_text, samples in families]
+        for fn in self._collectors:
+            try:
+                families.extend(fn())
+            except Exception as e:
+                print("Lỗi thu thập metrics:", e)
+        lines = []
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    cumulative, total, count = value.snapshot()
+                    for bound, acc in cumulative:
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket"
+                                     f"{_labels(labels, le=le)} {acc}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # không có /proc: dùng đỉnh RSS (Linux tính KB, macOS tính byte)
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+METRICS = Metrics()
+METRICS.describe("bot_updates_total", "counter",
+                 "Số update Telegram đã nhận")
+METRICS.describe("bot_store_load_seconds", "histogram",
+                 "Thời gian nạp dữ liệu (snapshot + journal)")
+METRICS.describe("bot_store_write_seconds", "histogram",
+                 "Thời gian ghi dữ liệu theo loại ghi")
+METRICS.describe("bot_store_bytes_written_total", "counter",
+                 "Số byte đã ghi ra đĩa theo loại ghi")
+METRICS.describe("bot_page_cache_total", "counter",
+                 "Số lần lấy trang danh sách từ cache (hit) / dựng lại (miss)")
+METRICS.describe("bot_import_farms_total", "counter",
+                 "Số farm thêm qua /nhap_du_lieu")
+METRICS.describe("bot_backup_seconds", "histogram",
+                 "Thời gian mỗi lần sao lưu tăng dần")
+METRICS.describe("bot_reminder_pass_seconds", "histogram",
+                 "Thời gian mỗi lượt xử lý nhắc hạn")
+METRICS.describe("bot_reminder_farms_scanned_total", "counter",
+                 "Số farm scheduler đã xét")
+METRICS.describe("bot_reminder_farms_due_total", "counter",
+                 "Số lần nhắc đến hạn cần gửi")
+METRICS.collect(lambda: [("process_resident_memory_bytes", "gauge",
+                          "RSS của tiến trình", [({}, process_rss_bytes())])])
+
+
+# ================== HEALTH ==================
+
+
+class Health:
+    # Mốc thời gian (monotonic) của các vòng chính: "loop" (nhịp event loop),
+    # "get_updates" (poll thành công), "reminder_pass" (nhịp thread nhắc hạn,
+    # ít nhất mỗi phút kể cả khi không có gì tới hạn), "save" / "save_error".
+    # /healthz: tiến trình còn chạy vòng chính; /readyz: thêm các ngưỡng tuổi
+    # và backlog, để orchestrator khởi động lại bot bị treo.
+
+    def __init__(self):
+        self._marks = {}
+        self.running = False
+        self.mode = "polling"
+        self.backlog = lambda: 0
+
+    def mark(self, name):
+        self._marks[name] = time.monotonic()
+
+    def age(self, name):
+        t = self._marks.get(name)
+        return None if t is None else time.monotonic() - t
+
+    def report(self):
+        ages = {
+            name: self.age(name)
+            for name in ("loop", "get_updates", "reminder_pass", "save",
+                         "save_error")
+        }
+        backlog = {"dispatch": self.backlog(), "outbound": sum(OUTBOX.depth())}
+        checks = {"running": self.running}
+        # event loop không nhịp quá 60 giây = bị treo
+        checks["loop"] = ages["loop"] is not None and ages["loop"] < 60
+        if self.mode == "polling" and HEALTH_MAX_POLL_AGE:
+            checks["get_updates"] = (ages["get_updates"] is not None and
+                                     ages["get_updates"] < HEALTH_MAX_POLL_AGE)
+        if HEALTH_MAX_REMINDER_AGE:
+            checks["reminder_pass"] = (
+                ages["reminder_pass"] is not None and
+                ages["reminder_pass"] < HEALTH_MAX_REMINDER_AGE)
+        # lần ghi gần nhất phải thành công
+        checks["save"] = ages["save_error"] is None or (
+            ages["save"] is not None and ages["save"] < ages["save_error"])
+        if HEALTH_MAX_SAVE_AGE:
+            checks["save"] = checks["save"] and (
+                ages["save"] is not None and ages["save"] < HEALTH_MAX_SAVE_AGE)
+        if HEALTH_MAX_BACKLOG:
+            checks["backlog"] = sum(backlog.values()) < HEALTH_MAX_BACKLOG
+        return {
+            "mode": self.mode,
+            "ages": {k: None if v is None else round(v, 1)
+                     for k, v in ages.items()},
+            "backlog": backlog,
+            "checks": checks,
+        }
+
+    def live(self):
+        report = self.report()
+        return report["checks"]["running"] and report["checks"]["loop"], report
+
+    def ready(self):
+        report = self.report()
+        return all(report["checks"].values()), report
+
+
+HEALTH = Health()
+
+
 # ================== DATA LOAD / SAVE ==================
 
 
-def load_data():
-    if os.path.exists(DATA_FILE):
+def _empty_data():
+    return {"farms": [], "user_states": {}, "credentials": {}, "meta": {}}
+
+
+def _read_data_file(path):
+    if os.path.exists(path):
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
+            with open(path, "r", encoding="utf-8") as f:
                 data = json.load(f)
         except json.JSONDecodeError:
-            data = {"farms": [], "user_states": {}, "credentials": {}}
+            data = _empty_data()
     else:
-        data = {"farms": [], "user_states": {}, "credentials": {}}
+        data = _empty_data()
 
     data.setdefault("farms", [])
     data.setdefault("user_states", {})
     data.setdefault("credentials", {})
+    data.setdefault("meta", {})
 
     # bảo đảm mỗi farm có email_logins
     for farm in data["farms"]:
@@ -95,23 +791,1937 @@ def load_data():
     return data
 
 
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
+def history_matches(entry, start=None, end=None, kind=None):
+    # start/end: chuỗi YYYY-MM-DD (tính cả 2 đầu)
+    date = entry.get("date", "")
+    return ((start is None or date >= start) and
+            (end is None or date <= end) and
+            (kind is None or entry.get("type") == kind))
+
+
+class HistoryArchive:
+    # Lịch sử nhắc cũ (ngoài `keep` lần gần nhất giữ trong farm) ghi nối đuôi
+    # vào root/YYYY-MM.jsonl theo tháng của lần nhắc, không bao giờ sửa lại.
+    # Index farm_id -> offset các dòng của từng tháng được dựng dần khi đọc
+    # (chỉ quét phần mới ghi thêm), nên tra 1 farm chỉ đọc đúng các dòng của
+    # farm đó trong các tháng cần.
+
+    def __init__(self, root, keep):
+        self.root = root
+        self.keep = keep
+        self._lock = threading.Lock()
+        # tháng -> [số byte đã index, {farm_id: array offset}]
+        self._index = {}
+
+    def _path(self, month):
+        return os.path.join(self.root, f"{month}.jsonl")
+
+    def months(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(n[:-6] for n in names if n.endswith(".jsonl"))
+
+    def append(self, farm_id, entries):
+        by_month = {}
+        for entry in entries:
+            month = (entry.get("date") or "0000-00")[:7]
+            by_month.setdefault(month, []).append(
+                json.dumps({"farm_id": farm_id, **entry}, ensure_ascii=False) +
+                "\n")
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            for month, lines in by_month.items():
+                with open(self._path(month), "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+
+    def _offsets(self, month, farm_id):
+        with self._lock:
+            indexed = self._index.setdefault(month, [0, {}])
+            try:
+                f = open(self._path(month), "rb")
+            except FileNotFoundError:
+                return []
+            with f:
+                pos = indexed[0]
+                f.seek(pos)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # dòng đang ghi dở
+                    try:
+                        fid = json.loads(line)["farm_id"]
+                    except (ValueError, KeyError):
+                        fid = None
+                    if fid is not None:
+                        indexed[1].setdefault(fid, array("q")).append(pos)
+                    pos += len(line)
+                indexed[0] = pos
+            return list(indexed[1].get(farm_id, ()))
+
+    def query(self, farm_id, start=None, end=None, kind=None, limit=None):
+        # các lần nhắc đã lưu trữ của farm, mới nhất trước; đọc từ tháng mới
+        # nhất lùi dần, đủ `limit` thì dừng
+        res = []
+        for month in reversed(self.months()):
+            if end is not None and month > end[:7]:
+                continue
+            if start is not None and month < start[:7]:
+                break
+            offsets = self._offsets(month, farm_id)
+            if not offsets:
+                continue
+            rows = []
+            with open(self._path(month), "rb") as f:
+                for pos in offsets:
+                    f.seek(pos)
+                    entry = json.loads(f.readline())
+                    entry.pop("farm_id", None)
+                    if history_matches(entry, start, end, kind):
+                        rows.append(entry)
+            rows.sort(key=lambda h: h.get("date", ""), reverse=True)
+            res.extend(rows)
+            if limit is not None and len(res) >= limit:
+                break
+        return res[:limit] if limit is not None else res
+
+    def farm_history(self, farm, start=None, end=None, kind=None, limit=20):
+        # lịch sử trong farm (mới nhất) + phần đã lưu trữ, mới nhất trước
+        recent = [
+            h for h in farm.get("reminder_history", [])
+            if history_matches(h, start, end, kind)
+        ]
+        recent.sort(key=lambda h: h.get("date", ""), reverse=True)
+        if len(recent) >= limit:
+            # phần lưu trữ luôn cũ hơn phần trong farm
+            return recent[:limit]
+        res, seen = [], set()
+        for h in recent + self.query(farm["id"], start, end, kind, limit):
+            # ghi lưu trữ xong mà chưa kịp cắt (tắt ngang) thì có thể trùng
+            key = (h.get("type"), h.get("date"), h.get("renewal_date"))
+            if key not in seen:
+                seen.add(key)
+                res.append(h)
+        return res[:limit]
+
+
+class JsonStore:
+    # Giữ dữ liệu thường trú trong bộ nhớ: chỉ đọc file 1 lần lúc khởi động,
+    # và chỉ đọc lại khi mtime/size của file trên đĩa đổi (sửa tay, restore...).
+    #
+    # Mỗi thay đổi được ghi nối đuôi 1 dòng JSON vào journal (O(thay đổi)),
+    # thread nền sẽ gộp journal vào snapshot khi journal vượt ngưỡng.
+    # Khởi động = đọc snapshot + phát lại các dòng journal có seq mới hơn.
+
+    def __init__(self, path, journal_path, compact_bytes, history=None):
+        self.path = path
+        self.history = history
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self._data = None
+        self._sig = None
+        self._by_id = {}
+        self._parts = {}
+        self._seq = 0
+        self._next_id = 1
+        self._journal = None
+        self._compact_event = threading.Event()
+        self._compact_lock = threading.Lock()
+        self._compactor = None
+        self._watchers = []
+
+    def _file_sig(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    # ---------- nạp / phát lại ----------
+
+    def _load(self, replay):
+        started = time.perf_counter()
+        data = _read_data_file(self.path)
+        self._data = data
+        self._seq = data.get("journal_seq", 0)
+        self._reindex()
+        # file snapshot bị sửa/restore từ bên ngoài (replay=False) thì vẫn
+        # phát lại journal lên file mới: các lần ghi chưa compact không được
+        # mất; journal giữ nguyên, lần compact sau gộp vào snapshot.
+        for path in (self.journal_path + ".old", self.journal_path):
+            self._replay(path)
+        if not replay:
+            self._notify(None)
+        self._sig = self._file_sig()
+        METRICS.observe("bot_store_load_seconds",
+                        time.perf_counter() - started,
+                        source="snapshot")
+
+    def _reindex(self):
+        self._by_id = {}
+        self._parts = {}
+        max_id = 0
+        for farm in self._data["farms"]:
+            if isinstance(farm.get("id"), int):
+                max_id = max(max_id, farm["id"])
+        for farm in self._data["farms"]:
+            if not isinstance(farm.get("id"), int):
+                max_id += 1
+                farm["id"] = max_id
+            self._by_id[farm["id"]] = farm
+            self._index_add(farm)
+        self._next_id = max_id + 1
+
+    def _index_add(self, farm):
+        key = owner_key(farm.get("chat_id"))
+        part = self._parts.get(key)
+        if part is None:
+            part = self._parts[key] = FarmPartition()
+        part.add(farm)
+
+    def _index_remove(self, farm):
+        key = owner_key(farm.get("chat_id"))
+        part = self._parts[key]
+        part.remove(farm)
+        if not part.farms:
+            del self._parts[key]
+
+    def _scope(self, owner):
+        # các phân vùng cần đọc: của 1 chat, hoặc tất cả khi owner là None
+        if owner is None:
+            return list(self._parts.values())
+        part = self._parts.get(owner_key(owner))
+        return [part] if part is not None else []
+
+    def _replay(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # dòng cuối có thể bị cắt dở khi crash
+                    continue
+                if entry.get("seq", 0) <= self._seq:
+                    continue
+                self._apply(entry)
+                self._seq = entry["seq"]
+
+    def _apply(self, entry):
+        op = entry["op"]
+        data = self._data
+        if op in ("add_farm", "add_farms"):
+            for farm in entry.get("farms") or [entry["farm"]]:
+                old = self._by_id.get(farm["id"])
+                if old is not None:
+                    # file sửa ngoài đã có farm trùng id: lần ghi của bot thắng
+                    self._index_remove(old)
+                    data["farms"].remove(old)
+                data["farms"].append(farm)
+                self._by_id[farm["id"]] = farm
+                self._index_add(farm)
+                self._next_id = max(self._next_id, farm["id"] + 1)
+        elif op == "update_farm":
+            farm = self._by_id.get(entry["id"])
+            if farm is not None and "chat_id" in entry["fields"]:
+                # đổi chủ: chuyển farm sang phân vùng của chat mới
+                self._index_remove(farm)
+                farm.update(entry["fields"])
+                self._index_add(farm)
+            elif farm is not None:
+                part = self._parts[owner_key(farm.get("chat_id"))]
+                touched = [
+                    index for index in part.indexes
+                    if any(k in entry["fields"] for k in index.fields)
+                ]
+                for index in touched:
+                    index.remove(farm)
+                farm.update(entry["fields"])
+                for index in touched:
+                    index.add(farm)
+        elif op == "delete_farm":
+            farm = self._by_id.pop(entry["id"], None)
+            if farm is not None:
+                self._index_remove(farm)
+                data["farms"].remove(farm)
+        elif op == "add_history":
+            farm = self._by_id.get(entry["id"])
+            if farm is not None:
+                history = farm.setdefault("reminder_history", [])
+                history.append(entry["entry"])
+                if entry.get("keep"):
+                    del history[:-entry["keep"]]
+        elif op == "set_email_login":
+            farm = self._by_id.get(entry["id"])
+            if farm is not None:
+                farm.setdefault("email_logins", {})[entry["email"]] = entry["login"]
+        elif op == "set_email_logins":
+            for farm_id, email, login in entry["logins"]:
+                farm = self._by_id.get(farm_id)
+                if farm is not None:
+                    farm.setdefault("email_logins", {})[email] = login
+        elif op == "set_state":
+            data["user_states"][entry["chat_id"]] = entry["state"]
+        elif op == "clear_state":
+            data["user_states"].pop(entry["chat_id"], None)
+        elif op == "set_meta":
+            data["meta"][entry["key"]] = entry["value"]
+
+    # ---------- journal ----------
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _record(self, op, **fields):
+        with self.lock:
+            self.get()
+            entry = {"seq": self._seq + 1, "op": op, **fields}
+            self._apply(entry)
+            self._seq = entry["seq"]
+            started = time.perf_counter()
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            line = json.dumps(entry, ensure_ascii=False) + "\n"
+            try:
+                self._journal.write(line)
+                self._journal.flush()
+            except OSError:
+                HEALTH.mark("save_error")
+                raise
+            HEALTH.mark("save")
+            METRICS.observe("bot_store_write_seconds",
+                            time.perf_counter() - started,
+                            kind="journal")
+            METRICS.inc("bot_store_bytes_written_total",
+                        len(line.encode("utf-8")),
+                        kind="journal")
+            if self._journal.tell() >= self.compact_bytes:
+                self._compact_event.set()
+        if op in ("add_farm", "delete_farm"):
+            self._notify(entry.get("id") or entry["farm"]["id"])
+        elif op == "add_farms":
+            for farm in entry["farms"]:
+                self._notify(farm["id"])
+        elif op == "update_farm":
+            self._notify(entry["id"], entry["fields"])
+        elif op == "add_history":
+            self._notify(entry["id"], ("reminder_history", ))
+        elif op == "set_email_login":
+            self._notify(entry["id"], ("email_logins", ))
+        elif op == "set_email_logins":
+            for farm_id in {farm_id for farm_id, _, _ in entry["logins"]}:
+                self._notify(farm_id, ("email_logins", ))
+
+    # ---------- theo dõi thay đổi ----------
+
+    def watch(self, fields, callback):
+        # callback(farm_id) khi farm được thêm/xoá hoặc 1 trong `fields` đổi
+        # (fields=None: mọi thay đổi của farm, kể cả lịch sử nhắc, login);
+        # callback(None) khi toàn bộ dữ liệu được nạp lại.
+        self._watchers.append((fields, callback))
+
+    def _notify(self, farm_id, fields=None):
+        for watched, callback in self._watchers:
+            if (watched is None or fields is None or
+                    any(k in fields for k in watched)):
+                callback(farm_id)
+
+    def _compact_loop(self):
+        while True:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                print("Lỗi compact journal:", e)
+
+    def compact(self):
+        # Dưới lock chỉ serialize + đổi tên journal; ghi snapshot ra đĩa ở
+        # ngoài lock để không chặn các handler.
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        with self.lock:
+            self.get()
+            self._data["journal_seq"] = self._seq
+            payload = json.dumps(self._data, ensure_ascii=False, indent=2)
+            self._close_journal()
+            old = self.journal_path + ".old"
+            if os.path.exists(self.journal_path):
+                if os.path.exists(old):
+                    # lần compact trước chưa xong: nối phần còn lại vào .old
+                    with open(self.journal_path, "r", encoding="utf-8") as src, \
+                            open(old, "a", encoding="utf-8") as dst:
+                        dst.write(src.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, old)
+        self._write_snapshot(payload)
+        if os.path.exists(old):
+            os.remove(old)
+
+    def _write_snapshot(self, payload):
+        started = time.perf_counter()
+        tmp = self.path + ".tmp"
+        raw = payload.encode("utf-8")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(raw)
+            with self.lock:
+                os.replace(tmp, self.path)
+                self._sig = self._file_sig()
+        except OSError:
+            HEALTH.mark("save_error")
+            raise
+        HEALTH.mark("save")
+        METRICS.observe("bot_store_write_seconds",
+                        time.perf_counter() - started,
+                        kind="snapshot")
+        METRICS.inc("bot_store_bytes_written_total", len(raw), kind="snapshot")
+
+    # ---------- API cho handler ----------
+
+    def get(self):
+        with self.lock:
+            sig = self._file_sig()
+            if self._data is None:
+                self._load(replay=True)
+            elif sig != self._sig:
+                self._load(replay=False)
+            return self._data
+
+    def save(self, data):
+        # Ghi đè toàn bộ (import/restore): snapshot mới, journal làm lại từ đầu.
+        with self.lock:
+            self.get()
+            self._data = data
+            self._data.setdefault("farms", [])
+            self._data.setdefault("user_states", {})
+            self._data.setdefault("credentials", {})
+            self._data.setdefault("meta", {})
+            self._reindex()
+        self.compact()
+        self._notify(None)
+
+    def start(self):
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=self._compact_loop,
+                                               daemon=True)
+            self._compactor.start()
+
+    def export_data(self):
+        return self.get()
+
+    def export_state(self):
+        # phần không phải farm (bản sao sâu)
+        with self.lock:
+            data = self.get()
+            return json.loads(
+                json.dumps({
+                    "user_states": data["user_states"],
+                    "credentials": data["credentials"],
+                    "meta": data["meta"],
+                }))
+
+    def _farm_list(self, owner):
+        # danh sách farm theo thứ tự thêm: toàn bộ, hoặc của phân vùng owner
+        data = self.get()
+        if owner is None:
+            return data["farms"]
+        part = self._parts.get(owner_key(owner))
+        return part.farms if part is not None else []
+
+    def farms(self, owner=None):
+        with self.lock:
+            return list(self._farm_list(owner))
+
+    def iter_farms(self, batch=500, owner=None):
+        # duyệt farm theo từng lô, mỗi lô chép dưới lock: handler vẫn ghi được
+        # xen giữa, và không phải dựng 1 bản sao toàn bộ dữ liệu
+        with self.lock:
+            ids = [farm["id"] for farm in self._farm_list(owner)]
+        for i in range(0, len(ids), batch):
+            with self.lock:
+                chunk = []
+                for farm_id in ids[i:i + batch]:
+                    farm = self._by_id.get(farm_id)
+                    if farm is None:
+                        continue
+                    chunk.append({
+                        **farm,
+                        "members": list(farm.get("members", [])),
+                        "email_logins": dict(farm.get("email_logins", {})),
+                        "reminder_history": list(
+                            farm.get("reminder_history", [])),
+                    })
+            yield from chunk
+
+    def has_farms(self, owner=None):
+        with self.lock:
+            return bool(self._farm_list(owner))
+
+    def page_farms(self, offset, limit, owner=None):
+        # (tổng số farm, farm thứ offset..offset+limit theo thứ tự thêm)
+        with self.lock:
+            farms = self._farm_list(owner)
+            return len(farms), farms[offset:offset + limit]
+
+    def summary(self, owner=None):
+        with self.lock:
+            self.get()
+            parts = self._scope(owner)
+            return (sum(p.totals.count for p in parts),
+                    sum(p.totals.price for p in parts),
+                    sum(p.totals.active for p in parts))
+
+    def farm_by_id(self, farm_id, owner=None):
+        with self.lock:
+            self.get()
+            farm = self._by_id.get(farm_id)
+            if (farm is not None and owner is not None and
+                    owner_key(farm.get("chat_id")) != owner_key(owner)):
+                return None
+            return farm
+
+    def find_farm(self, name, owner=None):
+        # trùng tên ở nhiều phân vùng (chỉ khi owner None): lấy farm id nhỏ nhất
+        with self.lock:
+            self.get()
+            ids = [i for p in self._scope(owner) for i in p.names.lookup(name)]
+            return self._by_id[min(ids)] if ids else None
+
+    def duplicate_names(self, owner=None):
+        # tên trùng được xét trong từng phân vùng: 2 chat đặt cùng tên là bình thường
+        with self.lock:
+            self.get()
+            firsts = sorted(min(ids) for p in self._scope(owner)
+                            for ids in p.names.duplicates())
+            return [self._by_id[i]["name"] for i in firsts]
+
+    def search_farms(self, keyword, owner=None):
+        with self.lock:
+            self.get()
+            parts = self._scope(owner)
+            if len(parts) == 1:
+                ids = parts[0].trigrams.search(keyword)
+            else:
+                ids = [i for _, i in sorted(
+                    r for p in parts for r in p.trigrams.ranked(keyword))]
+            return [self._by_id[i] for i in ids]
+
+    def farms_due(self, start, days, owner=None):
+        with self.lock:
+            self.get()
+            res = [(self._by_id[farm_id], d)
+                   for p in self._scope(owner)
+                   for farm_id, d in p.renewals.due(start, days)]
+        res.sort(key=lambda x: (x[1], x[0]["id"]))
+        return res
+
+    def get_meta(self, key, default=None):
+        return self.get()["meta"].get(key, default)
+
+    def set_meta(self, key, value):
+        self._record("set_meta", key=key, value=value)
+
+    def add_farm(self, farm):
+        with self.lock:
+            self.get()
+            farm["id"] = self._next_id
+            self._record("add_farm", farm=farm)
+            return farm
+
+    def add_farms(self, farms):
+        # nhập hàng loạt: 1 dòng journal cho cả lô, cả lô hoặc không
+        with self.lock:
+            self.get()
+            for i, farm in enumerate(farms):
+                farm["id"] = self._next_id + i
+            self._record("add_farms", farms=farms)
+            return farms
+
+    def update_farm(self, farm, **fields):
+        self._record("update_farm", id=farm["id"], fields=fields)
+
+    def delete_farm(self, farm):
+        self._record("delete_farm", id=farm["id"])
+
+    def add_history(self, farm, entry):
+        # giữ `keep` lần gần nhất, phần bị đẩy ra ghi vào lưu trữ trước
+        keep = self.history.keep if self.history is not None else 0
+        with self.lock:
+            self.get()
+            current = self._by_id.get(farm["id"], farm).get(
+                "reminder_history", [])
+            overflow = len(current) + 1 - keep
+            if keep and overflow > 0:
+                self.history.append(farm["id"], (current + [entry])[:overflow])
+            self._record("add_history", id=farm["id"], entry=entry, keep=keep)
+
+    def set_email_login(self, farm, email, login):
+        self._record("set_email_login", id=farm["id"], email=email, login=login)
+
+    def set_email_logins(self, logins):
+        # [(farm_id, email, login)] ghi trong 1 dòng journal: cả batch hoặc không
+        self._record("set_email_logins",
+                     logins=[[farm_id, email, login]
+                             for farm_id, email, login in logins])
+
+    def clear_state(self, chat_id):
+        with self.lock:
+            if str(chat_id) in self.get()["user_states"]:
+                self._record("clear_state", chat_id=str(chat_id))
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS farms (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    name_lower TEXT NOT NULL,
+    owner_email TEXT NOT NULL DEFAULT '',
+    owner_email_lower TEXT NOT NULL DEFAULT '',
+    start_date TEXT NOT NULL DEFAULT '',
+    renewal_day INTEGER NOT NULL DEFAULT 1,
+    price INTEGER NOT NULL DEFAULT 0,
+    chat_id INTEGER,
+    reminder_enabled INTEGER NOT NULL DEFAULT 1,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_farms_name ON farms(name_lower);
+CREATE INDEX IF NOT EXISTS idx_farms_owner ON farms(owner_email_lower);
+CREATE INDEX IF NOT EXISTS idx_farms_renewal ON farms(renewal_day);
+CREATE INDEX IF NOT EXISTS idx_farms_chat ON farms(chat_id);
+CREATE INDEX IF NOT EXISTS idx_farms_chat_name ON farms(chat_id, name_lower);
+CREATE INDEX IF NOT EXISTS idx_farms_chat_renewal ON farms(chat_id, renewal_day);
+
+CREATE TABLE IF NOT EXISTS members (
+    farm_id INTEGER NOT NULL REFERENCES farms(id) ON DELETE CASCADE,
+    pos INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    email_lower TEXT NOT NULL,
+    PRIMARY KEY (farm_id, pos)
+);
+CREATE INDEX IF NOT EXISTS idx_members_email ON members(email_lower);
+
+CREATE TABLE IF NOT EXISTS email_logins (
+    farm_id INTEGER NOT NULL REFERENCES farms(id) ON DELETE CASCADE,
+    email TEXT NOT NULL,
+    enc TEXT NOT NULL DEFAULT '',
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (farm_id, email)
+);
+
+CREATE TABLE IF NOT EXISTS reminder_history (
+    id INTEGER PRIMARY KEY,
+    farm_id INTEGER NOT NULL REFERENCES farms(id) ON DELETE CASCADE,
+    type TEXT NOT NULL,
+    date TEXT NOT NULL,
+    renewal_date TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_history_farm ON reminder_history(farm_id, date);
+
+CREATE TABLE IF NOT EXISTS user_states (
+    chat_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# các field của farm có cột riêng; field khác nằm trong cột extra (JSON)
+FARM_COLUMNS = ("name", "owner_email", "start_date", "renewal_day", "price",
+                "chat_id", "reminder_enabled")
+
+
+class SqliteStore:
+    # Backend SQLite: tìm theo tên/email, báo cáo và nhắc hạn chạy bằng truy vấn
+    # có index thay vì duyệt toàn bộ danh sách farm trong Python.
+
+    def __init__(self, path, history=None):
+        self.path = path
+        self.history = history
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SQLITE_SCHEMA)
+        # index 3-gram dựng khi cần: khoá None = mọi chat, còn lại owner_key
+        self.trigrams = {}
+        self._watchers = []
+        self._rekey_names()
+
+    def start(self):
+        pass
+
+    @contextlib.contextmanager
+    def _tx(self):
+        # 1 transaction ghi, đo thời gian tới lúc commit xong
+        with self.lock:
+            started = time.perf_counter()
+            try:
+                with self.conn:
+                    yield
+            except sqlite3.Error:
+                HEALTH.mark("save_error")
+                raise
+            HEALTH.mark("save")
+            METRICS.observe("bot_store_write_seconds",
+                            time.perf_counter() - started,
+                            kind="sqlite")
+
+    def watch(self, fields, callback):
+        self._watchers.append((fields, callback))
+
+    def _notify(self, farm_id, fields=None):
+        for watched, callback in self._watchers:
+            if (watched is None or fields is None or
+                    any(k in fields for k in watched)):
+                callback(farm_id)
+
+    def _rekey_names(self):
+        # name_lower giữ tên đã chuẩn hoá (normalize_name); khi đổi cách chuẩn
+        # hoá (VD: bật/tắt NAME_FOLD_DIACRITICS) thì tính lại toàn bộ khoá.
+        version = "v1:fold" if NAME_FOLD_DIACRITICS else "v1:nofold"
+        with self._tx():
+            r = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'name_key'").fetchone()
+            if r and r[0] == version:
+                return
+            rows = self.conn.execute("SELECT id, name FROM farms").fetchall()
+            self.conn.executemany(
+                "UPDATE farms SET name_lower = ? WHERE id = ?",
+                [(normalize_name(r["name"]), r["id"]) for r in rows])
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('name_key', ?)",
+                (version, ))
+
+    # ---------- đọc ----------
+
+    @staticmethod
+    def _owned(owner, cond="", params=()):
+        # (WHERE ..., tham số) có thêm chat_id = owner; owner None = mọi chat.
+        # Các index trên farms đều bắt đầu bằng chat_id nên truy vấn của 1
+        # chat chỉ quét phần index của chat đó.
+        conds = [c for c in (cond, owner is not None and "chat_id = ?") if c]
+        args = tuple(params) + ((owner, ) if owner is not None else ())
+        return ("WHERE " + " AND ".join(conds) if conds else ""), args
+
+    def _load_farms(self, where="", params=(), limit=None, offset=0):
+        with self.lock:
+            sql = f"SELECT * FROM farms {where} ORDER BY id"
+            if limit:
+                sql += f" LIMIT {int(limit)} OFFSET {int(offset)}"
+            rows = self.conn.execute(sql, params).fetchall()
+            if not rows:
+                return []
+            farms = {}
+            for r in rows:
+                farm = json.loads(r["extra"])
+                farm.update({
+                    "id": r["id"],
+                    "name": r["name"],
+                    "owner_email": r["owner_email"],
+                    "members": [],
+                    "start_date": r["start_date"],
+                    "renewal_day": r["renewal_day"],
+                    "price": r["price"],
+                    "chat_id": r["chat_id"],
+                    "reminder_enabled": bool(r["reminder_enabled"]),
+                    "reminder_history": [],
+                    "email_logins": {},
+                })
+                farms[r["id"]] = farm
+            ids = list(farms)
+            marks = ",".join("?" * len(ids))
+            for r in self.conn.execute(
+                    f"SELECT farm_id, email FROM members WHERE farm_id IN ({marks}) "
+                    "ORDER BY farm_id, pos", ids):
+                farms[r["farm_id"]]["members"].append(r["email"])
+            for r in self.conn.execute(
+                    f"SELECT * FROM email_logins WHERE farm_id IN ({marks})", ids):
+                login = json.loads(r["extra"])
+                login["enc"] = r["enc"]
+                farms[r["farm_id"]]["email_logins"][r["email"]] = login
+            for r in self.conn.execute(
+                    f"SELECT * FROM reminder_history WHERE farm_id IN ({marks}) "
+                    "ORDER BY id", ids):
+                farms[r["farm_id"]]["reminder_history"].append({
+                    "type": r["type"],
+                    "date": r["date"],
+                    "renewal_date": r["renewal_date"],
+                })
+            return list(farms.values())
+
+    def export_data(self):
+        with self.lock:
+            return {"farms": self._load_farms(), **self.export_state()}
+
+    def export_state(self):
+        with self.lock:
+            states = {
+                r["chat_id"]: json.loads(r["state"])
+                for r in self.conn.execute("SELECT * FROM user_states")
+            }
+            meta = {
+                r["key"]: json.loads(r["value"])
+                for r in self.conn.execute(
+                    "SELECT * FROM meta WHERE key != 'name_key'")
+            }
+            return {
+                "user_states": states,
+                "credentials": meta.pop("credentials", {}),
+                "meta": meta,
+            }
+
+    def farms(self, owner=None):
+        return self._load_farms(*self._owned(owner))
+
+    def iter_farms(self, batch=500, owner=None):
+        # đọc từng trang theo id, bộ nhớ chỉ giữ 1 trang
+        last = 0
+        while True:
+            page = self._load_farms(*self._owned(owner, "id > ?", (last, )),
+                                    limit=batch)
+            if not page:
+                return
+            yield from page
+            last = page[-1]["id"]
+
+    def has_farms(self, owner=None):
+        where, args = self._owned(owner)
+        with self.lock:
+            return self.conn.execute(f"SELECT 1 FROM farms {where} LIMIT 1",
+                                     args).fetchone() is not None
+
+    def page_farms(self, offset, limit, owner=None):
+        where, args = self._owned(owner)
+        with self.lock:
+            total = self.conn.execute(f"SELECT COUNT(*) FROM farms {where}",
+                                      args).fetchone()[0]
+            return total, self._load_farms(where, args, limit=limit,
+                                           offset=offset)
+
+    def summary(self, owner=None):
+        where, args = self._owned(owner)
+        with self.lock:
+            r = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(price), 0), "
+                f"COALESCE(SUM(reminder_enabled), 0) FROM farms {where}",
+                args).fetchone()
+            return r[0], r[1], r[2]
+
+    def farm_by_id(self, farm_id, owner=None):
+        res = self._load_farms(*self._owned(owner, "id = ?", (farm_id, )))
+        return res[0] if res else None
+
+    def find_farm(self, name, owner=None):
+        res = self._load_farms(*self._owned(owner, "name_lower = ?",
+                                            (normalize_name(name), )),
+                               limit=1)
+        return res[0] if res else None
+
+    def duplicate_names(self, owner=None):
+        # tên trùng được xét trong từng chat: 2 chat đặt cùng tên là bình thường
+        where, args = self._owned(owner)
+        with self.lock:
+            return [
+                r[0] for r in self.conn.execute(
+                    "SELECT name FROM farms WHERE id IN (SELECT MIN(id) "
+                    f"FROM farms {where} GROUP BY chat_id, name_lower "
+                    "HAVING COUNT(*) > 1) ORDER BY id", args)
+            ]
+
+    def _trigram_index(self, owner=None):
+        # dựng 1 lần từ DB ở lần tìm đầu tiên của mỗi chat (owner None: mọi
+        # chat), sau đó cập nhật theo từng thay đổi
+        key = None if owner is None else owner_key(owner)
+        with self.lock:
+            index = self.trigrams.get(key)
+            if index is None:
+                index = TrigramIndex()
+                where, args = self._owned(owner)
+                members = {}
+                for r in self.conn.execute(
+                        "SELECT farm_id, email FROM members WHERE farm_id IN "
+                        f"(SELECT id FROM farms {where}) ORDER BY farm_id, pos",
+                        args):
+                    members.setdefault(r["farm_id"], []).append(r["email"])
+                for r in self.conn.execute(
+                        f"SELECT id, name, owner_email FROM farms {where}",
+                        args):
+                    index.add({
+                        "id": r["id"],
+                        "name": r["name"],
+                        "owner_email": r["owner_email"],
+                        "members": members.get(r["id"], []),
+                    })
+                self.trigrams[key] = index
+            return index
+
+    def _built_trigrams(self, farm):
+        # các index 3-gram đã dựng có chứa farm này (chung và của chat chủ)
+        keys = (None, owner_key(farm.get("chat_id")))
+        return [self.trigrams[k] for k in keys if k in self.trigrams]
+
+    def search_farms(self, keyword, owner=None):
+        with self.lock:
+            ids = self._trigram_index(owner).search(keyword)
+        if not ids:
+            return []
+        by_id = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for f in self._load_farms(f"WHERE id IN ({marks})", chunk):
+                by_id[f["id"]] = f
+        return [by_id[i] for i in ids if i in by_id]
+
+    def farms_due(self, start, days, owner=None):
+        day_map = renewal_day_map(start, days)
+        marks = ",".join("?" * len(day_map))
+        farms = self._load_farms(*self._owned(
+            owner, f"renewal_day IN ({marks})", list(day_map)))
+        res = [(f, day_map[f["renewal_day"]]) for f in farms]
+        res.sort(key=lambda x: (x[1], x[0]["id"]))
+        return res
+
+    # ---------- ghi ----------
+
+    def _insert_farm(self, farm):
+        extra = {
+            k: v
+            for k, v in farm.items() if k not in FARM_COLUMNS and k not in (
+                "id", "members", "email_logins", "reminder_history")
+        }
+        cur = self.conn.execute(
+            "INSERT INTO farms (id, name, name_lower, owner_email, "
+            "owner_email_lower, start_date, renewal_day, price, chat_id, "
+            "reminder_enabled, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                farm.get("id"),
+                farm.get("name", ""),
+                normalize_name(farm.get("name", "")),
+                farm.get("owner_email", ""),
+                farm.get("owner_email", "").lower(),
+                farm.get("start_date", ""),
+                farm.get("renewal_day", 1),
+                farm.get("price", 0),
+                farm.get("chat_id"),
+                int(bool(farm.get("reminder_enabled", True))),
+                json.dumps(extra, ensure_ascii=False),
+            ))
+        farm["id"] = cur.lastrowid
+        self._write_members(farm["id"], farm.get("members", []))
+        for email, login in farm.get("email_logins", {}).items():
+            self._write_login(farm["id"], email, login)
+        for h in farm.get("reminder_history", []):
+            self._write_history(farm["id"], h)
+        return farm
+
+    def _write_members(self, farm_id, members):
+        self.conn.execute("DELETE FROM members WHERE farm_id = ?", (farm_id, ))
+        self.conn.executemany(
+            "INSERT INTO members (farm_id, pos, email, email_lower) "
+            "VALUES (?, ?, ?, ?)",
+            [(farm_id, i, m, m.lower()) for i, m in enumerate(members)])
+
+    def _write_login(self, farm_id, email, login):
+        extra = {k: v for k, v in login.items() if k != "enc"}
+        self.conn.execute(
+            "INSERT OR REPLACE INTO email_logins (farm_id, email, enc, extra) "
+            "VALUES (?, ?, ?, ?)", (farm_id, email, login.get("enc", ""),
+                                    json.dumps(extra, ensure_ascii=False)))
+
+    def _write_history(self, farm_id, entry):
+        self.conn.execute(
+            "INSERT INTO reminder_history (farm_id, type, date, renewal_date) "
+            "VALUES (?, ?, ?, ?)", (farm_id, entry.get("type", ""),
+                                    entry.get("date", ""),
+                                    entry.get("renewal_date", "")))
+
+    def save(self, data):
+        # Ghi đè toàn bộ (import/restore/migrate) trong 1 transaction.
+        with self._tx():
+            for table in ("reminder_history", "email_logins", "members",
+                          "farms", "user_states"):
+                self.conn.execute(f"DELETE FROM {table}")
+            self.conn.execute("DELETE FROM meta WHERE key != 'name_key'")
+            for farm in data.get("farms", []):
+                farm = dict(farm)
+                if not isinstance(farm.get("id"), int):
+                    farm.pop("id", None)
+                self._insert_farm(farm)
+            for chat_id, state in data.get("user_states", {}).items():
+                self.conn.execute(
+                    "INSERT INTO user_states (chat_id, state) VALUES (?, ?)",
+                    (str(chat_id), json.dumps(state, ensure_ascii=False)))
+            meta = dict(data.get("meta", {}))
+            meta["credentials"] = data.get("credentials", {})
+            self.conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in meta.items()])
+            self.trigrams = {}
+        self._notify(None)
+
+    def add_farm(self, farm):
+        with self._tx():
+            farm.pop("id", None)
+            self._insert_farm(farm)
+            for index in self._built_trigrams(farm):
+                index.add(farm)
+        self._notify(farm["id"])
+        return farm
+
+    def add_farms(self, farms):
+        with self._tx():
+            for farm in farms:
+                farm.pop("id", None)
+                self._insert_farm(farm)
+                for index in self._built_trigrams(farm):
+                    index.add(farm)
+        for farm in farms:
+            self._notify(farm["id"])
+        return farms
+
+    def update_farm(self, farm, **fields):
+        with self._tx():
+            cols = {k: v for k, v in fields.items() if k in FARM_COLUMNS}
+            extra = {
+                k: v
+                for k, v in fields.items()
+                if k not in FARM_COLUMNS and k != "members"
+            }
+            if "name" in cols:
+                cols["name_lower"] = normalize_name(cols["name"])
+            if "owner_email" in cols:
+                cols["owner_email_lower"] = cols["owner_email"].lower()
+            if "reminder_enabled" in cols:
+                cols["reminder_enabled"] = int(bool(cols["reminder_enabled"]))
+            if cols:
+                sets = ", ".join(f"{k} = ?" for k in cols)
+                self.conn.execute(f"UPDATE farms SET {sets} WHERE id = ?",
+                                  (*cols.values(), farm["id"]))
+            if extra:
+                r = self.conn.execute("SELECT extra FROM farms WHERE id = ?",
+                                      (farm["id"], )).fetchone()
+                merged = json.loads(r["extra"]) if r else {}
+                merged.update(extra)
+                self.conn.execute(
+                    "UPDATE farms SET extra = ? WHERE id = ?",
+                    (json.dumps(merged, ensure_ascii=False), farm["id"]))
+            if "members" in fields:
+                self._write_members(farm["id"], fields["members"])
+            touched = any(k in fields
+                          for k in TrigramIndex.fields + ("chat_id", ))
+            if touched:
+                for index in self._built_trigrams(farm):
+                    index.remove(farm)
+            farm.update(fields)
+            if touched:
+                for index in self._built_trigrams(farm):
+                    index.add(farm)
+        self._notify(farm["id"], fields)
+
+    def delete_farm(self, farm):
+        with self._tx():
+            self.conn.execute("DELETE FROM farms WHERE id = ?", (farm["id"], ))
+            for index in self._built_trigrams(farm):
+                index.remove(farm)
+        self._notify(farm["id"])
+
+    def add_history(self, farm, entry):
+        keep = self.history.keep if self.history is not None else 0
+        with self._tx():
+            self._write_history(farm["id"], entry)
+            if keep:
+                old = self.conn.execute(
+                    "SELECT * FROM reminder_history WHERE farm_id = ? "
+                    "ORDER BY id DESC LIMIT -1 OFFSET ?",
+                    (farm["id"], keep)).fetchall()
+                if old:
+                    self.history.append(farm["id"], [{
+                        "type": r["type"],
+                        "date": r["date"],
+                        "renewal_date": r["renewal_date"],
+                    } for r in reversed(old)])
+                    self.conn.execute(
+                        "DELETE FROM reminder_history WHERE farm_id = ? "
+                        "AND id <= ?", (farm["id"], old[0]["id"]))
+        history = farm.setdefault("reminder_history", [])
+        history.append(entry)
+        if keep:
+            del history[:-keep]
+        self._notify(farm["id"], ("reminder_history", ))
+
+    def set_email_login(self, farm, email, login):
+        with self._tx():
+            self._write_login(farm["id"], email, login)
+        farm.setdefault("email_logins", {})[email] = login
+        self._notify(farm["id"], ("email_logins", ))
+
+    def set_email_logins(self, logins):
+        with self._tx():
+            for farm_id, email, login in logins:
+                self._write_login(farm_id, email, login)
+        for farm_id in {farm_id for farm_id, _, _ in logins}:
+            self._notify(farm_id, ("email_logins", ))
+
+    def clear_state(self, chat_id):
+        with self._tx():
+            self.conn.execute("DELETE FROM user_states WHERE chat_id = ?",
+                              (str(chat_id), ))
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            r = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                  (key, )).fetchone()
+            return json.loads(r["value"]) if r else default
+
+    def set_meta(self, key, value):
+        with self._tx():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)))
+
+
+HISTORY = HistoryArchive(HISTORY_DIR, HISTORY_KEEP)
+
+
+def open_store():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(SQLITE_FILE, history=HISTORY)
+    return JsonStore(DATA_FILE, JOURNAL_FILE, JOURNAL_COMPACT_BYTES,
+                     history=HISTORY)
+
+
+STORE = None if SPAWN_CHILD else open_store()
+# admin đang bật /xem_tat_ca: chỉ giữ trong RAM (không ghi journal, không vào
+# bản sao lưu, restore không đè); khởi động lại thì về farm của chat mình
+ALL_TENANT_CHATS = set()
+
+
+def scope_of(chat_id):
+    # phân vùng farm chat được xem: của chính chat đó; admin bật /xem_tat_ca
+    # thì None (mọi chat)
+    key = str(chat_id)
+    if key in ADMIN_CHAT_IDS and key in ALL_TENANT_CHATS:
+        return None
+    return chat_id
+
+
+def farms_of(chat_id):
+    # store chỉ đọc trong phân vùng của chat: danh sách, tìm, báo cáo, tra id
+    return TenantView(STORE, scope_of(chat_id))
+
+
+def migrate_json_to_sqlite(json_path=DATA_FILE, db_path=SQLITE_FILE):
+    src = JsonStore(json_path, json_path + ".journal", JOURNAL_COMPACT_BYTES)
+    data = src.export_data()
+    dst = SqliteStore(db_path)
+    dst.save(data)
+    print(f"✅ Đã chuyển {len(data['farms'])} farm từ {json_path} sang {db_path}")
+
+
+def export_sqlite_to_json(json_path, db_path=SQLITE_FILE):
+    data = SqliteStore(db_path).export_data()
+    with open(json_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"✅ Đã xuất {len(data['farms'])} farm ra {json_path}")
+
+
+# ================== SESSIONS ==================
+
+
+class SessionStore:
+    # Trạng thái hội thoại của từng chat, giữ trong RAM thay vì trong dữ liệu
+    # farm: gõ qua 1 flow không ghi gì vào farms_data.json / farms_data.db.
+    # Mỗi phiên có hạn riêng (tính từ lần set cuối); phiên hết hạn bị xoá khi
+    # đọc tới, hoặc khi quét lười lúc set (tối đa 1 lần mỗi ttl/10). Vượt
+    # maxsize thì bỏ phiên lâu không dùng nhất. Có path thì thread nền ghi
+    # các phiên ra file riêng (mã hoá: có thể chứa mật khẩu đang nhập dở) để
+    # khởi động lại vẫn làm tiếp được.
+    # get/set đều chép state: handler sửa bản của mình rồi set lại, bản trong
+    # _items chỉ đổi dưới _lock nên flush ghi ra lúc nào cũng nhất quán.
+
+    def __init__(self, ttl, maxsize, path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = path
+        self._lock = threading.Lock()
+        # chat_id -> (hết hạn, state), phiên dùng gần nhất ở cuối
+        self._items = OrderedDict()
+        self._next_sweep = 0
+        self._dirty = False
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, chat_id):
+        key = str(chat_id)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self._items[key]
+                self.expired += 1
+                self._dirty = True
+                return None
+            self._items.move_to_end(key)
+            return copy.deepcopy(item[1])
+
+    def set(self, chat_id, state, ttl=None):
+        now = time.time()
+        key = str(chat_id)
+        state = copy.deepcopy(state)
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (now + (ttl or self.ttl), state)
+            self._dirty = True
+            if now >= self._next_sweep:
+                for old in [
+                        k for k, (exp, _) in self._items.items() if exp <= now
+                ]:
+                    del self._items[old]
+                    self.expired += 1
+                self._next_sweep = now + self.ttl / 10
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self, chat_id):
+        with self._lock:
+            if self._items.pop(str(chat_id), None) is not None:
+                self._dirty = True
+
+    def adopt(self, store):
+        # chuyển user_states kiểu cũ (nằm trong dữ liệu farm) sang đây 1 lần;
+        # không biết tuổi nên cho hạn mới, phiên bỏ dở sẽ tự hết hạn
+        for chat_id, state in store.export_state()["user_states"].items():
+            if self.get(chat_id) is None:
+                self.set(chat_id, state)
+            store.clear_state(chat_id)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.loads(decrypt_text(f.read()))
+        except (OSError, ValueError, InvalidToken) as e:
+            print("Bỏ qua file phiên không đọc được:", e)
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires, state in items:
+                if expires > now:
+                    self._items[key] = (expires, state)
+
+    def flush(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            raw = json.dumps([[k, exp, state]
+                              for k, (exp, state) in self._items.items()],
+                             ensure_ascii=False)
+            self._dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(encrypt_text(raw))
+        os.replace(tmp, self.path)
+
+    def start(self, interval=5):
+        if self.path:
+            threading.Thread(target=self._run, args=(interval, ),
+                             daemon=True).start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                # VD: đĩa đầy; lần sau ghi lại
+                with self._lock:
+                    self._dirty = True
+                print("Lỗi ghi file phiên:", e)
+
+
+SESSIONS = None if SPAWN_CHILD else SessionStore(SESSION_TTL, SESSION_MAX,
+                                                 SESSION_FILE or None)
+
+
+# ================== INCREMENTAL BACKUP ==================
+
+
+class BackupError(Exception):
+    pass
+
+
+def _canonical_json(obj):
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class BackupManager:
+    # Sao lưu tăng dần, định danh theo nội dung (trong BACKUP_DIR):
+    # - objects/xx/<sha256>.gz: 1 farm (hoặc phần state) dạng JSON chuẩn hoá,
+    #   nội dung giống nhau chỉ lưu 1 lần;
+    # - manifests/<thời gian>-full.json: map farm_id -> hash của mọi farm;
+    #   manifests/<thời gian>-delta.json: chỉ các farm đổi/xoá so với bản
+    #   trước. Farm đổi được theo dõi qua STORE.watch, nên 1 bản delta chỉ
+    #   đọc/ghi đúng các farm đã đổi;
+    # - mỗi manifest có checksum; khôi phục = bản full + chuỗi delta, kiểm tra
+    #   checksum và hash từng object rồi mới thay dữ liệu.
+
+    def __init__(self, store, root, full_every=24, keep_full=7):
+        self.store = store
+        self.root = root
+        self.full_every = full_every
+        self.keep_full = keep_full
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._dirty = set()
+        # sau khởi động chưa biết farm nào đổi: lần đầu so toàn bộ
+        self._all_dirty = True
+        self._hashes = None
+        # vừa khôi phục: bản sau phải là full, không nối delta vào chuỗi cũ
+        self._force_full = False
+        self._thread = None
+        store.watch(None, self._on_change)
+
+    def _on_change(self, farm_id):
+        with self._lock:
+            if farm_id is None:
+                self._all_dirty = True
+            else:
+                self._dirty.add(farm_id)
+
+    # ---------- file ----------
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest + ".gz")
+
+    def _put_object(self, raw):
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(gzip.compress(raw, mtime=0))
+            os.replace(tmp, path)
+        return digest
+
+    def _get_object(self, digest):
+        try:
+            with open(self._object_path(digest), "rb") as f:
+                raw = gzip.decompress(f.read())
+        except (OSError, EOFError) as e:
+            raise BackupError(f"thiếu/hỏng object {digest[:12]}: {e}")
+        if hashlib.sha256(raw).hexdigest() != digest:
+            raise BackupError(f"object {digest[:12]} sai checksum")
+        return json.loads(raw)
+
+    def list_manifests(self):
+        try:
+            names = os.listdir(os.path.join(self.root, "manifests"))
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.endswith(".json"))
+
+    def read_manifest(self, name):
+        path = os.path.join(self.root, "manifests", name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise BackupError(f"không đọc được manifest {name}: {e}")
+        checksum = manifest.pop("checksum", None)
+        if hashlib.sha256(_canonical_json(manifest)).hexdigest() != checksum:
+            raise BackupError(f"manifest {name} sai checksum")
+        return manifest
+
+    def _write_manifest(self, manifest):
+        manifest["checksum"] = hashlib.sha256(
+            _canonical_json(manifest)).hexdigest()
+        folder = os.path.join(self.root, "manifests")
+        os.makedirs(folder, exist_ok=True)
+        tmp = os.path.join(folder, manifest["name"] + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, os.path.join(folder, manifest["name"]))
+
+    def resolve(self, name):
+        # (map farm_id -> hash, manifest cuối) sau khi áp chuỗi full + delta
+        chain = []
+        while name:
+            manifest = self.read_manifest(name)
+            chain.append(manifest)
+            name = manifest.get("parent")
+        if not chain or chain[-1]["kind"] != "full":
+            raise BackupError("chuỗi sao lưu không bắt đầu bằng bản full")
+        farms = {}
+        for manifest in reversed(chain):
+            if manifest["kind"] == "full":
+                farms = {}
+            farms.update(
+                (int(k), v) for k, v in manifest.get("farms", {}).items())
+            for farm_id in manifest.get("deleted", []):
+                farms.pop(farm_id, None)
+        if len(farms) != chain[0]["farm_count"]:
+            raise BackupError("số farm không khớp manifest")
+        return farms, chain[0], len(chain) - 1
+
+    # ---------- sao lưu ----------
+
+    def _farm_digest(self, farm):
+        with self.store.lock:
+            raw = _canonical_json(farm)
+        return self._put_object(raw)
+
+    def backup(self, full=False):
+        # trả về manifest mới, hoặc None nếu không có gì thay đổi
+        with self._run_lock:
+            started = time.perf_counter()
+            names = self.list_manifests()
+            parent = names[-1] if names else None
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                all_dirty, self._all_dirty = self._all_dirty, False
+            depth = 0
+            if self._force_full:
+                parent = None
+            elif parent is not None and self._hashes is None:
+                try:
+                    self._hashes, _, depth = self.resolve(parent)
+                except BackupError as e:
+                    print("Bản sao lưu trước bị hỏng, làm bản full mới:", e)
+                    parent = None
+            elif parent is not None:
+                depth = self.read_manifest(parent).get("depth", 0)
+            full = full or parent is None or depth + 1 >= self.full_every
+            previous = self._hashes or {}
+
+            if full or all_dirty:
+                current = {
+                    farm["id"]: self._farm_digest(farm)
+                    for farm in self.store.iter_farms()
+                }
+            else:
+                current = dict(previous)
+                for farm_id in dirty:
+                    farm = self.store.farm_by_id(farm_id)
+                    if farm is None:
+                        current.pop(farm_id, None)
+                    else:
+                        current[farm_id] = self._farm_digest(farm)
+            state = self._put_object(_canonical_json(self.store.export_state()))
+
+            changed = {k: v for k, v in current.items() if previous.get(k) != v}
+            deleted = sorted(k for k in previous if k not in current)
+            if not full and not changed and not deleted and (
+                    self.read_manifest(parent)["state"] == state):
+                return None
+
+            now = datetime.now()
+            kind = "full" if full else "delta"
+            manifest = {
+                "version": 1,
+                "name": f"{now.strftime('%Y%m%d-%H%M%S-%f')}-{kind}.json",
+                "kind": kind,
+                "created": now.isoformat(),
+                "parent": None if full else parent,
+                "depth": 0 if full else depth + 1,
+                "farm_count": len(current),
+                "state": state,
+            }
+            if full:
+                manifest["farms"] = {str(k): v for k, v in current.items()}
+            else:
+                manifest["farms"] = {str(k): v for k, v in changed.items()}
+                manifest["deleted"] = deleted
+            self._write_manifest(manifest)
+            self._hashes = current
+            self._force_full = False
+            if full:
+                self._prune()
+            METRICS.observe("bot_backup_seconds",
+                            time.perf_counter() - started,
+                            kind=kind)
+            return manifest
+
+    def _prune(self):
+        # giữ keep_full bản full gần nhất cùng các delta sau chúng, rồi xoá
+        # object không còn manifest nào dùng
+        names = self.list_manifests()
+        fulls = [n for n in names if n.endswith("-full.json")]
+        if len(fulls) <= self.keep_full:
+            return
+        cutoff = fulls[-self.keep_full]
+        folder = os.path.join(self.root, "manifests")
+        for name in names:
+            if name < cutoff:
+                os.remove(os.path.join(folder, name))
+        used = set()
+        for name in self.list_manifests():
+            manifest = self.read_manifest(name)
+            used.add(manifest["state"])
+            used.update(manifest.get("farms", {}).values())
+        objects = os.path.join(self.root, "objects")
+        for sub in os.listdir(objects):
+            for fn in os.listdir(os.path.join(objects, sub)):
+                if fn[:-3] not in used:
+                    os.remove(os.path.join(objects, sub, fn))
+
+    # ---------- khôi phục ----------
+
+    def load(self, name):
+        # dựng lại toàn bộ dữ liệu từ 1 bản sao lưu, kiểm tra hết trước khi trả
+        farm_hashes, manifest, _ = self.resolve(name)
+        farms = []
+        for farm_id in sorted(farm_hashes):
+            farm = self._get_object(farm_hashes[farm_id])
+            if (farm.get("id") != farm_id
+                    or not isinstance(farm.get("name"), str)
+                    or farm.get("renewal_day", 1) not in range(1, 32)):
+                raise BackupError(f"farm {farm_id} không hợp lệ")
+            farms.append(farm)
+        state = self._get_object(manifest["state"])
+        return {"farms": farms, **state}, farm_hashes
+
+    def restore(self, name):
+        data, farm_hashes = self.load(name)
+        # sao lưu trạng thái hiện tại trước để có thể quay lại
+        self.backup()
+        with self._run_lock:
+            # mốc nhắc hạn giữ theo hiện tại để không nhắc lại các lần đã gửi
+            checkpoint = self.store.get_meta("reminder_checkpoint")
+            if checkpoint:
+                data["meta"]["reminder_checkpoint"] = checkpoint
+            self.store.save(data)
+            # bản mới nhất trong manifests là trạng thái trước khi khôi phục:
+            # delta tính theo dữ liệu vừa khôi phục không được nối vào đó
+            self._hashes = None
+            self._force_full = True
+        self.backup(full=True)
+        return len(data["farms"])
+
+    # ---------- chạy định kỳ ----------
+
+    def start(self, interval):
+        if self._thread is None and interval > 0:
+            self._thread = threading.Thread(target=self._run,
+                                            args=(interval, ),
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.backup()
+            except Exception as e:
+                print("Lỗi sao lưu tự động:", e)
+
+
+BACKUPS = None if SPAWN_CHILD else BackupManager(
+    STORE, BACKUP_DIR, BACKUP_FULL_EVERY, BACKUP_KEEP_FULL)
+
+
+# ================== KEY ROTATION ==================
+
+
+def rotate_keys(store=None, batch_size=None, workers=None, progress=print):
+    # Mã hoá lại mọi email_logins[*].enc chưa dùng khoá MASTER_SECRET hiện tại.
+    # Mỗi batch: giải mã/mã hoá song song trong process pool (không chiếm GIL
+    # của bot), rồi ghi cả batch 1 lần và lưu mốc vào meta "key_rotation".
+    # Chạy lại sau khi crash sẽ đi tiếp từ mốc; blob đã có kid mới thì bỏ qua.
+    store = store or STORE
+    batch_size = batch_size or ROTATE_BATCH_SIZE
+    workers = workers or ROTATE_WORKERS
+    state = store.get_meta("key_rotation") or {}
+    if state.get("kid") != KEY_ID or state.get("finished"):
+        state = {"kid": KEY_ID, "after": None, "rotated": 0, "failed": 0}
+    after = tuple(state["after"]) if state["after"] else None
+
+    pending = []
+    for farm in sorted(store.farms(), key=lambda f: f["id"]):
+        for email, login in sorted(farm.get("email_logins", {}).items()):
+            if after is not None and (farm["id"], email) <= after:
+                continue
+            if login.get("enc") and login.get("kid") != KEY_ID:
+                pending.append((farm["id"], email, login["enc"]))
+    if not pending:
+        state["finished"] = datetime.now().isoformat()
+        store.set_meta("key_rotation", state)
+        return state
+
+    # chỉ import khi xoay: file nằm cạnh bot.py, deploy phải upload kèm
+    import rotation_worker
+
+    keys = [_fernet_key(s) for s in [MASTER_SECRET, *OLD_MASTER_SECRETS]]
+    # spawn: không fork tiến trình bot đang có nhiều thread; hàm chạy trong
+    # process con nằm ở rotation_worker, bot.py chạy lại ở đó thì bỏ qua
+    # phần tạo store/client (SPAWN_CHILD)
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=ctx,
+                             initializer=rotation_worker.init,
+                             initargs=(keys, )) as pool:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            step = -(-len(batch) // workers)
+            chunks = [[enc for _, _, enc in batch[i:i + step]]
+                      for i in range(0, len(batch), step)]
+            rotated = [t for chunk in pool.map(rotation_worker.rotate_tokens,
+                                               chunks)
+                       for t in chunk]
+            with store.lock:
+                updates = []
+                for (farm_id, email, old), new in zip(batch, rotated):
+                    if new is None:
+                        state["failed"] += 1
+                        continue
+                    farm = store.farm_by_id(farm_id)
+                    login = (farm or {}).get("email_logins", {}).get(email)
+                    if not login or login.get("enc") != old:
+                        # login vừa bị sửa trong lúc xoay: giữ bản mới
+                        continue
+                    updates.append((farm_id, email, {
+                        **login, "enc": new,
+                        "kid": KEY_ID
+                    }))
+                store.set_email_logins(updates)
+                state["rotated"] += len(updates)
+                state["after"] = [batch[-1][0], batch[-1][1]]
+                store.set_meta("key_rotation", state)
+            progress(f"🔑 Đã xoay {start + len(batch)}/{len(pending)} login")
+    state["finished"] = datetime.now().isoformat()
+    store.set_meta("key_rotation", state)
+    return state
 
 
 # ================== TELEGRAM API ==================
 
 
+class TelegramError(Exception):
+
+    def __init__(self, method, description, error_code=None):
+        super().__init__(f"{method}: {description}")
+        self.error_code = error_code
+
+
+class TelegramClient:
+    # 1 requests.Session dùng chung (pool keep-alive, không bắt tay TLS lại cho
+    # mỗi tin nhắn), tự thử lại khi lỗi mạng / 5xx (backoff luỹ thừa + jitter),
+    # chờ đúng retry_after khi bị 429, và đo độ trễ theo từng method.
+
+    def __init__(self, base_url, retries=3, backoff=0.5, max_backoff=30,
+                 pool_size=32, file_url=None):
+        self.base_url = base_url
+        self.file_url = file_url
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+
+    def _observe(self, method, started, error=False):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            hist = self.latency.get(method)
+            if hist is None:
+                hist = self.latency[method] = Histogram()
+            if error:
+                self.errors[method] = self.errors.get(method, 0) + 1
+        hist.observe(elapsed)
+
+    def _sleep_backoff(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2**attempt))
+        time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+    def call(self, method, params=None, files=None, timeout=20, retries=None,
+             stream=None):
+        # stream: hàm trả về (content_type, iterable bytes) để gửi body dạng
+        # chunked; gọi lại mỗi lần thử nên body luôn được sinh lại từ đầu
+        if retries is None:
+            retries = self.retries
+        url = f"{self.base_url}/{method}"
+        attempt = 0
+        while True:
+            for f in (files or {}).values():
+                if hasattr(f, "seek"):
+                    f.seek(0)
+            started = time.perf_counter()
+            try:
+                if stream is not None:
+                    content_type, body = stream()
+                    resp = self.session.post(
+                        url,
+                        params=params,
+                        data=body,
+                        headers={"Content-Type": content_type},
+                        timeout=timeout)
+                else:
+                    resp = self.session.post(url, data=params, files=files,
+                                             timeout=timeout)
+            except requests.RequestException as e:
+                self._observe(method, started, error=True)
+                if attempt >= retries:
+                    raise TelegramError(method, str(e)) from e
+                self._sleep_backoff(attempt)
+                attempt += 1
+                continue
+
+            try:
+                payload = resp.json()
+            except ValueError:
+                payload = {"ok": False, "description": resp.text[:200]}
+            ok = resp.status_code == 200 and payload.get("ok")
+            self._observe(method, started, error=not ok)
+            if ok:
+                return payload.get("result")
+
+            code = payload.get("error_code", resp.status_code)
+            description = payload.get("description", f"HTTP {resp.status_code}")
+            if attempt < retries and code == 429:
+                retry_after = (payload.get("parameters") or {}).get(
+                    "retry_after", 1)
+                time.sleep(min(retry_after, self.max_backoff * 4))
+            elif attempt < retries and resp.status_code >= 500:
+                self._sleep_backoff(attempt)
+            else:
+                raise TelegramError(method, description, code)
+            attempt += 1
+
+    def download(self, file_id, timeout=60):
+        # file người dùng gửi lên: getFile lấy đường dẫn rồi tải dạng stream
+        # (response để đọc dần, người gọi phải close)
+        info = self.call("getFile", {"file_id": file_id})
+        started = time.perf_counter()
+        try:
+            resp = self.session.get(f"{self.file_url}/{info['file_path']}",
+                                    stream=True,
+                                    timeout=timeout)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            self._observe("download", started, error=True)
+            raise TelegramError("download", str(e)) from e
+        self._observe("download", started)
+        return resp
+
+
+API = None if SPAWN_CHILD else TelegramClient(BASE_URL,
+                                              retries=TELEGRAM_RETRIES,
+                                              backoff=TELEGRAM_BACKOFF,
+                                              pool_size=HANDLER_WORKERS * 2,
+                                              file_url=FILE_URL)
+
+
+class TokenBucket:
+    # rate token/giây, tối đa capacity token (cho phép gửi dồn 1 chút)
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundQueue:
+    # Hàng đợi gửi tin ra Telegram, tôn trọng giới hạn flood (~30 tin/giây
+    # toàn bot, ~1 tin/giây mỗi chat). Có 2 làn ưu tiên: trả lời lệnh
+    # (INTERACTIVE) luôn được xét trước tin nhắc hàng loạt (BULK), nên đợt
+    # nhắc lớn không làm chậm lệnh của người dùng. Mỗi chat chỉ có 1 request
+    # đang bay để giữ đúng thứ tự tin; làn đầy thì submit() chờ (backpressure).
+    INTERACTIVE, BULK = 0, 1
+    # Telegram không tính các method này là tin nhắn của chat: chỉ lấy lượt
+    # của giới hạn toàn bot, không tốn lượt 1 tin/giây của chat
+    UNMETERED = frozenset({"answerCallbackQuery"})
+
+    def __init__(self, api, rate=30, chat_rate=1, chat_burst=3, maxsize=1000,
+                 workers=8):
+        self.api = api
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.maxsize = maxsize
+        self.workers = workers
+        # burst nhỏ để không cửa sổ 1 giây nào vượt quá ~rate tin
+        self._global = TokenBucket(rate, max(1, rate / 10))
+        self._chats = {}
+        self._busy = set()
+        self._lanes = (deque(), deque())
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="outbound")
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def depth(self):
+        with self._cond:
+            return tuple(len(lane) for lane in self._lanes)
+
+    def submit(self, chat_id, method, params, priority=INTERACTIVE, **kwargs):
+        # kwargs chuyển nguyên cho TelegramClient.call (files, stream, timeout)
+        self.start()
+        future = Future()
+        with self._cond:
+            lane = self._lanes[priority]
+            while len(lane) >= self.maxsize:
+                self._cond.wait()
+            lane.append((str(chat_id), method, params, kwargs, future))
+            self._cond.notify_all()
+        return future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # bỏ các bucket đã đầy lại (chat lâu không gửi)
+                now = time.monotonic()
+                for key, b in list(self._chats.items()):
+                    if b.wait_time(now) == 0 and b.tokens >= b.capacity:
+                        del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now):
+        # trả về (job, None) hoặc (None, số giây nên chờ; None = chờ notify)
+        delay = self._global.wait_time(now)
+        if delay:
+            return None, delay
+        delay = None
+        for lane in self._lanes:
+            blocked = set()
+            for i, job in enumerate(lane):
+                chat_id = job[0]
+                metered = job[1] not in self.UNMETERED
+                # tin chưa tới lượt không giữ chân trả lời nút bấm phía sau nó
+                if chat_id in blocked and metered:
+                    continue
+                if chat_id in self._busy:
+                    blocked.add(chat_id)
+                    continue
+                if metered:
+                    bucket = self._chat_bucket(chat_id)
+                    wait = bucket.wait_time(now)
+                    if wait:
+                        blocked.add(chat_id)
+                        delay = wait if delay is None else min(delay, wait)
+                        continue
+                    bucket.take()
+                del lane[i]
+                self._global.take()
+                return job, None
+        return None, delay
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job, delay = self._pick(time.monotonic())
+                if job is None:
+                    self._cond.wait(delay)
+                    continue
+                self._busy.add(job[0])
+                self._cond.notify_all()
+            self._executor.submit(self._send, job)
+
+    def _send(self, job):
+        chat_id, method, params, kwargs, future = job
+        try:
+            future.set_result(self.api.call(method, params, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._cond:
+                self._busy.discard(chat_id)
+                self._cond.notify_all()
+
+
+OUTBOX = None if SPAWN_CHILD else OutboundQueue(API,
+                                                rate=OUTBOUND_RATE,
+                                                chat_rate=OUTBOUND_CHAT_RATE,
+                                                maxsize=OUTBOUND_QUEUE_SIZE)
+
+
+MESSAGE_LIMIT = 4096
+
+
+def message_length(text):
+    # Telegram tính độ dài tin theo đơn vị UTF-16 (emoji = 2)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_message(lines, reserve=0, limit=MESSAGE_LIMIT):
+    # ghép các dòng thành nhiều đoạn, mỗi đoạn + reserve ký tự (header)
+    # không vượt quá giới hạn 1 tin của Telegram
+    parts, cur, size = [], [], reserve
+    for line in lines:
+        n = message_length(line) + 1
+        if cur and size + n > limit:
+            parts.append("\n".join(cur))
+            cur, size = [], reserve
+        cur.append(line)
+        size += n
+    if cur:
+        parts.append("\n".join(cur))
+    return parts
+
+
+def _log_send_error(future):
+    if future.exception() is not None:
+        print("Lỗi send_message:", future.exception())
+
+
 def get_updates(offset=None):
-    url = BASE_URL + "/getUpdates"
     params = {"timeout": 100, "offset": offset}
-    resp = requests.get(url, params=params, timeout=120)
-    return resp.json()
+    return API.call("getUpdates", params, timeout=120)
 
 
-def send_message(chat_id, text, reply_markup=None):
-    url = BASE_URL + "/sendMessage"
+def send_message(chat_id, text, reply_markup=None,
+                 priority=OutboundQueue.INTERACTIVE, wait=True):
     data = {
         "chat_id": chat_id,
         "text": text,
@@ -119,21 +2729,97 @@ def send_message(chat_id, text, reply_markup=None):
     }
     if reply_markup:
         data["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
+    future = OUTBOX.submit(chat_id, "sendMessage", data, priority=priority)
+    if not wait:
+        # tin nhắc hàng loạt: không chờ gửi xong, lỗi chỉ ghi log
+        future.add_done_callback(_log_send_error)
+        return None
     try:
-        requests.post(url, data=data, timeout=20)
-    except Exception as e:
+        return future.result()
+    except TelegramError as e:
         print("Lỗi send_message:", e)
+        return None
+
+
+def edit_message(chat_id, message_id, text, reply_markup=None):
+    data = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "parse_mode": "HTML",
+    }
+    if reply_markup:
+        data["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
+    try:
+        return OUTBOX.submit(chat_id, "editMessageText", data).result()
+    except TelegramError as e:
+        # bấm lại đúng trang đang xem: Telegram báo không có gì để sửa
+        if "not modified" not in str(e):
+            print("Lỗi edit_message:", e)
+        return None
+
+
+def answer_callback(chat_id, callback_id, text=None):
+    # tắt vòng quay trên nút vừa bấm (text: thông báo nhỏ hiện lên)
+    data = {"callback_query_id": callback_id}
+    if text:
+        data["text"] = text
+    future = OUTBOX.submit(chat_id, "answerCallbackQuery", data)
+    future.add_done_callback(_log_send_error)
 
 
 def send_document(chat_id, file_path, caption=""):
-    url = BASE_URL + "/sendDocument"
     with open(file_path, "rb") as f:
         files = {"document": f}
         data = {"chat_id": chat_id, "caption": caption}
         try:
-            requests.post(url, data=data, files=files, timeout=60)
-        except Exception as e:
+            return OUTBOX.submit(chat_id, "sendDocument", data, files=files,
+                                 timeout=60).result()
+        except TelegramError as e:
             print("Lỗi send_document:", e)
+            return None
+
+
+def _gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = định dạng gzip
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def _multipart_body(boundary, filename, chunks):
+    yield (f"--{boundary}\r\n"
+           f'Content-Disposition: form-data; name="document"; '
+           f'filename="{filename}"\r\n'
+           "Content-Type: application/octet-stream\r\n\r\n").encode("utf-8")
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+
+def send_document_stream(chat_id, filename, make_chunks, caption="",
+                         gzip=False):
+    # Gửi file sinh dần từ make_chunks() (iterable bytes) thẳng vào body
+    # multipart (chunked), không ghi file tạm; gzip=True nén trên đường đi.
+    if gzip:
+        filename += ".gz"
+
+    def stream():
+        boundary = f"bot{random.getrandbits(64):016x}"
+        chunks = make_chunks()
+        if gzip:
+            chunks = _gzip_chunks(chunks)
+        return (f"multipart/form-data; boundary={boundary}",
+                _multipart_body(boundary, filename, chunks))
+
+    data = {"chat_id": chat_id, "caption": caption}
+    try:
+        return OUTBOX.submit(chat_id, "sendDocument", data, stream=stream,
+                             timeout=300).result()
+    except TelegramError as e:
+        print("Lỗi send_document:", e)
+        return None
 
 
 # ================== MENU & HELP ==================
@@ -159,6 +2845,7 @@ def get_menu_text():
 💾 <b>Dữ liệu:</b>
 /sao_luu - Backup JSON
 /xuat_csv - Export CSV
+/nhap_du_lieu - Nhập farm hàng loạt từ file
 /bat_tat_nhac - Bật/Tắt nhắc
 
 🔐 <b>Login email (theo farm):</b>
@@ -167,6 +2854,7 @@ def get_menu_text():
 
 ℹ️ <b>Khác:</b>
 /huy - Hủy thao tác hiện tại
+/hieu_nang - Thời gian xử lý lệnh
 /help - Hướng dẫn chi tiết
 """
 
@@ -208,12 +2896,16 @@ def handle_help(chat_id):
 
 • /them_farm: Thêm farm/khách hàng, bot hỏi từng bước.
 • /danh_sach, /xem_farm, /sua_farm, /xoa_farm, /tim_farm: Quản lý farm.
-• /thong_ke, /bao_cao_ngay, /bao_cao_tuan, /lich_su: Thống kê & lịch sử.
+• /thong_ke, /bao_cao_ngay, /bao_cao_tuan, /lich_su: Thống kê & lịch sử
+  (/lich_su lọc được theo khoảng ngày, tháng và loại nhắc).
 • /sao_luu, /xuat_csv: Sao lưu & export dữ liệu.
+• /nhap_du_lieu: Gửi file CSV (định dạng /xuat_csv) hoặc JSON (/sao_luu) để
+  thêm nhiều farm 1 lần; dòng lỗi / trùng tên được bỏ qua và báo lại.
 • /bat_tat_nhac: Bật/tắt nhắc hạn từng farm.
 • /set_mail_login: Lưu mật khẩu / 2FA cho email trong farm.
 • /get_mail_login: Xem lại mật khẩu / 2FA cho email trong farm.
 • /huy: Huỷ thao tác đang làm.
+• /hieu_nang: Số lần gọi và thời gian xử lý (p50 / p95) của từng lệnh.
 """
     send_message(chat_id, help_text)
 
@@ -246,30 +2938,52 @@ def get_next_renewal_date(renewal_day, from_date=None):
     return renewal_date
 
 
+def renewal_days_on(day):
+    # các renewal_day rơi vào ngày `day`; ngày cuối tháng gom luôn các
+    # renewal_day lớn hơn bị kẹp lại (VD: ngày 29-31 rơi vào 28/02)
+    last_day = calendar.monthrange(day.year, day.month)[1]
+    if day.day == last_day:
+        return range(day.day, 32)
+    return (day.day, )
+
+
+def renewal_day_map(start, days):
+    # renewal_day -> ngày đến hạn trong khoảng [start, start + days]
+    day_map = {}
+    for i in range(days + 1):
+        d = start + timedelta(days=i)
+        for rday in renewal_days_on(d):
+            day_map.setdefault(rday, d)
+    return day_map
+
+
 # ================== ADD FARM ==================
 
 
-def start_add_farm(chat_id, data):
-    data["user_states"][str(chat_id)] = {
+def start_add_farm(chat_id):
+    SESSIONS.set(chat_id, {
         "action": "add_farm",
         "step": "name",
         "farm": {},
-    }
-    save_data(data)
+    })
     send_message(chat_id,
                  "📝 <b>Thêm farm/khách hàng mới</b>\n\nNhập <b>tên</b>:")
 
 
-def handle_add_farm_flow(chat_id, text, data):
-    state = data["user_states"][str(chat_id)]
+def handle_add_farm_flow(chat_id, text):
+    state = SESSIONS.get(chat_id)
     step = state["step"]
     farm = state["farm"]
 
     if step == "name":
         farm["name"] = text.strip()
         state["step"] = "owner"
+        dup = farms_of(chat_id).find_farm(farm["name"])
+        warn = (f"\n⚠️ Đã có farm <b>{dup['name']}</b> trùng tên, các lệnh "
+                "tìm theo tên sẽ chọn farm cũ." if dup else "")
         send_message(
-            chat_id, f"✅ Tên: <b>{farm['name']}</b>\n\nNhập <b>email chủ</b>:")
+            chat_id,
+            f"✅ Tên: <b>{farm['name']}</b>{warn}\n\nNhập <b>email chủ</b>:")
 
     elif step == "owner":
         farm["owner_email"] = text.strip()
@@ -333,10 +3047,8 @@ def handle_add_farm_flow(chat_id, text, data):
             farm.setdefault("reminder_history", [])
             farm.setdefault("email_logins", {})
 
-            data["farms"].append(farm)
-            if str(chat_id) in data["user_states"]:
-                del data["user_states"][str(chat_id)]
-            save_data(data)
+            STORE.add_farm(farm)
+            SESSIONS.clear(chat_id)
 
             members = farm.get("members", [])
             mem_str = ""
@@ -362,56 +3074,237 @@ def handle_add_farm_flow(chat_id, text, data):
         except ValueError:
             send_message(chat_id, "❌ Vui lòng nhập số tiền hợp lệ.")
 
-    save_data(data)
+    if SESSIONS.get(chat_id) is not None:
+        SESSIONS.set(chat_id, state)
+
+
+# ================== PAGINATION ==================
+
+
+def _list_line(i, f):
+    st = "🔔" if f.get("reminder_enabled", True) else "🔕"
+    return (f"<b>{i}. {f['name']}</b> {st}\n"
+            f"   👤 {f['owner_email']}\n"
+            f"   📅 Ngày {f['renewal_day']}\n"
+            f"   💰 {f['price']:,} VNĐ\n\n")
+
+
+def _name_line(i, f):
+    return f"• {f['name']}\n"
+
+
+def _toggle_line(i, f):
+    st = "ON" if f.get("reminder_enabled", True) else "OFF"
+    return f"• {f['name']} - {st}\n"
+
+
+def _toggle_label(f):
+    st = "ON" if f.get("reminder_enabled", True) else "OFF"
+    return f"{f['name']} · {st}"
+
+
+# số farm mỗi trang: danh sách chi tiết / trang chọn farm (nút 2 farm/hàng:
+# 40 nút + hàng lật trang, dưới giới hạn 100 nút của Telegram)
+LIST_PAGE_SIZE = 10
+PICK_PAGE_SIZE = 40
+# loại trang -> (tiêu đề theo tổng số farm, dòng của 1 farm, số farm/trang,
+# chữ trên nút chọn farm hoặc None nếu trang không có nút chọn)
+PAGE_KINDS = {
+    "list": (lambda total: f"📋 <b>Danh sách ({total})</b>\n\n", _list_line,
+             LIST_PAGE_SIZE, None),
+    "view": (lambda total: "👁 <b>Xem chi tiết</b>\n\nChọn farm hoặc nhập "
+             "<b>tên</b>:\n\n", _name_line, PICK_PAGE_SIZE,
+             lambda f: f["name"]),
+    "edit": (lambda total: "✏️ <b>Sửa farm</b>\n\nChọn farm hoặc nhập "
+             "<b>tên</b>:\n\n", _name_line, PICK_PAGE_SIZE,
+             lambda f: f["name"]),
+    "delete": (lambda total: "🗑 <b>Xoá farm</b>\n\nChọn farm hoặc nhập "
+               "<b>tên</b>:\n\n", _name_line, PICK_PAGE_SIZE,
+               lambda f: f["name"]),
+    "history": (lambda total: "🕒 <b>Lịch sử nhắc</b>\n\nChọn farm hoặc "
+                "nhập tên farm:\n\n", _name_line, PICK_PAGE_SIZE,
+                lambda f: f["name"]),
+    "toggle": (lambda total: "🔔 <b>Bật/Tắt nhắc</b>\n\nBấm để đổi, hoặc "
+               "nhập tên farm:\n\n", _toggle_line, PICK_PAGE_SIZE,
+               _toggle_label),
+    "set_login": (lambda total: "🔐 <b>Lưu mật khẩu / 2FA cho email</b>\n\n"
+                  "Chọn farm hoặc nhập <b>tên farm</b>:\n\n", _name_line,
+                  PICK_PAGE_SIZE, lambda f: f["name"]),
+    "get_login": (lambda total: "🔎 <b>Xem login email</b>\n\nChọn farm "
+                  "hoặc nhập <b>tên farm</b>:\n\n", _name_line,
+                  PICK_PAGE_SIZE, lambda f: f["name"]),
+}
+# các trường hiện trên trang: đổi thì xoá cache
+PAGE_FIELDS = ("name", "owner_email", "renewal_day", "price",
+               "reminder_enabled")
+
+
+class PageCache:
+    # (loại, số trang) -> (text, inline keyboard) đã dựng sẵn, LRU; farm được
+    # thêm/xoá hoặc đổi trường đang hiện thì xoá hết. Lật trang chỉ đọc đúng
+    # các farm của trang đó (store.page_farms), không dựng lại cả danh sách.
+
+    def __init__(self, store, size=256):
+        self.store = store
+        self.size = size
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._version = 0
+        store.watch(PAGE_FIELDS, self._invalidate)
+
+    def _invalidate(self, farm_id):
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+
+    def get(self, kind, page, owner=None):
+        # owner: chat có phân vùng đang xem (None = mọi chat, cho admin)
+        key = (None if owner is None else owner_key(owner), kind, page)
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is not None:
+                self._pages.move_to_end(key)
+                METRICS.inc("bot_page_cache_total", result="hit")
+                return cached
+            version = self._version
+        METRICS.inc("bot_page_cache_total", result="miss")
+        rendered = self._render(kind, page, owner)
+        with self._lock:
+            # có thay đổi trong lúc dựng trang: không lưu bản có thể đã cũ
+            if version == self._version:
+                self._pages[key] = rendered
+                if len(self._pages) > self.size:
+                    self._pages.popitem(last=False)
+        return rendered
+
+    def _render(self, kind, page, owner):
+        title, line, per_page, label = PAGE_KINDS[kind]
+        total, farms = self.store.page_farms(page * per_page, per_page,
+                                             owner=owner)
+        pages = max(1, -(-total // per_page))
+        if page >= pages:
+            # danh sách ngắn lại: về trang cuối
+            page = pages - 1
+            total, farms = self.store.page_farms(page * per_page, per_page,
+                                                 owner=owner)
+        start = page * per_page
+        text = title(total) + "".join(
+            line(i, f) for i, f in enumerate(farms, start + 1))
+        rows = []
+        if label is not None:
+            # nút chọn farm, 2 nút/hàng; callback_data chỉ mang id farm
+            buttons = [{
+                "text": label(f),
+                "callback_data": f"sel:{kind}:{page}:{f['id']}"
+            } for f in farms]
+            rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        rows += page_keyboard(kind, page, pages)
+        return text, {"inline_keyboard": rows} if rows else None
+
+
+def page_keyboard(kind, page, pages):
+    # hàng nút lật trang ([] nếu chỉ có 1 trang)
+    if pages <= 1:
+        return []
+
+    def button(label, target):
+        return {"text": label, "callback_data": f"pg:{kind}:{target}"}
+
+    row = []
+    if page > 0:
+        row += [button("⏮", 0), button("◀️", page - 1)]
+    row.append({"text": f"{page + 1}/{pages}", "callback_data": "noop"})
+    if page < pages - 1:
+        row += [button("▶️", page + 1), button("⏭", pages - 1)]
+    return [row]
+
+
+PAGES = None if SPAWN_CHILD else PageCache(STORE)
+
+
+def send_page(chat_id, kind, page=0):
+    text, markup = PAGES.get(kind, page, scope_of(chat_id))
+    send_message(chat_id, text, reply_markup=markup)
+
+
+def handle_page_callback(chat_id, message_id, arg):
+    # callback_data "pg:<loại>:<trang>": sửa tin đang có, không gửi tin mới
+    kind, _, page = arg.partition(":")
+    if kind not in PAGE_KINDS or not page.isdigit():
+        return
+    text, markup = PAGES.get(kind, int(page), scope_of(chat_id))
+    edit_message(chat_id, message_id, text, reply_markup=markup)
+
+
+def copy_button(label, text):
+    # nút copy_text: bấm là chép vào clipboard ngay trên máy người dùng,
+    # không gửi update về bot (Telegram giới hạn 256 ký tự)
+    return {"text": label, "copy_text": {"text": text[:256]}}
+
+
+def _callback_ids(arg, count):
+    # "12:3" -> [12, 3]; None nếu sai định dạng (callback_data do client gửi)
+    parts = arg.split(":")
+    if len(parts) != count or not all(p.isdigit() for p in parts):
+        return None
+    return [int(p) for p in parts]
+
+
+def handle_select_callback(chat_id, message_id, arg):
+    # callback_data "sel:<loại trang>:<trang>:<id farm>" từ nút chọn farm
+    kind, _, rest = arg.partition(":")
+    ids = _callback_ids(rest, 2)
+    if kind not in SELECT_ACTIONS or ids is None:
+        return None
+    page, farm_id = ids
+    farm = farms_of(chat_id).farm_by_id(farm_id)
+    if farm is None:
+        return "❌ Farm không còn tồn tại."
+    result = SELECT_ACTIONS[kind](chat_id, farm)
+    if kind == "toggle":
+        # cập nhật ON/OFF ngay trên trang đang xem
+        text, markup = PAGES.get(kind, page, scope_of(chat_id))
+        edit_message(chat_id, message_id, text, reply_markup=markup)
+    return result
 
 
 # ================== LIST / VIEW FARM ==================
 
 
-def handle_list_farms(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def handle_list_farms(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id,
                      "📭 Chưa có dữ liệu. Dùng /them_farm để thêm mới.")
         return
-    msg = f"📋 <b>Danh sách ({len(farms)})</b>\n\n"
-    for i, f in enumerate(farms, 1):
-        st = "🔔" if f.get("reminder_enabled", True) else "🔕"
-        msg += (f"<b>{i}. {f['name']}</b> {st}\n"
-                f"   👤 {f['owner_email']}\n"
-                f"   📅 Ngày {f['renewal_day']}\n"
-                f"   💰 {f['price']:,} VNĐ\n\n")
-    send_message(chat_id, msg)
+    send_page(chat_id, "list")
 
 
-def start_view_farm(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def start_view_farm(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "view_farm",
         "step": "select",
-    }
-    save_data(data)
-    msg = "👁 <b>Xem chi tiết</b>\n\nNhập <b>tên</b>:\n\n"
-    for f in farms:
-        msg += f"• {f['name']}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "view")
 
 
-def handle_view_farm_flow(chat_id, text, data):
-    name = text.strip().lower()
-    farms = data.get("farms", [])
-    target = None
-    for f in farms:
-        if f["name"].lower() == name:
-            target = f
-            break
+def handle_view_farm_flow(chat_id, text):
+    target = farms_of(chat_id).find_farm(text)
     if not target:
         send_message(chat_id, f"❌ Không tìm thấy <b>{text}</b>.")
         return
+    show_farm(chat_id, target)
+
+
+def show_farm(chat_id, target):
+    SESSIONS.clear(chat_id)
+    text, markup = farm_detail(target)
+    send_message(chat_id, text, reply_markup=markup)
+
 
+def farm_detail(target):
     start_str = target.get("start_date", "")
     if start_str:
         try:
@@ -444,89 +3337,76 @@ def handle_view_farm_flow(chat_id, text, data):
 🔐 Mật khẩu / 2FA KHÔNG hiển thị ở đây.
 Dùng lệnh /get_mail_login để xem login từng email.
 """
-    if str(chat_id) in data["user_states"]:
-        del data["user_states"][str(chat_id)]
-        save_data(data)
-    send_message(chat_id, detail)
+    farm_id = target["id"]
+    emails = [target["owner_email"]] + members
+    rows = [[copy_button(f"📋 Copy {em}", em)] for em in emails if em]
+    rows.append([
+        {"text": "✏️ Email chủ", "callback_data": f"ed:{farm_id}:owner"},
+        {"text": "✏️ Ngày gia hạn", "callback_data": f"ed:{farm_id}:renewal"},
+        {"text": "✏️ Giá", "callback_data": f"ed:{farm_id}:price"},
+    ])
+    rows.append([
+        {"text": "🔔 Bật/Tắt nhắc", "callback_data": f"tg:{farm_id}"},
+        {"text": "🗑 Xoá", "callback_data": f"del:{farm_id}:ask"},
+    ])
+    return detail, {"inline_keyboard": rows}
 
 
 # ================== EDIT / DELETE ==================
 
 
-def start_edit_farm(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def start_edit_farm(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu để sửa!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "edit_farm",
         "step": "select",
-    }
-    save_data(data)
-    msg = "✏️ <b>Sửa farm</b>\n\nNhập <b>tên</b>:\n\n"
-    for f in farms:
-        msg += f"• {f['name']}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "edit")
 
 
-def handle_edit_farm_flow(chat_id, text, data):
-    state = data["user_states"][str(chat_id)]
+def handle_edit_farm_flow(chat_id, text):
+    state = SESSIONS.get(chat_id)
     step = state["step"]
 
     if step == "select":
-        farms = data.get("farms", [])
-        name = text.strip().lower()
-        idx = -1
-        for i, f in enumerate(farms):
-            if f["name"].lower() == name:
-                idx = i
-                break
-        if idx == -1:
+        farm = farms_of(chat_id).find_farm(text)
+        if farm is None:
             send_message(chat_id, f"❌ Không tìm thấy <b>{text}</b>.")
             return
-        state["farm_index"] = idx
-        state["step"] = "field"
-        save_data(data)
-        send_message(
-            chat_id,
-            "Chọn mục sửa:\n1 - Email chủ\n2 - Ngày gia hạn\n3 - Giá tiền\nNhập 1 / 2 / 3:",
-        )
+        ask_edit_field(chat_id, farm)
 
     elif step == "field":
-        if text.strip() == "1":
-            state["step"] = "edit_owner"
-            save_data(data)
-            send_message(chat_id, "Nhập email chủ mới:")
-        elif text.strip() == "2":
-            state["step"] = "edit_renewal"
-            save_data(data)
-            send_message(chat_id, "Nhập ngày gia hạn mới (1-31):")
-        elif text.strip() == "3":
-            state["step"] = "edit_price"
-            save_data(data)
-            send_message(chat_id, "Nhập giá tiền mới:")
-        else:
+        field = {"1": "owner", "2": "renewal", "3": "price"}.get(text.strip())
+        if field is None:
             send_message(chat_id, "❌ Vui lòng nhập 1 / 2 / 3.")
+            return
+        ask_edit_value(chat_id, state["farm_id"], field)
 
     elif step == "edit_owner":
-        idx = state["farm_index"]
-        data["farms"][idx]["owner_email"] = text.strip()
-        name = data["farms"][idx]["name"]
-        del data["user_states"][str(chat_id)]
-        save_data(data)
-        send_message(chat_id, f"✅ Đã cập nhật email chủ của <b>{name}</b>.")
+        farm = farms_of(chat_id).farm_by_id(state["farm_id"])
+        SESSIONS.clear(chat_id)
+        if farm is None:
+            send_message(chat_id, "❌ Farm không còn tồn tại.")
+            return
+        STORE.update_farm(farm, owner_email=text.strip())
+        send_message(chat_id,
+                     f"✅ Đã cập nhật email chủ của <b>{farm['name']}</b>.")
 
     elif step == "edit_renewal":
         try:
             day = int(text.strip())
             if 1 <= day <= 31:
-                idx = state["farm_index"]
-                data["farms"][idx]["renewal_day"] = day
-                name = data["farms"][idx]["name"]
-                del data["user_states"][str(chat_id)]
-                save_data(data)
-                send_message(chat_id,
-                             f"✅ Đã cập nhật ngày gia hạn của <b>{name}</b>.")
+                farm = farms_of(chat_id).farm_by_id(state["farm_id"])
+                SESSIONS.clear(chat_id)
+                if farm is None:
+                    send_message(chat_id, "❌ Farm không còn tồn tại.")
+                    return
+                STORE.update_farm(farm, renewal_day=day)
+                send_message(
+                    chat_id,
+                    f"✅ Đã cập nhật ngày gia hạn của <b>{farm['name']}</b>.")
             else:
                 send_message(chat_id, "❌ Vui lòng nhập số 1-31.")
         except ValueError:
@@ -535,80 +3415,134 @@ def handle_edit_farm_flow(chat_id, text, data):
     elif step == "edit_price":
         try:
             price = int(text.replace(",", "").replace(".", "").strip())
-            idx = state["farm_index"]
-            data["farms"][idx]["price"] = price
-            name = data["farms"][idx]["name"]
-            del data["user_states"][str(chat_id)]
-            save_data(data)
-            send_message(chat_id, f"✅ Đã cập nhật giá của <b>{name}</b>.")
+            farm = farms_of(chat_id).farm_by_id(state["farm_id"])
+            SESSIONS.clear(chat_id)
+            if farm is None:
+                send_message(chat_id, "❌ Farm không còn tồn tại.")
+                return
+            STORE.update_farm(farm, price=price)
+            send_message(chat_id,
+                         f"✅ Đã cập nhật giá của <b>{farm['name']}</b>.")
         except ValueError:
             send_message(chat_id, "❌ Vui lòng nhập số tiền hợp lệ.")
 
 
-def start_delete_farm(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+# mục sửa -> (step của flow edit_farm, câu hỏi)
+EDIT_FIELDS = {
+    "owner": ("edit_owner", "Nhập email chủ mới:"),
+    "renewal": ("edit_renewal", "Nhập ngày gia hạn mới (1-31):"),
+    "price": ("edit_price", "Nhập giá tiền mới:"),
+}
+
+
+def ask_edit_field(chat_id, farm):
+    SESSIONS.set(chat_id, {
+        "action": "edit_farm",
+        "step": "field",
+        "farm_id": farm["id"],
+    })
+    farm_id = farm["id"]
+    send_message(
+        chat_id,
+        f"✏️ <b>{farm['name']}</b>\n\nChọn mục sửa:\n1 - Email chủ\n"
+        "2 - Ngày gia hạn\n3 - Giá tiền\nBấm nút hoặc nhập 1 / 2 / 3:",
+        reply_markup={"inline_keyboard": [[
+            {"text": "1 - Email chủ", "callback_data": f"ed:{farm_id}:owner"},
+            {"text": "2 - Ngày gia hạn", "callback_data": f"ed:{farm_id}:renewal"},
+            {"text": "3 - Giá tiền", "callback_data": f"ed:{farm_id}:price"},
+        ]]})
+
+
+def ask_edit_value(chat_id, farm_id, field):
+    step, prompt = EDIT_FIELDS[field]
+    SESSIONS.set(chat_id, {
+        "action": "edit_farm",
+        "step": step,
+        "farm_id": farm_id,
+    })
+    send_message(chat_id, prompt)
+
+
+def handle_edit_callback(chat_id, message_id, arg):
+    # "ed:<id farm>:<mục>": hỏi luôn giá trị mới, bỏ qua bước chọn farm/mục
+    farm_id, _, field = arg.partition(":")
+    if not farm_id.isdigit() or field not in EDIT_FIELDS:
+        return None
+    if farms_of(chat_id).farm_by_id(int(farm_id)) is None:
+        return "❌ Farm không còn tồn tại."
+    ask_edit_value(chat_id, int(farm_id), field)
+    return None
+
+
+def start_delete_farm(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu để xoá!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "delete_farm",
         "step": "select",
-    }
-    save_data(data)
-    msg = "🗑 <b>Xoá farm</b>\n\nNhập <b>tên</b>:\n\n"
-    for f in farms:
-        msg += f"• {f['name']}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "delete")
 
 
-def handle_delete_farm_flow(chat_id, text, data):
-    farms = data.get("farms", [])
-    name = text.strip().lower()
-    idx = -1
-    for i, f in enumerate(farms):
-        if f["name"].lower() == name:
-            idx = i
-            break
-    if idx == -1:
+def handle_delete_farm_flow(chat_id, text):
+    farm = farms_of(chat_id).find_farm(text)
+    if farm is None:
         send_message(chat_id, f"❌ Không tìm thấy <b>{text}</b>.")
         return
-    deleted = farms[idx]["name"]
-    farms.pop(idx)
-    if str(chat_id) in data["user_states"]:
-        del data["user_states"][str(chat_id)]
-    save_data(data)
+    deleted = farm["name"]
+    STORE.delete_farm(farm)
+    SESSIONS.clear(chat_id)
     send_message(chat_id, f"✅ Đã xoá <b>{deleted}</b>.")
 
 
+def confirm_delete(chat_id, farm):
+    # chọn bằng nút thì hỏi lại trước khi xoá (gõ đúng tên thì xoá luôn)
+    SESSIONS.clear(chat_id)
+    send_message(
+        chat_id, f"🗑 Xoá <b>{farm['name']}</b>?",
+        reply_markup={"inline_keyboard": [[
+            {"text": "✅ Xoá", "callback_data": f"del:{farm['id']}:yes"},
+            {"text": "❌ Không", "callback_data": f"del:{farm['id']}:no"},
+        ]]})
+
+
+def handle_delete_callback(chat_id, message_id, arg):
+    # "del:<id farm>:ask|yes|no"
+    farm_id, _, answer = arg.partition(":")
+    if not farm_id.isdigit():
+        return None
+    farm = farms_of(chat_id).farm_by_id(int(farm_id))
+    if farm is None:
+        edit_message(chat_id, message_id, "❌ Farm không còn tồn tại.")
+    elif answer == "ask":
+        confirm_delete(chat_id, farm)
+    elif answer == "yes":
+        STORE.delete_farm(farm)
+        edit_message(chat_id, message_id, f"✅ Đã xoá <b>{farm['name']}</b>.")
+    else:
+        edit_message(chat_id, message_id,
+                     f"❎ Giữ lại <b>{farm['name']}</b>.")
+    return None
+
+
 # ================== SEARCH ==================
 
 
-def start_search_farm(chat_id, data):
-    if not data.get("farms"):
+def start_search_farm(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu để tìm!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "search_farm",
         "step": "input",
-    }
-    save_data(data)
+    })
     send_message(chat_id, "🔍 Nhập <b>tên</b> hoặc <b>email</b> cần tìm:")
 
 
-def handle_search_farm_flow(chat_id, text, data):
-    kw = text.strip().lower()
-    res = []
-    for f in data.get("farms", []):
-        if kw in f["name"].lower() or kw in f["owner_email"].lower():
-            res.append(f)
-            continue
-        for m in f.get("members", []):
-            if kw in m.lower():
-                res.append(f)
-                break
-    if str(chat_id) in data["user_states"]:
-        del data["user_states"][str(chat_id)]
-        save_data(data)
+def handle_search_farm_flow(chat_id, text):
+    res = farms_of(chat_id).search_farms(text.strip())
+    SESSIONS.clear(chat_id)
     if not res:
         send_message(chat_id, f"❌ Không tìm thấy với từ khoá <b>{text}</b>.")
         return
@@ -624,28 +3558,23 @@ def handle_search_farm_flow(chat_id, text, data):
 # ================== STATS & REPORT ==================
 
 
-def handle_statistics(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def handle_statistics(chat_id):
+    view = farms_of(chat_id)
+    total, total_cost, active = view.summary()
+    if not total:
         send_message(chat_id, "📭 Chưa có dữ liệu để thống kê!")
         return
-    total = len(farms)
-    total_cost = sum(f.get("price", 0) for f in farms)
-    active = sum(1 for f in farms if f.get("reminder_enabled", True))
-    today = datetime.now()
-    upcoming = []
-    for f in farms:
-        rd = get_next_renewal_date(f.get("renewal_day", 1), from_date=today)
-        diff = (rd.date() - today.date()).days
-        if 0 <= diff <= 7:
-            upcoming.append((f, diff))
+    today = datetime.now().date()
+    upcoming = [(f, (rd - today).days) for f, rd in view.farms_due(today, 7)]
+    dups = view.duplicate_names()
+    dup_line = f"⚠️ Tên trùng: {', '.join(dups)}\n" if dups else ""
 
     msg = f"""📊 <b>Thống kê</b>
 
 📦 Tổng farm: <b>{total}</b>
 💰 Tổng tiền/tháng: <b>{total_cost:,} VNĐ</b>
 🔔 Đang bật nhắc: <b>{active}/{total}</b>
-
+{dup_line}
 ⏰ Đến hạn trong 7 ngày tới:"""
 
     if not upcoming:
@@ -663,22 +3592,14 @@ def handle_statistics(chat_id, data):
     send_message(chat_id, msg)
 
 
-def handle_daily_report(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def handle_daily_report(chat_id):
+    view = farms_of(chat_id)
+    if not view.has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu!")
         return
     today = datetime.now()
     today_str = today.strftime("%d/%m/%Y")
-    res = []
-    for f in farms:
-        rd = get_next_renewal_date(f.get("renewal_day", 1),
-                                   from_date=today.replace(hour=0,
-                                                           minute=0,
-                                                           second=0,
-                                                           microsecond=0))
-        if rd.date() == today.date():
-            res.append(f)
+    res = [f for f, _ in view.farms_due(today.date(), 0)]
     if not res:
         send_message(chat_id,
                      f"📅 Hôm nay ({today_str}) không có farm nào đến hạn.")
@@ -689,18 +3610,13 @@ def handle_daily_report(chat_id, data):
     send_message(chat_id, msg)
 
 
-def handle_weekly_report(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def handle_weekly_report(chat_id):
+    view = farms_of(chat_id)
+    if not view.has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu!")
         return
-    today = datetime.now()
-    res = []
-    for f in farms:
-        rd = get_next_renewal_date(f.get("renewal_day", 1), from_date=today)
-        diff = (rd.date() - today.date()).days
-        if 0 <= diff <= 7:
-            res.append((f, rd, diff))
+    today = datetime.now().date()
+    res = [(f, rd, (rd - today).days) for f, rd in view.farms_due(today, 7)]
     if not res:
         send_message(chat_id, "📆 7 ngày tới không có farm nào đến hạn.")
         return
@@ -716,220 +3632,476 @@ def handle_weekly_report(chat_id, data):
     send_message(chat_id, msg)
 
 
-def start_history(chat_id, data):
-    if not data.get("farms"):
+def start_history(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có farm nào!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "history",
         "step": "farm",
-    }
-    save_data(data)
-    msg = "🕒 <b>Lịch sử nhắc</b>\n\nNhập tên farm:\n\n"
-    for f in data["farms"]:
-        msg += f"• {f['name']}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "history")
 
 
-def handle_history_flow(chat_id, text, data):
-    name = text.strip().lower()
-    target = None
-    for f in data.get("farms", []):
-        if f["name"].lower() == name:
-            target = f
-            break
-    if not target:
-        send_message(chat_id, f"❌ Không tìm thấy <b>{text}</b>.")
+HISTORY_LABELS = {
+    "3days": "Trước 3 ngày",
+    "2days": "Trước 2 ngày",
+    "1day": "Trước 1 ngày",
+    "0day": "Đúng ngày",
+}
+
+
+def parse_history_filter(text):
+    # "01/09/2025-30/09/2025", "09/2025", "15/09/2025", "0day"... cách nhau bởi
+    # dấu cách -> (từ ngày, đến ngày, loại); ValueError nếu sai
+    start = end = kind = None
+    for token in text.split():
+        if token.lower() == "skip":
+            continue
+        if token in HISTORY_LABELS:
+            kind = token
+        elif "-" in token:
+            a, b = token.split("-", 1)
+            start = datetime.strptime(a, "%d/%m/%Y").strftime("%Y-%m-%d")
+            end = datetime.strptime(b, "%d/%m/%Y").strftime("%Y-%m-%d")
+        elif token.count("/") == 2:
+            start = end = datetime.strptime(token,
+                                            "%d/%m/%Y").strftime("%Y-%m-%d")
+        else:
+            month = datetime.strptime(token, "%m/%Y")
+            last_day = calendar.monthrange(month.year, month.month)[1]
+            start = month.strftime("%Y-%m-01")
+            end = month.strftime(f"%Y-%m-{last_day:02d}")
+    return start, end, kind
+
+
+def ask_history_filter(chat_id, target):
+    SESSIONS.set(chat_id, {
+        "action": "history",
+        "step": "filter",
+        "farm_id": target["id"],
+    })
+    send_message(
+        chat_id, f"🕒 <b>{target['name']}</b>\n\nNhập bộ lọc (cách nhau "
+        "bởi dấu cách):\n• Khoảng ngày: <code>01/09/2025-30/09/2025</code>"
+        "\n• Tháng: <code>09/2025</code> hoặc 1 ngày: "
+        "<code>15/09/2025</code>\n• Loại: <code>3days</code>, "
+        "<code>2days</code>, <code>1day</code>, <code>0day</code>\n\n"
+        "Hoặc gõ <code>skip</code> để xem 20 lần gần nhất.")
+
+
+def handle_history_flow(chat_id, text):
+    state = SESSIONS.get(chat_id)
+    if state.get("step") == "farm":
+        target = farms_of(chat_id).find_farm(text)
+        if not target:
+            send_message(chat_id, f"❌ Không tìm thấy <b>{text}</b>.")
+            return
+        ask_history_filter(chat_id, target)
+        return
+
+    try:
+        start, end, kind = parse_history_filter(text)
+    except ValueError:
+        send_message(chat_id, "❌ Bộ lọc không hợp lệ, xem ví dụ ở trên.")
+        return
+    SESSIONS.clear(chat_id)
+    target = farms_of(chat_id).farm_by_id(state["farm_id"])
+    if target is None:
+        send_message(chat_id, "❌ Farm đã bị xoá.")
         return
 
-    history = target.get("reminder_history", [])
+    history = HISTORY.farm_history(target, start, end, kind, limit=20)
+    title = f"🕒 <b>Lịch sử nhắc - {target['name']}</b>"
+    if start is not None:
+        title += (f"\n📅 {datetime.strptime(start, '%Y-%m-%d'):%d/%m/%Y} - "
+                  f"{datetime.strptime(end, '%Y-%m-%d'):%d/%m/%Y}")
+    if kind is not None:
+        title += f"\n🔎 {HISTORY_LABELS[kind]}"
     if not history:
-        msg = f"🕒 <b>Lịch sử nhắc - {target['name']}</b>\n\nChưa có lần nhắc nào."
+        msg = f"{title}\n\nChưa có lần nhắc nào."
     else:
-        msg = f"🕒 <b>Lịch sử nhắc - {target['name']}</b>\n\n"
-        for h in sorted(history, key=lambda x: x.get("date", ""),
-                        reverse=True)[:20]:
+        msg = f"{title}\n\n"
+        for h in history:
             t = h.get("type", "")
-            label = {
-                "3days": "Trước 3 ngày",
-                "2days": "Trước 2 ngày",
-                "1day": "Trước 1 ngày",
-                "0day": "Đúng ngày",
-            }.get(t, t)
-            msg += f"• {h.get('date', '')}: {label}\n"
-
-    if str(chat_id) in data["user_states"]:
-        del data["user_states"][str(chat_id)]
-        save_data(data)
+            msg += f"• {h.get('date', '')}: {HISTORY_LABELS.get(t, t)}\n"
     send_message(chat_id, msg)
 
 
 # ================== BACKUP / CSV ==================
 
 
-def handle_backup(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+# gom dữ liệu export thành từng khối ~64KB trước khi gửi
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+def _utf8_chunks(pieces):
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(buf).encode("utf-8")
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf).encode("utf-8")
+
+
+def backup_json_chunks(view):
+    # {"backup_at": ..., "farms": [...]} sinh dần từng farm
+    yield from _utf8_chunks(_backup_json_pieces(view))
+
+
+def _backup_json_pieces(view):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    yield '{\n  "backup_at": ' + json.dumps(now) + ',\n  "farms": ['
+    sep = "\n    "
+    for farm in view.iter_farms():
+        yield sep + json.dumps(farm, ensure_ascii=False)
+        sep = ",\n    "
+    yield "\n  ]\n}\n"
+
+
+CSV_COLUMNS = [
+    "id",
+    "name",
+    "owner_email",
+    "members",
+    "member_count",
+    "start_date",
+    "renewal_day",
+    "next_renewal_date",
+    "days_left",
+    "price",
+    "reminder_enabled",
+    "chat_id",
+]
+
+
+def csv_chunks(view):
+    yield from _utf8_chunks(_csv_pieces(view))
+
+
+def _csv_pieces(view):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(CSV_COLUMNS)
+    today = datetime.now()
+    for x in view.iter_farms():
+        rd = get_next_renewal_date(x.get("renewal_day", 1), from_date=today)
+        members = x.get("members", [])
+        w.writerow([
+            x.get("id", ""),
+            x.get("name", ""),
+            x.get("owner_email", ""),
+            ",".join(members),
+            len(members),
+            x.get("start_date", ""),
+            x.get("renewal_day", ""),
+            rd.strftime("%Y-%m-%d"),
+            (rd.date() - today.date()).days,
+            x.get("price", ""),
+            int(bool(x.get("reminder_enabled", True))),
+            x.get("chat_id", ""),
+        ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def handle_backup(chat_id):
+    view = farms_of(chat_id)
+    if not view.has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu để backup!")
         return
-    backup = {
-        "backup_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "farms": farms,
-    }
     fn = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-    with open(fn, "w", encoding="utf-8") as f:
-        json.dump(backup, f, ensure_ascii=False, indent=2)
-    send_document(chat_id, fn, "💾 Backup dữ liệu farm")
-    os.remove(fn)
+    send_document_stream(chat_id, fn, lambda: backup_json_chunks(view),
+                         "💾 Backup dữ liệu farm", gzip=EXPORT_GZIP)
 
 
-def handle_export_csv(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def handle_export_csv(chat_id):
+    view = farms_of(chat_id)
+    if not view.has_farms():
         send_message(chat_id, "📭 Chưa có dữ liệu để export!")
         return
     fn = f"farms_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    with open(fn, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow([
-            "name",
-            "owner_email",
-            "members",
-            "start_date",
-            "renewal_day",
-            "price",
-            "chat_id",
-        ])
-        for x in farms:
-            w.writerow([
-                x.get("name", ""),
-                x.get("owner_email", ""),
-                ",".join(x.get("members", [])),
-                x.get("start_date", ""),
-                x.get("renewal_day", ""),
-                x.get("price", ""),
-                x.get("chat_id", ""),
-            ])
-    send_document(chat_id, fn, "📤 CSV farms")
-    os.remove(fn)
+    send_document_stream(chat_id, fn, lambda: csv_chunks(view),
+                         "📤 CSV farms", gzip=EXPORT_GZIP)
+
+
+# ================== IMPORT ==================
+
+# cột bắt buộc khi nhập CSV; các cột khác của /xuat_csv (id, số ngày còn
+# lại...) được bỏ qua
+IMPORT_REQUIRED = ("name", "owner_email", "start_date", "renewal_day", "price")
+# số dòng lỗi liệt kê trong tin nhắn, nhiều hơn thì gửi kèm file báo cáo
+IMPORT_REPORT_LINES = 30
+
+
+def parse_import_row(row, chat_id):
+    # 1 dòng CSV / 1 farm JSON -> farm mới, cùng quy tắc với /them_farm;
+    # ValueError nếu không hợp lệ
+    if not isinstance(row, dict):
+        raise ValueError("không phải 1 farm")
+
+    def field(key):
+        value = row.get(key)
+        return "" if value is None else str(value).strip()
+
+    for key in IMPORT_REQUIRED:
+        if not field(key):
+            raise ValueError(f"thiếu {key}")
+    members = row.get("members")
+    if members is None:
+        members = []
+    elif isinstance(members, str):
+        members = [m.strip() for m in members.split(",") if m.strip()]
+    elif not isinstance(members, list) or not all(
+            isinstance(m, str) for m in members):
+        raise ValueError("members phải là danh sách email")
+    if len(members) > 5:
+        raise ValueError("quá 5 thành viên")
+    # /them_farm nhập DD/MM/YYYY, /xuat_csv và /sao_luu ghi YYYY-MM-DD
+    for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            start = datetime.strptime(field("start_date"), fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        raise ValueError(f"ngày bắt đầu sai định dạng: {field('start_date')}")
+    try:
+        day = int(field("renewal_day"))
+    except ValueError:
+        day = 0
+    if not 1 <= day <= 31:
+        raise ValueError("ngày gia hạn phải là số 1-31")
+    try:
+        price = int(field("price").replace(",", "").replace(".", ""))
+    except ValueError:
+        raise ValueError(f"giá không hợp lệ: {field('price')}")
+    history = row.get("reminder_history") or []
+    if not isinstance(history, list) or not all(
+            isinstance(h, dict) and isinstance(h.get("type"), str) and
+            isinstance(h.get("date"), str) and
+            isinstance(h.get("renewal_date", ""), str) for h in history):
+        raise ValueError("reminder_history không hợp lệ")
+    logins = row.get("email_logins") or {}
+    if not isinstance(logins, dict):
+        raise ValueError("email_logins không hợp lệ")
+    for email, login in logins.items():
+        if not isinstance(login, dict) or not isinstance(login.get("enc"), str):
+            raise ValueError(f"login của {email} không hợp lệ")
+    return {
+        "name": field("name"),
+        "owner_email": field("owner_email"),
+        "members": [m.strip() for m in members],
+        "start_date": start.strftime("%Y-%m-%d"),
+        "renewal_day": day,
+        "price": price,
+        "chat_id": chat_id,
+        "reminder_enabled": field("reminder_enabled").lower() not in
+        ("0", "false", "no", "off"),
+        "reminder_history": history,
+        "email_logins": logins,
+    }
+
+
+def import_rows(stream, filename):
+    # (số dòng, farm thô) đọc dần từ file; .gz thì giải nén trên đường đi
+    if filename.endswith(".gz"):
+        stream = gzip.GzipFile(fileobj=stream)
+        filename = filename[:-3]
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if filename.endswith(".json"):
+        # JSON phải đọc hết mới parse được (Telegram giới hạn file 20MB)
+        data = json.load(text)
+        farms = data.get("farms") if isinstance(data, dict) else data
+        if not isinstance(farms, list):
+            raise ValueError("JSON không có danh sách farms")
+        yield from enumerate(farms, 1)
+        return
+    reader = csv.DictReader(text)
+    missing = [c for c in IMPORT_REQUIRED if c not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"thiếu cột {', '.join(missing)}")
+    for row in reader:
+        # dòng 1 là tiêu đề
+        yield reader.line_num, row
+
+
+def import_farms(rows, chat_id):
+    # -> (farm hợp lệ, [(số dòng, lỗi)]); trùng tên với farm đã có của chat
+    # hoặc với dòng trước trong file thì bỏ qua
+    farms, errors, seen = [], [], set()
+    for line, row in rows:
+        try:
+            farm = parse_import_row(row, chat_id)
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+        key = normalize_name(farm["name"])
+        if key in seen or STORE.find_farm(farm["name"],
+                                          owner=chat_id) is not None:
+            errors.append((line, f"trùng tên {farm['name']}"))
+            continue
+        seen.add(key)
+        farms.append(farm)
+    return farms, errors
+
+
+def start_import(chat_id):
+    SESSIONS.set(chat_id, {"action": "import", "step": "upload"})
+    send_message(
+        chat_id, "📥 <b>Nhập farm hàng loạt</b>\n\nGửi file <b>.csv</b> "
+        "(định dạng /xuat_csv) hoặc <b>.json</b> (định dạng /sao_luu), có thể "
+        "nén .gz.\nCột bắt buộc: " + ", ".join(IMPORT_REQUIRED) +
+        "\nNgày bắt đầu dạng DD/MM/YYYY hoặc YYYY-MM-DD.\n\n/huy để bỏ qua.")
+
+
+def handle_import_flow(chat_id, text):
+    send_message(chat_id, "📎 Hãy gửi file CSV/JSON, hoặc /huy để bỏ qua.")
+
+
+def _trim_import_history(farm):
+    # lịch sử nhập vào cũng chỉ giữ HISTORY_KEEP lần gần nhất trong farm; trả
+    # về phần cũ hơn để ghi vào lưu trữ khi farm đã có id
+    history = farm["reminder_history"]
+    if not HISTORY.keep or len(history) <= HISTORY.keep:
+        return []
+    farm["reminder_history"] = history[-HISTORY.keep:]
+    return history[:-HISTORY.keep]
+
+
+def handle_import_document(chat_id, document):
+    filename = (document.get("file_name") or "").lower()
+    if not filename.endswith((".csv", ".json", ".csv.gz", ".json.gz")):
+        send_message(chat_id, "❌ Chỉ nhận file .csv hoặc .json (có thể .gz).")
+        return
+    SESSIONS.clear(chat_id)
+    started = time.perf_counter()
+    try:
+        resp = API.download(document["file_id"])
+    except TelegramError as e:
+        send_message(chat_id, f"❌ Không tải được file: {html.escape(str(e), quote=False)}")
+        return
+    try:
+        with resp:
+            # đọc qua TextIOWrapper: không để urllib3 tự đóng khi hết dữ liệu
+            resp.raw.decode_content = True
+            resp.raw.auto_close = False
+            farms, errors = import_farms(import_rows(resp.raw, filename),
+                                         chat_id)
+    except Exception as e:
+        # file hỏng giữa chừng: không ghi dòng nào
+        send_message(chat_id,
+                     f"❌ Không đọc được file: {html.escape(str(e), quote=False)}")
+        return
+    if farms:
+        overflow = [_trim_import_history(farm) for farm in farms]
+        STORE.add_farms(farms)
+        for farm, old in zip(farms, overflow):
+            if old:
+                HISTORY.append(farm["id"], old)
+    METRICS.inc("bot_import_farms_total", len(farms))
+    msg = (f"📥 Đã nhập <b>{len(farms)}</b> farm, bỏ qua <b>{len(errors)}</b> "
+           f"dòng ({time.perf_counter() - started:.1f}s).")
+    lines = [f"Dòng {line}: {err}" for line, err in errors]
+    if lines:
+        msg += "\n\n" + html.escape("\n".join(lines[:IMPORT_REPORT_LINES]),
+                                    quote=False)
+    send_message(chat_id, msg)
+    if len(lines) > IMPORT_REPORT_LINES:
+        send_document_stream(
+            chat_id, "import_errors.txt",
+            lambda: _utf8_chunks(line + "\n" for line in lines),
+            f"⚠️ {len(lines)} dòng bị bỏ qua")
 
 
 # ================== TOGGLE REMINDER ==================
 
 
-def start_toggle_reminder(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def start_toggle_reminder(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có farm nào!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "toggle_reminder",
         "step": "select",
-    }
-    save_data(data)
-    msg = "🔔 <b>Bật/Tắt nhắc</b>\n\nNhập tên farm:\n\n"
-    for f in farms:
-        st = "ON" if f.get("reminder_enabled", True) else "OFF"
-        msg += f"• {f['name']} - {st}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "toggle")
 
 
-def handle_toggle_reminder_flow(chat_id, text, data):
-    name = text.strip().lower()
-    farms = data.get("farms", [])
-    target = None
-    for f in farms:
-        if f["name"].lower() == name:
-            target = f
-            break
+def handle_toggle_reminder_flow(chat_id, text):
+    target = farms_of(chat_id).find_farm(text)
     if not target:
         send_message(chat_id, f"❌ Không tìm thấy <b>{text}</b>.")
         return
-    cur = target.get("reminder_enabled", True)
-    target["reminder_enabled"] = not cur
-    save_data(data)
-    st = "🔔 ĐÃ BẬT" if target["reminder_enabled"] else "🔕 ĐÃ TẮT"
-    if str(chat_id) in data["user_states"]:
-        del data["user_states"][str(chat_id)]
-        save_data(data)
-    send_message(chat_id, f"✅ {st} nhắc cho <b>{target['name']}</b>.")
+    SESSIONS.clear(chat_id)
+    send_message(chat_id, f"✅ {toggle_reminder(target)}")
+
+
+def toggle_reminder(farm):
+    cur = farm.get("reminder_enabled", True)
+    STORE.update_farm(farm, reminder_enabled=not cur)
+    st = "🔔 ĐÃ BẬT" if farm["reminder_enabled"] else "🔕 ĐÃ TẮT"
+    return f"{st} nhắc cho {farm['name']}"
+
+
+def select_toggle_reminder(chat_id, farm):
+    SESSIONS.clear(chat_id)
+    return toggle_reminder(farm)
+
+
+def handle_toggle_callback(chat_id, message_id, arg):
+    # nút 🔔 trong /xem_farm: đổi rồi vẽ lại chính tin chi tiết đó
+    if not arg.isdigit():
+        return None
+    farm = farms_of(chat_id).farm_by_id(int(arg))
+    if farm is None:
+        return "❌ Farm không còn tồn tại."
+    result = toggle_reminder(farm)
+    text, markup = farm_detail(farm)
+    edit_message(chat_id, message_id, text, reply_markup=markup)
+    return result
 
 
 # ================== LOGIN CHO TỪNG EMAIL TRONG FARM ==================
 
 
-def start_set_mail_login(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def start_set_mail_login(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có farm nào!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "set_mail_login",
         "step": "choose_farm",
-    }
-    save_data(data)
-    msg = "🔐 <b>Lưu mật khẩu / 2FA cho email</b>\n\nNhập <b>tên farm</b>:\n\n"
-    for f in farms:
-        msg += f"• {f['name']}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "set_login")
 
 
-def handle_set_mail_login_flow(chat_id, text, data):
-    state = data["user_states"][str(chat_id)]
+def handle_set_mail_login_flow(chat_id, text):
+    state = SESSIONS.get(chat_id)
     step = state["step"]
 
     if step == "choose_farm":
-        farms = data.get("farms", [])
-        name = text.strip().lower()
-        idx = -1
-        for i, f in enumerate(farms):
-            if f["name"].lower() == name:
-                idx = i
-                break
-        if idx == -1:
+        farm = farms_of(chat_id).find_farm(text)
+        if farm is None:
             send_message(
                 chat_id,
                 f"❌ Không tìm thấy farm <b>{text}</b>. Nhập lại tên farm:")
             return
-        state["farm_index"] = idx
-        farm = farms[idx]
-        emails = [farm["owner_email"]] + farm.get("members", [])
-        state["emails"] = emails
-        state["step"] = "choose_email"
-        save_data(data)
-
-        lst = ""
-        for i, em in enumerate(emails, 1):
-            lst += f"{i}. {em}\n"
-
-        send_message(
-            chat_id,
-            f"✅ Đã chọn farm <b>{farm['name']}</b>\n\nDanh sách email:\n{lst}\nNhập <b>số thứ tự</b> email cần lưu password/2FA:",
-        )
+        choose_login_email(chat_id, farm, "set_mail_login")
 
     elif step == "choose_email":
-        try:
-            idx = int(text.strip())
-        except ValueError:
-            send_message(chat_id, "❌ Vui lòng nhập số thứ tự hợp lệ.")
-            return
-        emails = state.get("emails", [])
-        if not (1 <= idx <= len(emails)):
-            send_message(chat_id, "❌ Số thứ tự không hợp lệ, nhập lại:")
-            return
-        email = emails[idx - 1]
-        state["selected_email"] = email
-        state["step"] = "password"
-        save_data(data)
-        send_message(
-            chat_id,
-            f"📧 Email: <b>{email}</b>\n\nNhập <b>mật khẩu</b> (password):",
-        )
+        email = _chosen_email(chat_id, state, text)
+        if email is not None:
+            ask_login_password(chat_id, state["farm_id"], email)
 
     elif step == "password":
         state["password"] = text.strip()
         state["step"] = "twofa"
-        save_data(data)
+        SESSIONS.set(chat_id, state)
         send_message(
             chat_id,
             "Nhập <b>mã 2FA</b> (hoặc gõ <code>skip</code> nếu không có):")
@@ -940,7 +4112,7 @@ def handle_set_mail_login_flow(chat_id, text, data):
         else:
             state["twofa"] = text.strip()
         state["step"] = "note"
-        save_data(data)
+        SESSIONS.set(chat_id, state)
         send_message(chat_id,
                      "Nhập <b>ghi chú</b> (hoặc gõ <code>skip</code>):")
 
@@ -949,8 +4121,11 @@ def handle_set_mail_login_flow(chat_id, text, data):
         email = state["selected_email"]
         password = state.get("password", "")
         twofa = state.get("twofa", "")
-        farms = data.get("farms", [])
-        farm = farms[state["farm_index"]]
+        farm = farms_of(chat_id).farm_by_id(state["farm_id"])
+        if farm is None:
+            SESSIONS.clear(chat_id)
+            send_message(chat_id, "❌ Farm không còn tồn tại.")
+            return
 
         bundle = {
             "password": password,
@@ -959,13 +4134,9 @@ def handle_set_mail_login_flow(chat_id, text, data):
         }
         enc = encrypt_text(json.dumps(bundle, ensure_ascii=False))
 
-        farm.setdefault("email_logins", {})
-        farm["email_logins"][email] = {"enc": enc}
-        save_data(data)
+        STORE.set_email_login(farm, email, {"enc": enc, "kid": KEY_ID})
 
-        if str(chat_id) in data["user_states"]:
-            del data["user_states"][str(chat_id)]
-            save_data(data)
+        SESSIONS.clear(chat_id)
 
         send_message(
             chat_id,
@@ -977,301 +4148,1074 @@ Dùng /get_mail_login để xem lại khi cần.""",
         )
 
 
-def start_get_mail_login(chat_id, data):
-    farms = data.get("farms", [])
-    if not farms:
+def choose_login_email(chat_id, farm, action):
+    # bước chọn email chung của /set_mail_login và /get_mail_login
+    emails = [farm["owner_email"]] + farm.get("members", [])
+    SESSIONS.set(chat_id, {
+        "action": action,
+        "step": "choose_email",
+        "farm_id": farm["id"],
+        "emails": emails,
+    })
+    mode, purpose = (("set", "cần lưu password/2FA")
+                     if action == "set_mail_login" else
+                     ("get", "cần xem login"))
+    lst = ""
+    for i, em in enumerate(emails, 1):
+        lst += f"{i}. {em}\n"
+    buttons = [[{
+        "text": f"{i}. {em}",
+        "callback_data": f"ml:{mode}:{farm['id']}:{i}"
+    }] for i, em in enumerate(emails, 1)]
+    send_message(
+        chat_id,
+        f"✅ Đã chọn farm <b>{farm['name']}</b>\n\nDanh sách email:\n{lst}\n"
+        f"Bấm hoặc nhập <b>số thứ tự</b> email {purpose}:",
+        reply_markup={"inline_keyboard": buttons},
+    )
+
+
+def _chosen_email(chat_id, state, text):
+    try:
+        idx = int(text.strip())
+    except ValueError:
+        send_message(chat_id, "❌ Vui lòng nhập số thứ tự hợp lệ.")
+        return None
+    emails = state.get("emails", [])
+    if not (1 <= idx <= len(emails)):
+        send_message(chat_id, "❌ Số thứ tự không hợp lệ, nhập lại:")
+        return None
+    return emails[idx - 1]
+
+
+def ask_login_password(chat_id, farm_id, email):
+    SESSIONS.set(chat_id, {
+        "action": "set_mail_login",
+        "step": "password",
+        "farm_id": farm_id,
+        "selected_email": email,
+    })
+    send_message(
+        chat_id,
+        f"📧 Email: <b>{email}</b>\n\nNhập <b>mật khẩu</b> (password):",
+    )
+
+
+def handle_login_callback(chat_id, message_id, arg):
+    # "ml:set|get:<id farm>:<số thứ tự email>"
+    mode, _, rest = arg.partition(":")
+    ids = _callback_ids(rest, 2)
+    if mode not in ("set", "get") or ids is None:
+        return None
+    farm = farms_of(chat_id).farm_by_id(ids[0])
+    if farm is None:
+        return "❌ Farm không còn tồn tại."
+    emails = [farm["owner_email"]] + farm.get("members", [])
+    if not 1 <= ids[1] <= len(emails):
+        return "❌ Email không còn trong farm."
+    email = emails[ids[1] - 1]
+    if mode == "set":
+        ask_login_password(chat_id, farm["id"], email)
+    else:
+        show_login(chat_id, farm, email)
+    return None
+
+
+def start_get_mail_login(chat_id):
+    if not farms_of(chat_id).has_farms():
         send_message(chat_id, "📭 Chưa có farm nào!")
         return
-    data["user_states"][str(chat_id)] = {
+    SESSIONS.set(chat_id, {
         "action": "get_mail_login",
         "step": "choose_farm",
-    }
-    save_data(data)
-    msg = "🔎 <b>Xem login email</b>\n\nNhập <b>tên farm</b>:\n\n"
-    for f in farms:
-        msg += f"• {f['name']}\n"
-    send_message(chat_id, msg)
+    })
+    send_page(chat_id, "get_login")
 
 
-def handle_get_mail_login_flow(chat_id, text, data):
-    state = data["user_states"][str(chat_id)]
+def handle_get_mail_login_flow(chat_id, text):
+    state = SESSIONS.get(chat_id)
     step = state["step"]
 
     if step == "choose_farm":
-        farms = data.get("farms", [])
-        name = text.strip().lower()
-        idx = -1
-        for i, f in enumerate(farms):
-            if f["name"].lower() == name:
-                idx = i
-                break
-        if idx == -1:
+        farm = farms_of(chat_id).find_farm(text)
+        if farm is None:
             send_message(
                 chat_id,
                 f"❌ Không tìm thấy farm <b>{text}</b>. Nhập lại tên farm:")
             return
-        state["farm_index"] = idx
-        farm = farms[idx]
-        emails = [farm["owner_email"]] + farm.get("members", [])
-        state["emails"] = emails
-        state["step"] = "choose_email"
-        save_data(data)
-
-        lst = ""
-        for i, em in enumerate(emails, 1):
-            lst += f"{i}. {em}\n"
-        send_message(
-            chat_id,
-            f"✅ Đã chọn farm <b>{farm['name']}</b>\n\nDanh sách email:\n{lst}\nNhập <b>số thứ tự</b> email cần xem login:",
-        )
+        choose_login_email(chat_id, farm, "get_mail_login")
 
     elif step == "choose_email":
-        try:
-            idx = int(text.strip())
-        except ValueError:
-            send_message(chat_id, "❌ Vui lòng nhập số thứ tự hợp lệ.")
-            return
-        emails = state.get("emails", [])
-        if not (1 <= idx <= len(emails)):
-            send_message(chat_id, "❌ Số thứ tự không hợp lệ, nhập lại:")
-            return
-        email = emails[idx - 1]
-        farms = data.get("farms", [])
-        farm = farms[state["farm_index"]]
-        email_logins = farm.get("email_logins", {})
-        entry = email_logins.get(email)
-
-        if str(chat_id) in data.get("user_states", {}):
-            del data["user_states"][str(chat_id)]
-            save_data(data)
-
-        if not entry:
-            send_message(chat_id, f"❌ Chưa lưu login cho <b>{email}</b>.")
-            return
+        email = _chosen_email(chat_id, state, text)
+        if email is not None:
+            show_login(chat_id, farms_of(chat_id).farm_by_id(state["farm_id"]) or {
+                "id": state["farm_id"]
+            }, email)
 
-        try:
-            decoded = decrypt_text(entry["enc"])
-            bundle = json.loads(decoded)
-        except Exception as e:
-            print("Lỗi giải mã email_login:", e)
-            send_message(chat_id,
-                         "❌ Lỗi giải mã dữ liệu. Kiểm tra MASTER_SECRET.")
-            return
 
-        password = bundle.get("password", "")
-        twofa = bundle.get("twofa", "")
-        note = bundle.get("note", "")
+def show_login(chat_id, farm, email):
+    entry = farm.get("email_logins", {}).get(email)
+
+    SESSIONS.clear(chat_id)
+
+    if not entry:
+        send_message(chat_id, f"❌ Chưa lưu login cho <b>{email}</b>.")
+        return
+
+    try:
+        bundle = decrypt_login(farm["id"], email, entry["enc"])
+    except Exception as e:
+        print("Lỗi giải mã email_login:", e)
+        send_message(chat_id,
+                     "❌ Lỗi giải mã dữ liệu. Kiểm tra MASTER_SECRET.")
+        return
+
+    password = bundle.get("password", "")
+    twofa = bundle.get("twofa", "")
+    note = bundle.get("note", "")
 
-        msg = f"""🔐 <b>Login cho email</b>
+    msg = f"""🔐 <b>Login cho email</b>
 
 📧 Email: <b>{email}</b>
 🔑 Mật khẩu: <code>{password}</code>
 🛡 2FA: <code>{twofa}</code>
 📝 Ghi chú: {note if note else "(Không có)"}
 
-👉 Bạn có thể copy trực tiếp trong Telegram.
+👉 Bấm nút bên dưới để copy.
 """
-        send_message(chat_id, msg)
+    buttons = [copy_button("📋 Copy Email", email)]
+    if password:
+        buttons.append(copy_button("📋 Copy Password", password))
+    if twofa:
+        buttons.append(copy_button("📋 Copy 2FA", twofa))
+    send_message(chat_id, msg, reply_markup={"inline_keyboard": [buttons]})
 
 
 # ================== CANCEL ==================
 
 
-def cancel_action(chat_id, data):
-    if str(chat_id) in data.get("user_states", {}):
-        del data["user_states"][str(chat_id)]
-        save_data(data)
+def cancel_action(chat_id):
+    if SESSIONS.get(chat_id) is not None:
+        SESSIONS.clear(chat_id)
         send_message(chat_id, "✅ Đã huỷ thao tác hiện tại.")
     else:
         send_message(chat_id, "ℹ️ Không có thao tác nào cần hủy.")
 
 
-# ================== REMINDER LOOP ==================
+# ================== ADMIN ==================
 
+ROTATION_LOCK = threading.Lock()
 
-def check_and_send_reminders(data):
-    today = datetime.now().date()
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    changed = False
-
-    for f in data.get("farms", []):
-        if not f.get("reminder_enabled", True):
-            continue
-        rd = get_next_renewal_date(f.get("renewal_day", 1)).date()
-        diff = (rd - today).days
 
-        chat_id = f.get("chat_id")
-        if not chat_id:
-            continue
+def handle_rotate_keys(chat_id):
+    if str(chat_id) not in ADMIN_CHAT_IDS:
+        send_message(chat_id, "⛔ Lệnh chỉ dành cho admin (ADMIN_CHAT_IDS).")
+        return
+    if not ROTATION_LOCK.acquire(blocking=False):
+        send_message(chat_id, "⏳ Đang xoay khoá, vui lòng chờ.")
+        return
 
-        def add_hist(kind):
-            hist = f.get("reminder_history", [])
-            hist.append({
-                "type": kind,
-                "date": today_str,
-                "renewal_date": rd.strftime("%Y-%m-%d"),
-            })
-            f["reminder_history"] = hist
-
-        # 3 days
-        if diff == 3 and f.get("last3") != today_str:
-            send_message(chat_id,
-                         f"⏰ <b>{f['name']}</b> còn <b>3 ngày</b> đến hạn.")
-            f["last3"] = today_str
-            add_hist("3days")
-            changed = True
+    def run():
+        try:
+            state = rotate_keys()
+            send_message(
+                chat_id, f"✅ Xoay khoá xong (kid {state['kid']}): "
+                f"{state['rotated']} login mã hoá lại, "
+                f"{state['failed']} không giải mã được.")
+        except Exception as e:
+            print("Lỗi xoay khoá:", e)
+            send_message(chat_id, f"❌ Xoay khoá lỗi: {e}\nGửi lại "
+                         "/xoay_khoa để chạy tiếp từ mốc đã lưu.")
+        finally:
+            ROTATION_LOCK.release()
+
+    # chạy nền: vòng xử lý tin nhắn không phải chờ
+    threading.Thread(target=run, daemon=True).start()
+    send_message(chat_id,
+                 "🔄 Bắt đầu mã hoá lại login bằng MASTER_SECRET mới...")
 
-        # 2 days
-        if diff == 2 and f.get("last2") != today_str:
-            send_message(chat_id,
-                         f"⏰ <b>{f['name']}</b> còn <b>2 ngày</b> đến hạn.")
-            f["last2"] = today_str
-            add_hist("2days")
-            changed = True
 
-        # 1 day
-        if diff == 1 and f.get("last1") != today_str:
-            send_message(chat_id,
-                         f"🔔 <b>{f['name']}</b> còn <b>1 ngày</b> đến hạn.")
-            f["last1"] = today_str
-            add_hist("1day")
-            changed = True
+def handle_all_tenants(chat_id):
+    # bật/tắt chế độ xem farm của mọi chat (mặc định chỉ farm của chat mình)
+    key = str(chat_id)
+    if key not in ADMIN_CHAT_IDS:
+        send_message(chat_id, "⛔ Lệnh chỉ dành cho admin (ADMIN_CHAT_IDS).")
+        return
+    if scope_of(chat_id) is not None:
+        ALL_TENANT_CHATS.add(key)
+        msg = ("🌐 Đang xem farm của <b>mọi chat</b>. Danh sách, tìm kiếm, "
+               "báo cáo và sửa/xoá áp dụng cho tất cả.\nGửi lại /xem_tat_ca "
+               "để trở về farm của chat này.")
+    else:
+        ALL_TENANT_CHATS.discard(key)
+        msg = "👤 Đã trở về chỉ xem farm của chat này."
+    send_message(chat_id, msg)
 
-        # today
-        if diff == 0 and f.get("last0") != today_str:
-            send_message(chat_id,
-                         f"🚨 <b>{f['name']}</b> HÔM NAY đến hạn thanh toán!")
-            f["last0"] = today_str
-            add_hist("0day")
-            changed = True
 
-    if changed:
-        save_data(data)
+def start_restore(chat_id):
+    if str(chat_id) not in ADMIN_CHAT_IDS:
+        send_message(chat_id, "⛔ Lệnh chỉ dành cho admin (ADMIN_CHAT_IDS).")
+        return
+    names = BACKUPS.list_manifests()[-10:]
+    if not names:
+        send_message(chat_id, "📭 Chưa có bản sao lưu nào.")
+        return
+    SESSIONS.set(chat_id, {
+        "action": "restore",
+        "step": "select",
+        "names": names,
+    })
+    msg = "♻️ <b>Khôi phục dữ liệu</b>\n\nNhập <b>số thứ tự</b> bản sao lưu:\n\n"
+    for i, name in enumerate(names, 1):
+        msg += f"{i}. {name[:-5]}\n"
+    send_message(chat_id, msg + "\n/huy để bỏ qua.")
+
+
+def handle_restore_flow(chat_id, text):
+    names = SESSIONS.get(chat_id)["names"]
+    if not text.isdigit() or not 1 <= int(text) <= len(names):
+        send_message(chat_id, f"❌ Nhập số từ 1 đến {len(names)}.")
+        return
+    SESSIONS.clear(chat_id)
+    name = names[int(text) - 1]
+    try:
+        count = BACKUPS.restore(name)
+    except BackupError as e:
+        send_message(chat_id, f"❌ Bản sao lưu không hợp lệ, giữ nguyên dữ "
+                     f"liệu hiện tại: {e}")
+        return
+    send_message(chat_id, f"✅ Đã khôi phục {count} farm từ <b>{name[:-5]}</b>.")
 
 
-# ================== MAIN LOOP ==================
+# ================== REMINDER SCHEDULER ==================
 
+# (số ngày trước hạn, loại ghi vào reminder_history)
+REMINDER_KINDS = ((3, "3days"), (2, "2days"), (1, "1day"), (0, "0day"))
+REMINDER_KIND_NAMES = dict(REMINDER_KINDS)
 
-def main():
-    print("🤖 Bot nhắc hạn đang chạy...")
-    offset = None
-    last_check = datetime.now()
-    data = load_data()
 
+def next_reminder_event(farm, after):
+    # (giờ gửi, số ngày trước hạn, ngày đến hạn) của lần nhắc kế tiếp > after
+    day = after.date()
     while True:
+        rd = get_next_renewal_date(farm.get("renewal_day", 1),
+                                   from_date=datetime.combine(day,
+                                                              dt_time())).date()
+        for days_before, _ in REMINDER_KINDS:
+            fire_at = datetime.combine(rd - timedelta(days=days_before),
+                                       dt_time(REMINDER_HOUR))
+            if fire_at > after:
+                return fire_at, days_before, rd
+        day = rd + timedelta(days=1)
+
+
+def _reminder_text(farm, days_before, rd, event_day, today):
+    remaining = (rd - today).days
+    if event_day < today:
+        # nhắc bù cho lần nhắc bị lỡ khi bot không chạy
+        rd_str = rd.strftime("%d/%m/%Y")
+        if remaining >= 0:
+            return (f"⏰ (Nhắc bù) <b>{farm['name']}</b> còn <b>{remaining} "
+                    f"ngày</b> đến hạn ({rd_str}).")
+        return (f"🚨 (Nhắc bù) <b>{farm['name']}</b> đã đến hạn thanh toán "
+                f"ngày {rd_str}!")
+    if days_before == 0:
+        return f"🚨 <b>{farm['name']}</b> HÔM NAY đến hạn thanh toán!"
+    if days_before == 1:
+        return f"🔔 <b>{farm['name']}</b> còn <b>1 ngày</b> đến hạn."
+    return f"⏰ <b>{farm['name']}</b> còn <b>{days_before} ngày</b> đến hạn."
+
+
+def _reminder_pending(farm, days_before, event_day):
+    if not farm.get("chat_id"):
+        return False
+    return farm.get(f"last{days_before}") != event_day.strftime("%Y-%m-%d")
+
+
+def _record_reminder(farm, days_before, rd, event_day, today):
+    STORE.update_farm(farm, **{
+        f"last{days_before}": event_day.strftime("%Y-%m-%d")
+    })
+    STORE.add_history(farm, {
+        "type": REMINDER_KIND_NAMES[days_before],
+        "date": today.strftime("%Y-%m-%d"),
+        "renewal_date": rd.strftime("%Y-%m-%d"),
+    })
+
+
+def send_reminder(farm, days_before, rd, event_day, today):
+    if not _reminder_pending(farm, days_before, event_day):
+        return
+    send_message(farm["chat_id"],
+                 _reminder_text(farm, days_before, rd, event_day, today),
+                 priority=OutboundQueue.BULK,
+                 wait=False)
+    _record_reminder(farm, days_before, rd, event_day, today)
+
+
+def send_reminder_digest(chat_id, events, today):
+    # events: [(farm, days_before, rd, event_day)] cùng 1 chat trong 1 lượt;
+    # gửi 1 (hoặc vài, nếu quá 4096 ký tự) tin tổng hợp thay vì mỗi farm 1 tin
+    events = sorted(events, key=lambda e: (e[2], e[0]["name"]))
+    total = sum(e[0].get("price", 0) for e in events)
+    lines = [f"• {_reminder_text(f, n, rd, day, today)}"
+             for f, n, rd, day in events]
+    title = f"🔔 <b>Nhắc hạn: {len(events)} farm</b>"
+    summary = f"💰 Tổng: <b>{total:,} VNĐ</b>"
+    # chừa chỗ cho "(i/n)" và các dòng trống
+    parts = split_message(lines, reserve=message_length(title + summary) + 16)
+    for i, body in enumerate(parts, 1):
+        page = f" ({i}/{len(parts)})" if len(parts) > 1 else ""
+        send_message(chat_id,
+                     f"{title}{page}\n{summary}\n\n{body}",
+                     priority=OutboundQueue.BULK,
+                     wait=False)
+    for f, n, rd, day in events:
+        _record_reminder(f, n, rd, day, today)
+
+
+def send_reminders(events, today):
+    by_chat = {}
+    for farm, days_before, rd, event_day in events:
+        if _reminder_pending(farm, days_before, event_day):
+            by_chat.setdefault(farm["chat_id"], []).append(
+                (farm, days_before, rd, event_day))
+    for chat_id, items in by_chat.items():
+        if REMINDER_DIGEST and len(items) > 1:
+            send_reminder_digest(chat_id, items, today)
+        else:
+            for item in items:
+                send_reminder(*item, today)
+
+
+class ReminderScheduler:
+    # Thread riêng giữ min-heap (giờ gửi, farm, loại nhắc) và ngủ đúng tới sự
+    # kiện gần nhất, không phụ thuộc vòng long-poll getUpdates. Mốc đã xử lý
+    # được lưu vào meta "reminder_checkpoint" để nhắc bù sau khi bot tắt.
+
+    # ngủ tối đa chừng này giây mỗi lần: nhịp sống cho /readyz, và phòng khi
+    # đồng hồ hệ thống bị chỉnh
+    WAKE_SECONDS = 60
+
+    def __init__(self, store):
+        self.store = store
+        self._heap = []
+        self._version = {}
+        self._cond = threading.Condition()
+        self._dirty = set()
+        self._rebuild_needed = True
+        self._thread = None
+        store.watch(("renewal_day", "reminder_enabled"), self._on_change)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _on_change(self, farm_id):
+        # gọi từ thread của handler (đang giữ lock của store): chỉ đánh dấu,
+        # việc tính lại làm trong thread scheduler.
+        with self._cond:
+            if farm_id is None:
+                self._rebuild_needed = True
+            else:
+                self._dirty.add(farm_id)
+            self._cond.notify()
+
+    def _checkpoint(self):
+        now = datetime.now()
+        value = self.store.get_meta("reminder_checkpoint")
+        if value:
+            after = datetime.fromisoformat(value)
+        else:
+            after = now - timedelta(days=1)
+        # quá 1 chu kỳ tháng thì nhắc bù cũng không còn ý nghĩa
+        return max(after, now - timedelta(days=31))
+
+    def _schedule(self, farm_id, after):
+        version = self._version.get(farm_id, 0) + 1
+        self._version[farm_id] = version
+        farm = self.store.farm_by_id(farm_id)
+        if farm is None or not farm.get("reminder_enabled", True):
+            return
+        fire_at, days_before, rd = next_reminder_event(farm, after)
+        heapq.heappush(self._heap,
+                       (fire_at, farm_id, version, days_before, rd))
+
+    def _rebuild(self):
+        after = self._checkpoint()
+        self._heap = []
+        farms = self.store.farms()
+        for farm in farms:
+            self._version[farm["id"]] = self._version.get(farm["id"], 0) + 1
+            if not farm.get("reminder_enabled", True):
+                continue
+            fire_at, days_before, rd = next_reminder_event(farm, after)
+            self._heap.append((fire_at, farm["id"], self._version[farm["id"]],
+                               days_before, rd))
+        heapq.heapify(self._heap)
+        METRICS.inc("bot_reminder_farms_scanned_total", len(farms))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._rebuild_needed or self._dirty or
+                           (self._heap and self._heap[0][0] <= datetime.now())):
+                    HEALTH.mark("reminder_pass")
+                    timeout = self.WAKE_SECONDS
+                    if self._heap:
+                        timeout = (self._heap[0][0] -
+                                   datetime.now()).total_seconds()
+                        timeout = min(max(timeout, 0), self.WAKE_SECONDS)
+                    self._cond.wait(timeout)
+                rebuild, self._rebuild_needed = self._rebuild_needed, False
+                dirty, self._dirty = self._dirty, set()
+            started = time.perf_counter()
+            try:
+                if rebuild:
+                    self._rebuild()
+                    dirty = ()
+                # farm vừa sửa: tính lại từ đầu ngày để không lỡ lần nhắc hôm nay
+                start_of_day = datetime.combine(datetime.now().date(),
+                                                dt_time()) - timedelta(seconds=1)
+                for farm_id in dirty:
+                    self._schedule(farm_id, start_of_day)
+                self._fire_due()
+                METRICS.observe("bot_reminder_pass_seconds",
+                                time.perf_counter() - started)
+                HEALTH.mark("reminder_pass")
+            except Exception as e:
+                print("Lỗi scheduler nhắc hạn:", e)
+                time.sleep(5)
+
+    def _fire_due(self):
         now = datetime.now()
-        if (now - last_check).seconds >= 3600:
-            data = load_data()
-            check_and_send_reminders(data)
-            last_check = now
+        today = now.date()
+        fired = False
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, farm_id, version, days_before, rd = heapq.heappop(
+                self._heap)
+            if self._version.get(farm_id) != version:
+                continue
+            METRICS.inc("bot_reminder_farms_scanned_total")
+            farm = self.store.farm_by_id(farm_id)
+            if farm is None or not farm.get("reminder_enabled", True):
+                continue
+            nxt = next_reminder_event(farm, fire_at)
+            heapq.heappush(self._heap, (nxt[0], farm_id, version, nxt[1],
+                                        nxt[2]))
+            fired = True
+            if nxt[0] <= now:
+                # đã có lần nhắc mới hơn cũng tới giờ: bỏ lần cũ
+                continue
+            if fire_at.date() < today and nxt[0].date() == today:
+                # lỡ hôm trước nhưng hôm nay vẫn có lần nhắc đúng hạn
+                continue
+            due.append((farm, days_before, rd, fire_at.date()))
+        if due:
+            METRICS.inc("bot_reminder_farms_due_total", len(due))
+        send_reminders(due, today)
+        if fired:
+            self.store.set_meta("reminder_checkpoint", now.isoformat())
+
+
+SCHEDULER = None if SPAWN_CHILD else ReminderScheduler(STORE)
+
+
+# ================== UPDATE DISPATCH ==================
+
+
+def update_chat_id(update):
+    msg = update.get("message") or (update.get("callback_query") or {}).get(
+        "message")
+    if msg:
+        return msg["chat"]["id"]
+    return None
+
+
+class Router:
+    # Bảng định tuyến thay cho chuỗi if/elif: lệnh /... và chữ trên nút bàn
+    # phím -> handler(chat_id); action của flow đang dở -> handler(chat_id,
+    # text); file gửi lên (kèm caption là lệnh hoặc khi đang ở flow) ->
+    # handler(chat_id, document). Mỗi lần gọi handler đi qua chuỗi middleware
+    # mw(ctx, call_next).
+
+    def __init__(self):
+        self.commands = {}
+        self.flows = {}
+        self.documents = {}
+        self.callbacks = {}
+        self.middleware = []
+        self.fallback = None
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+
+    def command(self, handler, *texts):
+        for text in texts:
+            self.commands[text] = handler
+
+    def flow(self, action, handler):
+        self.flows[action] = handler
+
+    def document(self, action, handler, *captions):
+        for key in (action, ) + captions:
+            self.documents[key] = handler
+
+    def callback(self, prefix, handler):
+        # nút inline có callback_data "<prefix>:<arg>" -> handler(chat_id,
+        # message_id, arg); handler trả về chuỗi thì hiện thành thông báo nhỏ
+        self.callbacks[prefix] = handler
+
+    def use(self, middleware):
+        self.middleware.append(middleware)
+
+    def resolve(self, chat_id, text):
+        handler = self.commands.get(text)
+        if handler is not None:
+            return handler, (chat_id, )
+        state = SESSIONS.get(chat_id)
+        if state is not None:
+            handler = self.flows.get(state.get("action"))
+            if handler is None:
+                return None, ()
+            return handler, (chat_id, text)
+        return self.fallback, (chat_id, )
+
+    def resolve_document(self, chat_id, caption, document):
+        handler = self.documents.get(caption)
+        if handler is None:
+            state = SESSIONS.get(chat_id)
+            handler = self.documents.get((state or {}).get("action"))
+        if handler is None:
+            return self.resolve(chat_id, caption)
+        return handler, (chat_id, document)
+
+    def dispatch(self, update):
+        METRICS.inc("bot_updates_total")
+        if "callback_query" in update:
+            self.dispatch_callback(update["callback_query"])
+            return
+        msg = update.get("message")
+        if not msg:
+            return
+        chat_id = msg["chat"]["id"]
+        text = msg.get("text", "")
+        if not isinstance(text, str):
+            return
+        text = text.strip()
+        if "document" in msg:
+            text = msg.get("caption", "").strip()
+            handler, args = self.resolve_document(chat_id, text,
+                                                  msg["document"])
+        else:
+            handler, args = self.resolve(chat_id, text)
+        if handler is None:
+            return
+        ctx = {"chat_id": chat_id, "text": text, "handler": handler.__name__}
+        self._run(ctx, lambda: handler(*args))
 
+    def dispatch_callback(self, query):
+        msg = query.get("message")
+        if not msg:
+            return
+        chat_id = msg["chat"]["id"]
+        data = query.get("data", "")
+        prefix, _, arg = data.partition(":")
+        handler = self.callbacks.get(prefix)
+        result = []
+        if handler is not None:
+            ctx = {"chat_id": chat_id, "text": data,
+                   "handler": handler.__name__}
+            self._run(
+                ctx, lambda: result.append(
+                    handler(chat_id, msg["message_id"], arg)))
+        answer_callback(chat_id, query["id"], result[0] if result else None)
+
+    def _run(self, ctx, call):
+        for mw in reversed(self.middleware):
+            call = functools.partial(mw, ctx, call)
+        call()
+
+    def observe(self, name, seconds, error=False):
+        with self._lock:
+            hist = self.latency.get(name)
+            if hist is None:
+                hist = self.latency[name] = Histogram()
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        hist.observe(seconds)
+
+    def stats(self):
+        # [(handler, số lần gọi, p50, p95, tổng giây, số lỗi)], nhiều lần nhất trước
+        with self._lock:
+            items = list(self.latency.items())
+            errors = dict(self.errors)
+        rows = []
+        for name, hist in items:
+            _, total, count = hist.snapshot()
+            rows.append((name, count, hist.quantile(0.5), hist.quantile(0.95),
+                         total, errors.get(name, 0)))
+        rows.sort(key=lambda r: -r[1])
+        return rows
+
+
+def timing_middleware(ctx, call_next):
+    started = time.perf_counter()
+    error = True
+    try:
+        call_next()
+        error = False
+    finally:
+        ROUTER.observe(ctx["handler"], time.perf_counter() - started, error)
+
+
+def error_middleware(ctx, call_next):
+    # 1 handler lỗi không được làm chết worker của chat
+    try:
+        call_next()
+    except Exception as e:
+        print(f"Lỗi {ctx['handler']} (chat {ctx['chat_id']}):", repr(e))
+        send_message(ctx["chat_id"], "⚠️ Có lỗi khi xử lý, vui lòng thử lại.")
+
+
+class ChatLocks:
+    # 1 khoá riêng cho mỗi chat, tạo khi cần và bỏ khi không còn thread nào
+    # giữ/chờ: handler chậm của 1 chat không chặn chat khác. ChatDispatcher đã
+    # xử lý tuần tự từng chat, khoá này giữ đúng điều đó cho cả các đường gọi
+    # handler khác.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, chat_id):
+        key = str(chat_id)
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                # [khoá, số thread đang giữ hoặc chờ]
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
         try:
-            updates = get_updates(offset)
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+
+CHAT_LOCKS = ChatLocks()
+
+
+def chat_lock_middleware(ctx, call_next):
+    with CHAT_LOCKS.hold(ctx["chat_id"]):
+        call_next()
+
+
+def handle_performance(chat_id):
+    rows = ROUTER.stats()
+    if not rows:
+        send_message(chat_id, "⏱ Chưa có số liệu.")
+        return
+    msg = "⏱ <b>Thời gian xử lý lệnh</b> (p50 / p95)\n\n"
+    for name, count, p50, p95, _, errors in rows:
+        err = f" - ⚠️ {errors} lỗi" if errors else ""
+        msg += f"• {name}: {count} lần - ≤{p50 * 1000:g}ms / ≤{p95 * 1000:g}ms{err}\n"
+    send_message(chat_id, msg)
+
+
+def handle_unknown(chat_id):
+    send_message(chat_id, "❌ Lệnh không hợp lệ. Gửi /help để xem hướng dẫn.")
+
+
+ROUTER = Router()
+ROUTER.command(handle_start, "/start")
+ROUTER.command(handle_help, "/help")
+ROUTER.command(start_add_farm, "/them_farm", "➕ Thêm")
+ROUTER.command(handle_list_farms, "/danh_sach", "📋 Danh sách")
+ROUTER.command(start_view_farm, "/xem_farm")
+ROUTER.command(start_edit_farm, "/sua_farm")
+ROUTER.command(start_delete_farm, "/xoa_farm")
+ROUTER.command(start_search_farm, "/tim_farm")
+ROUTER.command(handle_statistics, "/thong_ke", "📊 Thống kê")
+ROUTER.command(handle_daily_report, "/bao_cao_ngay", "📅 Báo cáo hôm nay")
+ROUTER.command(handle_weekly_report, "/bao_cao_tuan", "📆 Báo cáo tuần")
+ROUTER.command(start_history, "/lich_su")
+ROUTER.command(handle_backup, "/sao_luu", "💾 Sao lưu")
+ROUTER.command(handle_export_csv, "/xuat_csv", "📤 Xuất CSV")
+ROUTER.command(start_import, "/nhap_du_lieu")
+ROUTER.command(start_toggle_reminder, "/bat_tat_nhac", "🔔 Bật/Tắt nhắc")
+ROUTER.command(start_set_mail_login, "/set_mail_login")
+ROUTER.command(start_get_mail_login, "/get_mail_login")
+ROUTER.command(cancel_action, "/huy")
+ROUTER.command(handle_performance, "/hieu_nang")
+ROUTER.command(handle_rotate_keys, "/xoay_khoa")
+ROUTER.command(start_restore, "/khoi_phuc")
+ROUTER.command(handle_all_tenants, "/xem_tat_ca")
+
+ROUTER.flow("add_farm", handle_add_farm_flow)
+ROUTER.flow("view_farm", handle_view_farm_flow)
+ROUTER.flow("edit_farm", handle_edit_farm_flow)
+ROUTER.flow("delete_farm", handle_delete_farm_flow)
+ROUTER.flow("search_farm", handle_search_farm_flow)
+ROUTER.flow("toggle_reminder", handle_toggle_reminder_flow)
+ROUTER.flow("history", handle_history_flow)
+ROUTER.flow("set_mail_login", handle_set_mail_login_flow)
+ROUTER.flow("get_mail_login", handle_get_mail_login_flow)
+ROUTER.flow("restore", handle_restore_flow)
+ROUTER.callback("pg", handle_page_callback)
+ROUTER.callback("sel", handle_select_callback)
+ROUTER.callback("ed", handle_edit_callback)
+ROUTER.callback("del", handle_delete_callback)
+ROUTER.callback("tg", handle_toggle_callback)
+ROUTER.callback("ml", handle_login_callback)
+
+# nút chọn farm trên trang danh sách (sel:<loại>:...) -> việc làm với farm đó
+SELECT_ACTIONS = {
+    "view": show_farm,
+    "edit": ask_edit_field,
+    "delete": confirm_delete,
+    "history": ask_history_filter,
+    "toggle": select_toggle_reminder,
+    "set_login": lambda chat_id, farm: choose_login_email(
+        chat_id, farm, "set_mail_login"),
+    "get_login": lambda chat_id, farm: choose_login_email(
+        chat_id, farm, "get_mail_login"),
+}
+ROUTER.flow("import", handle_import_flow)
+ROUTER.document("import", handle_import_document, "/nhap_du_lieu")
+ROUTER.fallback = handle_unknown
+
+ROUTER.use(error_middleware)
+# đo thời gian bên trong khoá chat: không tính thời gian chờ khoá
+ROUTER.use(chat_lock_middleware)
+ROUTER.use(timing_middleware)
+
+
+def handle_update(u):
+    ROUTER.dispatch(u)
+
+
+def _collect_runtime():
+    with ROUTER._lock:
+        handlers = list(ROUTER.latency.items())
+        handler_errors = list(ROUTER.errors.items())
+    with API._lock:
+        methods = list(API.latency.items())
+        method_errors = list(API.errors.items())
+    lanes = OUTBOX.depth()
+    return [
+        ("bot_handler_seconds", "histogram", "Thời gian xử lý theo handler",
+         [({"handler": n}, h) for n, h in handlers]),
+        ("bot_handler_errors_total", "counter", "Số lần handler lỗi",
+         [({"handler": n}, c) for n, c in handler_errors]),
+        ("bot_telegram_api_seconds", "histogram",
+         "Thời gian gọi Bot API theo method (mỗi lần thử)",
+         [({"method": n}, h) for n, h in methods]),
+        ("bot_telegram_api_errors_total", "counter",
+         "Số lần gọi Bot API lỗi theo method",
+         [({"method": n}, c) for n, c in method_errors]),
+        ("bot_outbound_queue_depth", "gauge", "Số tin đang chờ gửi",
+         [({"lane": "interactive"}, lanes[0]), ({"lane": "bulk"}, lanes[1])]),
+        ("bot_sessions", "gauge", "Số phiên hội thoại đang mở",
+         [({}, len(SESSIONS))]),
+        ("bot_sessions_dropped_total", "counter",
+         "Số phiên bị bỏ do hết hạn / vượt SESSION_MAX",
+         [({"reason": "expired"}, SESSIONS.expired),
+          ({"reason": "evicted"}, SESSIONS.evicted)]),
+        ("bot_credential_cache_requests_total", "counter",
+         "Số lần tra cache login đã giải mã",
+         [({"result": "hit"}, CRED_CACHE.hits),
+          ({"result": "miss"}, CRED_CACHE.misses)]),
+    ]
+
+
+METRICS.collect(_collect_runtime)
+
+
+# ================== ASYNC RUNTIME ==================
+
+
+class ChatDispatcher:
+    # Mỗi chat có 1 hàng đợi + 1 task: tin của cùng 1 chat xử lý đúng thứ tự,
+    # các chat khác nhau chạy song song trong thread pool, nên 1 lệnh chậm
+    # (VD: /sao_luu gửi file) không chặn các chat khác.
+
+    def __init__(self, executor, handler, idle_timeout=60):
+        self.executor = executor
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self._queues = {}
+        # số update đang chờ trong các hàng (chỉ sửa trong thread event loop)
+        self.backlog = 0
+
+    def submit(self, update):
+        # chỉ gọi từ thread của event loop
+        chat_id = update_chat_id(update)
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+            asyncio.get_running_loop().create_task(
+                self._worker(chat_id, queue))
+        queue.put_nowait(update)
+        self.backlog += 1
+
+    def pending(self):
+        return self.backlog
+
+    async def _worker(self, chat_id, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(),
+                                                self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self._queues[chat_id]
+                    return
+                continue
+            self.backlog -= 1
+            try:
+                await loop.run_in_executor(self.executor, self.handler,
+                                           update)
+            except Exception as e:
+                print(f"Lỗi xử lý update (chat {chat_id}):", e)
+
+
+class WebhookReceiver:
+    # Nhận update Telegram POST tới WEBHOOK_PATH trên ping server (mỗi request
+    # 1 thread): kiểm tra đường dẫn và secret token trước khi đọc body (giới
+    # hạn MAX_BODY byte), đẩy update sang event loop rồi trả 200 ngay, không
+    # xử lý tại chỗ. Hàng chờ vượt maxsize thì trả 429 để Telegram tự gửi lại.
+
+    # 1 update Telegram chỉ vài KB
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self, path, secret, maxsize=1000):
+        self.path = path
+        self.secret = secret
+        self.maxsize = maxsize
+        self._loop = None
+        self._dispatcher = None
+        self._lock = threading.Lock()
+        self._scheduled = 0
+
+    def attach(self, loop, dispatcher):
+        self._loop = loop
+        self._dispatcher = dispatcher
+
+    def receive(self, path, headers, rfile):
+        if self._loop is None or path.split("?")[0] != self.path:
+            return 404
+        token = headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return 403
+        try:
+            length = int(headers.get("Content-Length") or 0)
+        except ValueError:
+            return 400
+        if length < 0:
+            return 400
+        if length > self.MAX_BODY:
+            return 413
+        try:
+            update = json.loads(rfile.read(length))
+        except ValueError:
+            return 400
+        with self._lock:
+            if self._scheduled + self._dispatcher.pending() >= self.maxsize:
+                return 429
+            self._scheduled += 1
+        self._loop.call_soon_threadsafe(self._deliver, update)
+        return 200
+
+    def _deliver(self, update):
+        with self._lock:
+            self._scheduled -= 1
+        self._dispatcher.submit(update)
+
+
+WEBHOOK = WebhookReceiver(WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE)
+
+
+def set_webhook():
+    try:
+        API.call("setWebhook", {
+            "url": WEBHOOK_URL + WEBHOOK_PATH,
+            "secret_token": WEBHOOK_SECRET,
+            "max_connections": HANDLER_WORKERS,
+        })
+        return True
+    except TelegramError as e:
+        print("Lỗi setWebhook, chuyển sang long polling:", e)
+        return False
+
+
+async def poll_updates(dispatcher):
+    loop = asyncio.get_running_loop()
+    try:
+        # getUpdates không chạy được khi còn webhook cũ
+        await loop.run_in_executor(None, API.call, "deleteWebhook")
+    except TelegramError as e:
+        print("Lỗi deleteWebhook:", e)
+    offset = None
+    while True:
+        try:
+            updates = await loop.run_in_executor(None, get_updates, offset)
         except Exception as e:
             print("Lỗi get_updates:", e)
-            time.sleep(5)
+            await asyncio.sleep(5)
             continue
+        HEALTH.mark("get_updates")
+        for u in updates:
+            offset = u["update_id"] + 1
+            dispatcher.submit(u)
 
-        if updates.get("ok"):
-            for u in updates["result"]:
-                offset = u["update_id"] + 1
-                msg = u.get("message")
-                if not msg:
-                    continue
-                chat_id = msg["chat"]["id"]
-                text = msg.get("text", "")
-                if not isinstance(text, str):
-                    continue
-                text = text.strip()
-
-                data = load_data()
-
-                if text == "/start":
-                    handle_start(chat_id)
-                elif text == "/help":
-                    handle_help(chat_id)
-                elif text == "/them_farm":
-                    start_add_farm(chat_id, data)
-                elif text == "/danh_sach":
-                    handle_list_farms(chat_id, data)
-                elif text == "/xem_farm":
-                    start_view_farm(chat_id, data)
-                elif text == "/sua_farm":
-                    start_edit_farm(chat_id, data)
-                elif text == "/xoa_farm":
-                    start_delete_farm(chat_id, data)
-                elif text == "/tim_farm":
-                    start_search_farm(chat_id, data)
-                elif text == "/thong_ke":
-                    handle_statistics(chat_id, data)
-                elif text == "/bao_cao_ngay":
-                    handle_daily_report(chat_id, data)
-                elif text == "/bao_cao_tuan":
-                    handle_weekly_report(chat_id, data)
-                elif text == "/lich_su":
-                    start_history(chat_id, data)
-                elif text == "/sao_luu":
-                    handle_backup(chat_id, data)
-                elif text == "/xuat_csv":
-                    handle_export_csv(chat_id, data)
-                elif text == "/bat_tat_nhac":
-                    start_toggle_reminder(chat_id, data)
-                elif text == "/set_mail_login":
-                    start_set_mail_login(chat_id, data)
-                elif text == "/get_mail_login":
-                    start_get_mail_login(chat_id, data)
-                elif text == "/huy":
-                    cancel_action(chat_id, data)
-
-                # keyboard buttons
-                elif text == "➕ Thêm":
-                    start_add_farm(chat_id, data)
-                elif text == "📋 Danh sách":
-                    handle_list_farms(chat_id, data)
-                elif text == "📊 Thống kê":
-                    handle_statistics(chat_id, data)
-                elif text == "📆 Báo cáo tuần":
-                    handle_weekly_report(chat_id, data)
-                elif text == "📅 Báo cáo hôm nay":
-                    handle_daily_report(chat_id, data)
-                elif text == "💾 Sao lưu":
-                    handle_backup(chat_id, data)
-                elif text == "📤 Xuất CSV":
-                    handle_export_csv(chat_id, data)
-                elif text == "🔔 Bật/Tắt nhắc":
-                    start_toggle_reminder(chat_id, data)
-
-                # flows
-                elif str(chat_id) in data.get("user_states", {}):
-                    state = data["user_states"][str(chat_id)]
-                    action = state.get("action")
-
-                    if action == "add_farm":
-                        handle_add_farm_flow(chat_id, text, data)
-                    elif action == "view_farm":
-                        handle_view_farm_flow(chat_id, text, data)
-                    elif action == "edit_farm":
-                        handle_edit_farm_flow(chat_id, text, data)
-                    elif action == "delete_farm":
-                        handle_delete_farm_flow(chat_id, text, data)
-                    elif action == "search_farm":
-                        handle_search_farm_flow(chat_id, text, data)
-                    elif action == "toggle_reminder":
-                        handle_toggle_reminder_flow(chat_id, text, data)
-                    elif action == "history":
-                        handle_history_flow(chat_id, text, data)
-                    elif action == "set_mail_login":
-                        handle_set_mail_login_flow(chat_id, text, data)
-                    elif action == "get_mail_login":
-                        handle_get_mail_login_flow(chat_id, text, data)
 
-                else:
-                    send_message(
-                        chat_id,
-                        "❌ Lệnh không hợp lệ. Gửi /help để xem hướng dẫn.")
+async def heartbeat():
+    # event loop còn chạy task được thì /healthz mới coi là sống
+    while True:
+        HEALTH.mark("loop")
+        await asyncio.sleep(10)
+
+
+async def run_bot():
+    executor = ThreadPoolExecutor(max_workers=HANDLER_WORKERS,
+                                  thread_name_prefix="handler")
+    dispatcher = ChatDispatcher(executor, handle_update)
+    METRICS.collect(lambda: [("bot_dispatch_backlog", "gauge",
+                              "Số update đang chờ xử lý",
+                              [({}, dispatcher.pending())])])
+    HEALTH.backlog = dispatcher.pending
+    loop = asyncio.get_running_loop()
+    loop.create_task(heartbeat())
+    if WEBHOOK_URL and await loop.run_in_executor(None, set_webhook):
+        HEALTH.mode = "webhook"
+        WEBHOOK.attach(loop, dispatcher)
+        print("🌐 Nhận update qua webhook:", WEBHOOK_URL + WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    else:
+        await poll_updates(dispatcher)
 
-        time.sleep(1)
+
+# ================== MAIN ==================
+
+
+def main():
+    threading.Thread(target=run_server).start()
+    print("🤖 Bot nhắc hạn đang chạy...")
+    STORE.start()
+    SESSIONS.load()
+    SESSIONS.adopt(STORE)
+    SESSIONS.start()
+    SCHEDULER.start()
+    BACKUPS.start(BACKUP_INTERVAL)
+    HEALTH.running = True
+    try:
+        asyncio.run(run_bot())
+    finally:
+        # ping server vẫn giữ tiến trình sống: báo cho /healthz biết
+        HEALTH.running = False
+        SESSIONS.flush()
+
+
+# ================== BENCHMARK ==================
+
+
+def _scan_search(farms, keyword):
+    # cách tìm cũ của /tim_farm: duyệt từng farm, so chuỗi con
+    kw = keyword.lower()
+    res = []
+    for f in farms:
+        if kw in f["name"].lower() or kw in f["owner_email"].lower():
+            res.append(f)
+            continue
+        for m in f.get("members", []):
+            if kw in m.lower():
+                res.append(f)
+                break
+    return res
+
+
+def bench_search(n_farms=100000, members_per_farm=5):
+    rnd = random.Random(1)
+    first = ["Hiếu", "Đức", "Nguyễn", "Trâm", "Phương", "Linh", "Quân", "Bảo"]
+    farms = []
+    for i in range(n_farms):
+        farms.append({
+            "id": i + 1,
+            "name": f"{rnd.choice(first)} {i}",
+            "owner_email": f"owner{i}.{rnd.randrange(10**6)}@gmail.com",
+            "members": [
+                f"mem{i}x{j}.{rnd.randrange(10**6)}@gmail.com"
+                for j in range(members_per_farm)
+            ],
+        })
+
+    t0 = time.perf_counter()
+    index = TrigramIndex()
+    for f in farms:
+        index.add(f)
+    build = time.perf_counter() - t0
+    print(f"{n_farms} farm, {n_farms * members_per_farm} email thành viên; "
+          f"dựng index {build:.2f}s")
+
+    target = farms[n_farms // 2]
+    queries = [
+        target["name"].lower(),
+        target["name"][:6],
+        target["members"][2].split("@")[0][2:],
+        "hieu 4242",
+        "khong-co-ket-qua",
+    ]
+    print(f"{'từ khoá':<32}{'scan (ms)':>12}{'index (ms)':>12}{'kết quả':>10}")
+    for q in queries:
+        t0 = time.perf_counter()
+        _scan_search(farms, q)
+        scan_ms = (time.perf_counter() - t0) * 1000
+        runs = 20
+        t0 = time.perf_counter()
+        for _ in range(runs):
+            ids = index.search(q)
+        index_ms = (time.perf_counter() - t0) * 1000 / runs
+        print(f"{q:<32}{scan_ms:>12.2f}{index_ms:>12.3f}{len(ids):>10}")
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "--migrate-sqlite":
+        # python bot.py --migrate-sqlite [farms_data.json] [farms_data.db]
+        migrate_json_to_sqlite(*sys.argv[2:4])
+    elif len(sys.argv) > 2 and sys.argv[1] == "--export-json":
+        # python bot.py --export-json out.json [farms_data.db]
+        export_sqlite_to_json(*sys.argv[2:4])
+    elif len(sys.argv) > 1 and sys.argv[1] == "--rotate-keys":
+        # python bot.py --rotate-keys (chỉ chạy khi bot đang tắt; khi bot
+        # đang chạy thì dùng lệnh /xoay_khoa)
+        print(rotate_keys())
+    elif len(sys.argv) > 1 and sys.argv[1] == "--backup":
+        # python bot.py --backup [full]
+        print(BACKUPS.backup(full=sys.argv[2:3] == ["full"]) or
+              "Không có thay đổi từ bản sao lưu trước.")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--restore":
+        # python bot.py --restore [tên manifest] (mặc định: bản mới nhất; chỉ
+        # chạy khi bot đang tắt, khi bot đang chạy thì dùng /khoi_phuc)
+        names = BACKUPS.list_manifests()
+        if len(sys.argv) <= 2 and not names:
+            print("📭 Chưa có bản sao lưu nào.")
+            raise SystemExit(1)
+        name = sys.argv[2] if len(sys.argv) > 2 else names[-1]
+        print(f"Đã khôi phục {BACKUPS.restore(name)} farm từ {name}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--bench-search":
+        # python bot.py --bench-search [số farm]
+        bench_search(*map(int, sys.argv[2:3]))
+    else:
+        main()
@@ -0,0 +1,26 @@
+# Phần chạy trong process con của /xoay_khoa (--rotate-keys).
+# Tách khỏi bot.py để process con (pool dùng spawn) không cần store, phiên,
+# client Telegram... của bot; module này chỉ phụ thuộc cryptography và không
+# có tác dụng phụ khi import.
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+_FERNET = None
+
+
+def init(keys):
+    # keys: khoá Fernet (đã dẫn xuất từ secret), khoá đầu dùng để mã hoá
+    global _FERNET
+    _FERNET = MultiFernet([Fernet(k) for k in keys])
+
+
+def rotate_tokens(tokens):
+    # giải mã bằng khoá mới/cũ rồi mã hoá lại bằng khoá mới; None = không
+    # giải mã được bằng khoá nào
+    out = []
+    for token in tokens:
+        try:
+            out.append(_FERNET.rotate(token.encode("utf-8")).decode())
+        except InvalidToken:
+            out.append(None)
+    return out
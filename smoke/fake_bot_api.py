@@ -0,0 +1,201 @@
+# Server giả lập Bot API cho smoke test: bot chạy với
+# TELEGRAM_API_URL=http://127.0.0.1:<cổng> sẽ gọi vào đây thay cho Telegram.
+#
+# Ngoài các method bot dùng (getUpdates, sendMessage, getFile, ...) còn có
+# các đường dẫn điều khiển cho script test:
+#   POST /_push  {"update": {...}}                 thêm 1 update cho getUpdates
+#   POST /_fail  {"method": ..., "codes": [...]}   các lần gọi tới trả lỗi
+#   POST /_file  {"file_id": ..., "data": base64}  file cho getFile / tải về
+#   GET  /_sent                                    các lần gọi đã nhận
+#
+# Chạy riêng: python smoke/fake_bot_api.py 8081
+
+import base64
+import json
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeBotApi:
+
+    def __init__(self, port=0):
+        self.updates = []
+        self.sent = []
+        self.failed = []
+        self.files = {}
+        self.fail_codes = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port),
+                                          self._handler_class())
+        self.server.daemon_threads = True
+        # bot bị dừng giữa 1 lần long poll: bỏ qua lỗi ghi vào socket đã đóng
+        self.server.handle_error = lambda request, client_address: None
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    # ---------- dùng trực tiếp từ script test ----------
+
+    def push(self, update):
+        with self.lock:
+            update = {**update, "update_id": len(self.updates) + 1}
+            self.updates.append(update)
+            return update["update_id"]
+
+    def fail(self, method, *codes):
+        with self.lock:
+            self.fail_codes.setdefault(method, []).extend(codes)
+
+    def calls(self, method=None):
+        with self.lock:
+            return [c for c in self.sent if method in (None, c["method"])]
+
+    # ---------- HTTP ----------
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, obj, code=200):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    body = b""
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return body
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get("Content-Length")
+                                           or 0))
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                body = self._body()
+                ctype = self.headers.get("Content-Type", "")
+                if "json" in ctype and body:
+                    params.update(json.loads(body))
+                elif "urlencoded" in ctype:
+                    params.update({
+                        k: v[0]
+                        for k, v in parse_qs(body.decode("utf-8")).items()
+                    })
+                elif "multipart" in ctype:
+                    msg = BytesParser().parsebytes(
+                        f"Content-Type: {ctype}\r\n\r\n".encode("utf-8") +
+                        body)
+                    for part in msg.get_payload():
+                        name = part.get_param("name", header="content-disposition")
+                        data = part.get_payload(decode=True)
+                        if part.get_filename():
+                            params[name] = {
+                                "filename": part.get_filename(),
+                                "size": len(data),
+                            }
+                        else:
+                            params[name] = data.decode("utf-8")
+                return url.path, params
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                path, params = self._params()
+                method = path.rsplit("/", 1)[-1]
+                if path == "/_push":
+                    api.push(params["update"])
+                    return self._reply({"ok": True})
+                if path == "/_fail":
+                    api.fail(params["method"], *params["codes"])
+                    return self._reply({"ok": True})
+                if path == "/_file":
+                    api.files[params["file_id"]] = base64.b64decode(
+                        params["data"])
+                    return self._reply({"ok": True})
+                if path == "/_sent":
+                    return self._reply(api.calls())
+                if "/file/bot" in path:
+                    data = api.files.get(method)
+                    if data is None:
+                        return self._reply({"ok": False}, 404)
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                if method == "getUpdates":
+                    return self._get_updates(params)
+                if method == "getFile":
+                    return self._reply({
+                        "ok": True,
+                        "result": {
+                            "file_id": params["file_id"],
+                            "file_path": params["file_id"],
+                        }
+                    })
+                with api.lock:
+                    codes = api.fail_codes.get(method)
+                    code = codes.pop(0) if codes else None
+                    if code is not None:
+                        api.failed.append({"method": method, "code": code,
+                                           **params})
+                if code == 429:
+                    return self._reply({
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests",
+                        "parameters": {"retry_after": 1},
+                    }, 429)
+                if code is not None:
+                    return self._reply({"ok": False, "error_code": code}, code)
+                with api.lock:
+                    api.sent.append({"method": method, "t": time.time(),
+                                     **params})
+                    message_id = len(api.sent)
+                return self._reply({
+                    "ok": True,
+                    "result": {"message_id": message_id}
+                })
+
+            def _get_updates(self, params):
+                offset = int(params.get("offset") or 0)
+                deadline = time.time() + min(float(params.get("timeout", 0)), 1)
+                while True:
+                    with api.lock:
+                        res = [u for u in api.updates
+                               if u["update_id"] >= offset]
+                    if res or time.time() > deadline:
+                        return self._reply({"ok": True, "result": res})
+                    time.sleep(0.05)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    api = FakeBotApi(int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
+    print("Fake Bot API:", api.url)
+    api.server.serve_forever()
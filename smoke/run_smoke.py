@@ -0,0 +1,582 @@
+# Smoke test cho runtime và dữ liệu của bot, không cần Telegram thật:
+#   python smoke/run_smoke.py
+#
+# - bot.py chạy thành process riêng, nói chuyện với server giả lập Bot API
+#   (fake_bot_api.py): thứ tự trả lời trong từng chat, thử lại khi gặp 429/5xx;
+# - các phần còn lại import bot trong 1 thư mục tạm: journal + compact của
+#   JsonStore, nhắc bù của scheduler sau khi bot tắt.
+#
+# Mỗi kiểm tra in "ok <tên>"; lỗi đầu tiên dừng script với mã thoát 1.
+
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "smoke"))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+BOT_ENV = {
+    "TELEGRAM_BOT_TOKEN": "smoke-token",
+    "MASTER_SECRET": "smoke-secret",
+    "BACKUP_INTERVAL": "0",
+    "SESSION_FILE": "",
+    "REMINDER_HOUR": "0",
+}
+
+CHECKS = []
+
+
+def check(fn):
+    CHECKS.append(fn)
+    return fn
+
+
+def wait_for(cond, timeout=30, what="điều kiện"):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return
+        time.sleep(0.05)
+    raise AssertionError(f"hết {timeout}s vẫn chưa thấy {what}")
+
+
+# ================== BOT PROCESS + FAKE API ==================
+
+
+def message(chat_id, text):
+    return {"message": {"chat": {"id": chat_id}, "text": text}}
+
+
+@check
+def chat_ordering_and_retry():
+    # 5 chat gửi xen kẽ 4 lệnh; lần sendMessage đầu bị 429, lần sau 502:
+    # mọi tin vẫn tới đủ 1 lần và đúng thứ tự trong từng chat
+    api = FakeBotApi().start()
+    work = tempfile.mkdtemp()
+    env = {**os.environ, **BOT_ENV, "TELEGRAM_API_URL": api.url}
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")],
+                            cwd=work, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.STDOUT)
+    try:
+        chats = range(11, 16)
+        script = [
+            ("/help", "📖"),
+            ("/thong_ke", "📭 Chưa có dữ liệu để thống kê"),
+            ("/danh_sach", "📭 Chưa có dữ liệu."),
+            ("/huy", "ℹ️ Không có thao tác"),
+        ]
+        api.fail("sendMessage", 429, 502)
+        for text, _ in script:
+            for chat_id in chats:
+                api.push(message(chat_id, text))
+        total = len(script) * len(chats)
+        wait_for(lambda: len(api.calls("sendMessage")) >= total,
+                 what=f"{total} tin trả lời")
+        time.sleep(0.5)
+        sent = api.calls("sendMessage")
+        assert len(sent) == total, f"gửi {len(sent)} tin, cần {total}"
+        assert [f["code"] for f in api.failed] == [429, 502], api.failed
+        for chat_id in chats:
+            texts = [m["text"] for m in sent if int(m["chat_id"]) == chat_id]
+            for got, (cmd, prefix) in zip(texts, script):
+                assert got.startswith(prefix), (chat_id, cmd, got[:40])
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        api.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+@check
+def spawn_child_skips_globals():
+    # process con của pool xoay khoá chạy lại bot.py dưới tên __mp_main__:
+    # không được mở farms_data.db hay tạo store/client trong đó
+    work = tempfile.mkdtemp()
+    env = {**os.environ, **BOT_ENV, "STORAGE_BACKEND": "sqlite"}
+    code = ("import runpy; g = runpy.run_path('bot.py', run_name='__mp_main__'); "
+            "print([k for k in ('STORE', 'SESSIONS', 'BACKUPS', 'API', "
+            "'OUTBOX', 'PAGES', 'SCHEDULER') if g[k] is not None])")
+    try:
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env={
+            **env, "SQLITE_FILE": os.path.join(work, "farms.db")
+        }, capture_output=True, text=True, timeout=60)
+        assert out.returncode == 0, out.stderr
+        assert out.stdout.strip().splitlines()[-1] == "[]", out.stdout
+        assert os.listdir(work) == [], os.listdir(work)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+@check
+def restore_cli_without_backups():
+    # --restore khi BACKUP_DIR chưa có bản nào: báo rõ và thoát mã khác 0
+    work = tempfile.mkdtemp()
+    try:
+        out = subprocess.run(
+            [sys.executable, os.path.join(ROOT, "bot.py"), "--restore"],
+            cwd=work, env={**os.environ, **BOT_ENV}, capture_output=True,
+            text=True, timeout=60)
+        assert out.returncode == 1, (out.returncode, out.stderr)
+        assert "Chưa có bản sao lưu nào" in out.stdout, out.stdout
+        assert "Traceback" not in out.stderr, out.stderr
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+# ================== IN-PROCESS ==================
+
+
+def import_bot():
+    # bot đọc cấu hình và mở store ngay khi import: chạy trong thư mục tạm
+    os.environ.update(BOT_ENV)
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    import bot
+    return bot
+
+
+def new_farm(name, renewal_day=1, chat_id=7):
+    return {
+        "name": name,
+        "owner_email": f"{name.lower()}@example.com",
+        "members": [],
+        "start_date": "2025-01-01",
+        "renewal_day": renewal_day,
+        "price": 1000,
+        "chat_id": chat_id,
+        "reminder_enabled": True,
+        "reminder_history": [],
+        "email_logins": {},
+    }
+
+
+@check
+def chat_locks_are_per_chat(bot):
+    # handler chậm của chat 1 không được chặn chat khác (kể cả chat từng
+    # chung ngăn khoá theo hash), nhưng 2 lần gọi cùng chat vẫn tuần tự
+    import threading
+    release = threading.Event()
+    order = []
+
+    def slow():
+        order.append("slow start")
+        release.wait(5)
+        order.append("slow end")
+
+    def run(chat_id, call, name):
+        ctx = {"chat_id": chat_id, "text": name, "handler": name}
+        t = threading.Thread(target=bot.ROUTER._run, args=(ctx, call))
+        t.start()
+        return t
+
+    other = next(c for c in range(2, 10000)
+                 if hash(str(c)) % 64 == hash("1") % 64)
+    t1 = run(1, slow, "slow")
+    wait_for(lambda: order, 5, "handler chậm bắt đầu")
+    t2 = run(other, lambda: order.append("other"), "other")
+    t2.join(2)
+    assert order == ["slow start", "other"], order
+    t3 = run(1, lambda: order.append("same chat"), "same")
+    time.sleep(0.2)
+    assert "same chat" not in order, order
+    release.set()
+    for t in (t1, t3):
+        t.join(5)
+    assert order[-2:] == ["slow end", "same chat"], order
+    assert len(bot.CHAT_LOCKS) == 0
+
+
+@check
+def callback_answers_skip_chat_rate(bot):
+    # chat đã hết lượt 1 tin/giây: trả lời nút bấm vẫn đi ngay, không phải
+    # chờ sau tin đang đợi lượt
+    class Api:
+        def call(self, method, params, **kwargs):
+            return {"method": method}
+
+    queue = bot.OutboundQueue(Api(), rate=30, chat_rate=1, chat_burst=3)
+    for i in range(3):
+        queue.submit(5, "sendMessage", {"text": str(i)}).result(5)
+    started = time.monotonic()
+    waiting = queue.submit(5, "sendMessage", {"text": "4"})
+    answers = [queue.submit(5, "answerCallbackQuery", {"callback_query_id": i})
+               for i in range(4)]
+    for f in answers:
+        f.result(5)
+    answered = time.monotonic() - started
+    waiting.result(5)
+    sent = time.monotonic() - started
+    assert answered < 0.3 < sent, (answered, sent)
+
+
+@check
+def webhook_rejects_before_reading(bot):
+    # sai đường dẫn/secret hoặc body quá lớn: trả lỗi mà không đọc body
+    import io
+
+    class Body(io.BytesIO):
+        reads = 0
+
+        def read(self, n=-1):
+            Body.reads += 1
+            return super().read(n)
+
+    class Loop:
+        def call_soon_threadsafe(self, fn, *args):
+            fn(*args)
+
+    class Dispatcher:
+        updates = []
+
+        def pending(self):
+            return 0
+
+        def submit(self, update):
+            self.updates.append(update)
+
+    receiver = bot.WebhookReceiver("/hook", "s3cret")
+    receiver.attach(Loop(), Dispatcher())
+    body = json.dumps({"update_id": 1}).encode()
+    ok = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+    huge = {"Content-Length": str(10**10)}
+    cases = [
+        ("/other", {**ok, **huge}, 404),
+        ("/hook", {"X-Telegram-Bot-Api-Secret-Token": "x", **huge}, 403),
+        ("/hook", huge, 403),
+        ("/hook", {**ok, **huge}, 413),
+        ("/hook", {**ok, "Content-Length": "abc"}, 400),
+        ("/hook", {**ok, "Content-Length": "-5"}, 400),
+    ]
+    for path, headers, status in cases:
+        got = receiver.receive(path, headers, Body(body))
+        assert got == status, (path, headers, got)
+    assert Body.reads == 0, Body.reads
+    headers = {**ok, "Content-Length": str(len(body))}
+    assert receiver.receive("/hook", headers, Body(body)) == 200
+    assert Dispatcher.updates == [{"update_id": 1}]
+
+
+@check
+def store_replay_and_compaction(bot):
+    os.makedirs("store", exist_ok=True)
+    path = os.path.join("store", "farms.json")
+
+    def open_store():
+        return bot.JsonStore(path, path + ".journal", 1 << 30)
+
+    def dump(store):
+        # bỏ journal_seq: chỉ là mốc của snapshot, không phải dữ liệu
+        return json.dumps({"farms": store.farms(), **store.export_state()},
+                          sort_keys=True)
+
+    store = open_store()
+    a = store.add_farm(new_farm("A"))
+    store.add_farms([new_farm(f"B{i}") for i in range(3)])
+    store.update_farm(a, price=5000, members=["m@example.com"])
+    store.delete_farm(store.find_farm("B1"))
+    store.add_history(a, {"type": "1day", "date": "2025-01-01",
+                          "renewal_date": "2025-01-02"})
+    store.set_meta("k", "v")
+    before = dump(store)
+    assert not os.path.exists(path), "snapshot ghi khi chưa compact"
+
+    # chỉ có journal: mở lại = phát lại journal
+    assert dump(open_store()) == before
+
+    # compact: snapshot mới, journal bị gộp hết
+    store.compact()
+    assert not os.path.exists(path + ".journal")
+    assert dump(open_store()) == before
+
+    # snapshot + journal mới hơn
+    store.update_farm(store.find_farm("B2"), name="B2x")
+    after = dump(store)
+    reopened = open_store()
+    assert dump(reopened) == after
+    assert reopened.find_farm("B2x")["id"] == store.find_farm("B2x")["id"]
+    assert reopened.add_farm(new_farm("C"))["id"] == 5
+
+
+@check
+def store_external_edit_keeps_journal(bot):
+    # ghi (chỉ nằm trong journal) -> sửa tay farms.json -> đọc lại: vừa thấy
+    # chỗ sửa tay vừa giữ lần ghi chưa compact
+    os.makedirs("external", exist_ok=True)
+    path = os.path.join("external", "farms.json")
+
+    def open_store():
+        return bot.JsonStore(path, path + ".journal", 1 << 30)
+
+    store = open_store()
+    store.add_farm(new_farm("X"))
+    store.compact()
+    store.add_farm(new_farm("F1"))
+    store.update_farm(store.find_farm("X"), price=7)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data["farms"][0]["owner_email"] = "hand@example.com"
+    data["meta"]["edited"] = True
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def state(store):
+        return sorted((f["name"], f["owner_email"], f["price"])
+                      for f in store.farms())
+
+    expected = [("F1", "f1@example.com", 1000),
+                ("X", "hand@example.com", 7)]
+    assert state(store) == expected, state(store)
+    assert store.get_meta("edited") is True
+    assert state(open_store()) == expected
+    store.add_farm(new_farm("F2"))
+    store.compact()
+    assert not os.path.exists(path + ".journal")
+    assert [f["name"] for f in open_store().farms()] == ["X", "F1", "F2"]
+
+
+@check
+def scheduler_catch_up(bot):
+    # bot tắt 6 ngày: lần chạy sau nhắc bù đúng 1 lần cho mỗi farm đã/đang
+    # đến hạn, farm còn xa không bị nhắc, chạy lại không nhắc trùng
+    sent = []
+    bot.send_message = lambda chat_id, text, **kw: sent.append((chat_id, text))
+    store = bot.STORE
+    today = datetime.date.today()
+
+    def add(name, delta):
+        day = (today + datetime.timedelta(days=delta)).day
+        return store.add_farm(new_farm(name, renewal_day=day, chat_id=21))
+
+    due0, due2, past3 = add("Due0", 0), add("Due2", 2), add("Past3", -3)
+    far = add("Far", 10)
+    store.set_meta("reminder_checkpoint",
+                   (datetime.datetime.now() -
+                    datetime.timedelta(days=6)).isoformat())
+    scheduler = bot.ReminderScheduler(store)
+    scheduler._rebuild()
+    scheduler._fire_due()
+    assert sent, "không có tin nhắc bù"
+    kinds = {
+        f["name"]: [h["type"] for h in store.farm_by_id(f["id"])
+                    ["reminder_history"]]
+        for f in (due0, due2, past3, far)
+    }
+    assert kinds == {"Due0": ["0day"], "Due2": ["2days"],
+                     "Past3": ["0day"], "Far": []}, kinds
+
+    sent.clear()
+    scheduler._rebuild()
+    scheduler._fire_due()
+    assert not sent, sent
+
+
+@check
+def scheduler_heartbeat_when_idle(bot):
+    # không có farm nào (heap rỗng): thread vẫn thức dậy đều và đánh dấu
+    # reminder_pass, /readyz không báo lỗi chỉ vì lâu không có lần nhắc
+    path = os.path.join("idle", "farms.json")
+    os.makedirs("idle", exist_ok=True)
+    scheduler = bot.ReminderScheduler(
+        bot.JsonStore(path, path + ".journal", 1 << 30))
+    scheduler.WAKE_SECONDS = 0.1
+    scheduler.start()
+    time.sleep(0.3)
+    for _ in range(5):
+        time.sleep(0.2)
+        age = bot.HEALTH.age("reminder_pass")
+        assert age is not None and age < 0.2, age
+    assert not scheduler._heap
+
+
+@check
+def sessions_flush_own_copy(bot):
+    # flush chạy ở thread nền: state handler đang sửa (chưa set lại) không
+    # được lọt vào file phiên, set rồi mới ghi
+    sessions = bot.SessionStore(60, 10, "sessions_smoke.json")
+    sessions.set(1, {"step": "member", "farm": {"members": []}})
+    state = sessions.get(1)
+    state["farm"]["members"].append("a@x.com")
+    state["step"] = "start"
+    sessions.flush()
+    reloaded = bot.SessionStore(60, 10, "sessions_smoke.json")
+    reloaded.load()
+    assert reloaded.get(1) == {"step": "member", "farm": {"members": []}}
+    sessions.set(1, state)
+    state["farm"]["members"].append("b@x.com")
+    sessions.flush()
+    reloaded = bot.SessionStore(60, 10, "sessions_smoke.json")
+    reloaded.load()
+    assert reloaded.get(1) == {
+        "step": "start", "farm": {"members": ["a@x.com"]}}, reloaded.get(1)
+
+
+@check
+def rotate_keys_in_pool(bot):
+    # login mã hoá bằng khoá cũ được xoay qua pool spawn (rotation_worker)
+    from cryptography.fernet import Fernet
+    os.makedirs("rotate", exist_ok=True)
+    path = os.path.join("rotate", "farms.json")
+    store = bot.JsonStore(path, path + ".journal", 1 << 30)
+    old = Fernet(bot._fernet_key("old-secret"))
+    for i in range(3):
+        farm = store.add_farm(new_farm(f"r{i}"))
+        store.set_email_login(farm, f"u{i}@example.com", {
+            "enc": old.encrypt(f"pw{i}".encode()).decode(),
+            "kid": bot.key_id("old-secret"),
+        })
+    saved = bot.OLD_MASTER_SECRETS
+    bot.OLD_MASTER_SECRETS = ["old-secret"]
+    try:
+        state = bot.rotate_keys(store, batch_size=2, workers=2,
+                                progress=lambda msg: None)
+    finally:
+        bot.OLD_MASTER_SECRETS = saved
+    assert state["rotated"] == 3 and state["failed"] == 0, state
+    for i, farm in enumerate(store.farms()):
+        login = farm["email_logins"][f"u{i}@example.com"]
+        assert login["kid"] == bot.KEY_ID
+        assert bot.decrypt_text(login["enc"]) == f"pw{i}"
+
+
+@check
+def json_import_validates_rows(bot):
+    # login/lịch sử sai kiểu: lỗi của riêng dòng đó, không làm hỏng cả file;
+    # lịch sử dài bị cắt còn HISTORY_KEEP, phần cũ vào lưu trữ
+    import io
+    keep = bot.HISTORY.keep
+    history = [{"type": "1day", "date": f"2024-{m:02d}-01",
+                "renewal_date": f"2024-{m:02d}-02"} for m in range(1, 13)]
+    history *= 3
+    rows = [
+        {**new_farm("Imp ok"), "start_date": "2025-01-01",
+         "reminder_history": history,
+         "email_logins": {"a@x": {"enc": "token", "kid": 1}}},
+        {**new_farm("Imp bad login"), "email_logins": {"a@x": "plain"}},
+        {**new_farm("Imp bad logins"), "email_logins": ["a@x"]},
+        {**new_farm("Imp bad history"), "reminder_history": ["1day"]},
+        {**new_farm("Imp members num"), "members": 5},
+        {**new_farm("Imp members item"), "members": ["m@x", 3.5]},
+    ]
+
+    class Resp:
+        raw = io.BytesIO(json.dumps({"farms": rows}).encode())
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    sent = []
+    bot.send_message = lambda chat_id, text, **kw: sent.append(text)
+    bot.API.download = lambda file_id: Resp()
+    bot.handle_import_document(31, {"file_name": "farms.json",
+                                    "file_id": "f"})
+    assert "Đã nhập <b>1</b> farm, bỏ qua <b>5</b>" in sent[-1], sent[-1]
+    for line in ("Dòng 2: login của a@x", "Dòng 3: email_logins",
+                 "Dòng 4: reminder_history", "Dòng 5: members phải",
+                 "Dòng 6: members phải"):
+        assert line in sent[-1], sent[-1]
+    farm = bot.STORE.find_farm("Imp ok", owner=31)
+    assert farm["reminder_history"] == history[-keep:]
+    archived = bot.HISTORY.query(farm["id"])
+    assert len(archived) == len(history) - keep, len(archived)
+
+
+@check
+def picker_pages(bot):
+    # trang chọn farm: PICK_PAGE_SIZE tên, 2 nút/hàng, dưới giới hạn 100 nút
+    os.makedirs("pages", exist_ok=True)
+    path = os.path.join("pages", "farms.json")
+    store = bot.JsonStore(path, path + ".journal", 1 << 30)
+    store.add_farms([new_farm(f"p{i:02d}") for i in range(45)])
+    pages = bot.PageCache(store)
+    text, markup = pages.get("view", 0, None)
+    rows = markup["inline_keyboard"]
+    picks = [b for row in rows[:-1] for b in row]
+    assert len(picks) == bot.PICK_PAGE_SIZE == 40, len(picks)
+    assert "p39" in text and "p40" not in text
+    assert sum(map(len, rows)) <= 100
+    text, markup = pages.get("view", 1, None)
+    assert "p44" in text and "p39" not in text
+
+
+@check
+def all_tenants_toggle_in_memory(bot):
+    # /xem_tat_ca là tuỳ chọn xem của admin: không ghi vào dữ liệu farm
+    sent = []
+    bot.send_message = lambda chat_id, text, **kw: sent.append(text)
+    bot.ADMIN_CHAT_IDS.add("5")
+    try:
+        before = bot.STORE.export_state()
+        bot.handle_all_tenants(5)
+        assert bot.scope_of(5) is None
+        assert bot.scope_of(6) == 6
+        assert bot.STORE.export_state() == before
+        bot.handle_all_tenants(5)
+        assert bot.scope_of(5) == 5
+        assert bot.STORE.export_state() == before
+        bot.handle_all_tenants(6)
+        assert bot.scope_of(6) == 6 and "admin" in sent[-1], sent
+    finally:
+        bot.ADMIN_CHAT_IDS.discard("5")
+
+
+@check
+def backup_after_restore(bot):
+    # full -> sửa -> delta -> khôi phục bản full -> sửa -> sao lưu: bản mới
+    # nhất phải là dữ liệu sau khi khôi phục, không nối vào chuỗi cũ
+    os.makedirs("restore", exist_ok=True)
+    path = os.path.join("restore", "farms.json")
+    store = bot.JsonStore(path, path + ".journal", 1 << 30)
+    backups = bot.BackupManager(store, os.path.join("restore", "backups"))
+    for i in range(3):
+        store.add_farm(new_farm(f"f{i}"))
+    full = backups.backup(full=True)["name"]
+    store.update_farm(store.farm_by_id(1), name="EDITED")
+    assert backups.backup()["kind"] == "delta"
+    backups.restore(full)
+    store.update_farm(store.farm_by_id(2), price=99)
+    backups.backup()
+
+    def state(name):
+        data, _ = backups.load(name)
+        return [(f["name"], f["price"]) for f in data["farms"]]
+
+    latest = backups.list_manifests()[-1]
+    assert state(latest) == [("f0", 1000), ("f1", 99), ("f2", 1000)], \
+        state(latest)
+    # chuỗi của bản mới nhất bắt đầu từ bản full ghi ngay sau khi khôi phục
+    _, _, depth = backups.resolve(latest)
+    assert depth == 1, depth
+
+
+def main():
+    bot = None
+    for fn in CHECKS:
+        try:
+            if fn.__code__.co_argcount:
+                bot = bot or import_bot()
+                fn(bot)
+            else:
+                fn()
+        except Exception:
+            traceback.print_exc()
+            print("FAIL", fn.__name__)
+            return 1
+        print("ok", fn.__name__)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())